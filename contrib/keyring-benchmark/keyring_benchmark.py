@@ -0,0 +1,83 @@
+#!/usr/bin/python2
+#
+# Copyright (C) 2016  FreeIPA Contributors see COPYING for license
+#
+"""Measure latency of kernel keyring operations done by the ipa CLI
+
+Every ipa command reads the session cookie from the kernel keyring and
+stores the new one after the request. The benchmark repeats this sequence
+with the libkeyutils backend and with the keyctl utility backend of
+ipapython.kernel_keyring and prints latency of each operation.
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from ipapython import kernel_keyring
+
+KEY = 'ipa_keyring_benchmark'
+COOKIE = b'ipa_session=' + b'0123456789abcdef' * 4
+
+
+def measure(func, *args):
+    start = time.time()
+    func(*args)
+    return (time.time() - start) * 1000
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_benchmark(backend, rounds):
+    saved_backend = kernel_keyring._get_backend()
+    kernel_keyring._backend = backend
+    timings = dict(add=[], read=[], update=[], delete=[], command=[])
+    try:
+        try:
+            kernel_keyring.del_key(KEY)
+        except ValueError:
+            pass
+        for _i in range(rounds):
+            timings['add'].append(measure(kernel_keyring.add_key, KEY, COOKIE))
+            start = time.time()
+            timings['read'].append(measure(kernel_keyring.read_key, KEY))
+            timings['update'].append(
+                measure(kernel_keyring.update_key, KEY, COOKIE))
+            timings['command'].append((time.time() - start) * 1000)
+            timings['delete'].append(measure(kernel_keyring.del_key, KEY))
+    finally:
+        kernel_keyring._backend = saved_backend
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=100,
+                        help='number of repetitions (default: 100)')
+    args = parser.parse_args()
+
+    backends = [('keyctl', kernel_keyring._KeyctlBackend())]
+    default_backend = kernel_keyring._get_backend()
+    if isinstance(default_backend, kernel_keyring._KeyutilsBackend):
+        backends.insert(0, ('libkeyutils', default_backend))
+    else:
+        print('libkeyutils is not available')
+
+    print('%-12s %-8s %10s %10s %10s' % (
+        'backend', 'op', 'mean ms', 'median ms', 'p95 ms'))
+    for name, backend in backends:
+        timings = run_benchmark(backend, args.rounds)
+        for op in ('add', 'read', 'update', 'delete', 'command'):
+            values = timings[op]
+            print('%-12s %-8s %10.3f %10.3f %10.3f' % (
+                name, op, sum(values) / len(values),
+                percentile(values, 0.5), percentile(values, 0.95)))
+    print("'command' is read and update of the session cookie done by "
+          "every ipa command")
+
+
+if __name__ == '__main__':
+    main()
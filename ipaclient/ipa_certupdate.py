@@ -111,14 +111,15 @@ class CertUpdate(admintool.AdminTool):
         ipa_db = certdb.NSSDatabase(paths.IPA_NSSDB_DIR)
 
         # Remove old IPA certs from /etc/ipa/nssdb
-        for nickname in ('IPA CA', 'External CA cert'):
-            while ipa_db.has_nickname(nickname):
-                try:
-                    ipa_db.delete_cert(nickname)
-                except ipautil.CalledProcessError as e:
-                    self.log.error("Failed to remove %s from %s: %s",
-                                   nickname, ipa_db.secdir, e)
-                    break
+        try:
+            with ipa_db.batch():
+                # there is one line for every cert with the nickname
+                for nickname, _flags in ipa_db.list_certs():
+                    if nickname in ('IPA CA', 'External CA cert'):
+                        ipa_db.delete_cert(nickname)
+        except ipautil.CalledProcessError as e:
+            self.log.error("Failed to remove old IPA certs from %s: %s",
+                           ipa_db.secdir, e)
 
         self.update_db(ipa_db.secdir, certs)
 
@@ -174,6 +175,19 @@ class CertUpdate(admintool.AdminTool):
 
     def update_db(self, path, certs):
         db = certdb.NSSDatabase(path)
+        try:
+            with db.batch():
+                for cert, nickname, trusted, eku in certs:
+                    trust_flags = certstore.key_policy_to_trust_flags(
+                        trusted, True, eku)
+                    db.add_cert(cert, nickname, trust_flags)
+        except ipautil.CalledProcessError as e:
+            self.log.debug("Batch update of %s failed: %s", path, e)
+        else:
+            return
+
+        # adding a cert again is harmless, retry one by one to find out
+        # which cert failed
         for cert, nickname, trusted, eku in certs:
             trust_flags = certstore.key_policy_to_trust_flags(
                 trusted, True, eku)
@@ -45,12 +45,22 @@ with clear text passwords. All migrated users need to
 login at https://your.domain/ipa/migration/ before they
 can use their Kerberos accounts.''')
 
+    migration_incomplete_msg = _('''\
+Migration was stopped before all entries were processed.
+Use \'--resume\' option to continue.''')
+
     def get_options(self):
         for option in super(migrate_ds, self).get_options():
             if option.name == 'cacertfile':
                 option = option.clone_retype(option.name, File)
             yield option
 
+    def interactive_prompt_callback(self, kw):
+        # the bind password is not needed to show the stored checkpoint
+        if not kw.get('status') and kw.get('bindpw') is None:
+            kw['bindpw'] = self.Backend.textui.prompt_password(
+                self.params['bindpw'].label, confirm=False)
+
     def output_for_cli(self, textui, result, ldapuri, **options):
         textui.print_name(self.name)
         if not result['enabled']:
@@ -59,6 +69,21 @@ can use their Kerberos accounts.''')
         if not result['compat']:
             textui.print_plain("The compat plug-in is enabled. This can increase the memory requirements during migration. Disable the compat plug-in with \'ipa-compat-manage disable\' or re-run this script with \'--with-compat\' option.")
             return 1
+        checkpoint = result.get('checkpoint', {})
+        if options.get('status'):
+            for ldap_obj_name in self.migrate_order:
+                status = checkpoint.get(ldap_obj_name, {})
+                textui.print_plain('%s:' % ldap_obj_name)
+                textui.print_attribute('Complete', status.get('done', False))
+                textui.print_attribute('Migrated', status.get('migrated', 0))
+                if status.get('last'):
+                    textui.print_attribute('Last', status['last'])
+                textui.print_plain('Failed %s:' % ldap_obj_name)
+                textui.print_entry1(
+                    result['failed'].get(ldap_obj_name, {}),
+                    one_value_per_line=True,
+                )
+            return 0
         any_migrated = any(result['result'].values())
         textui.print_plain('Migrated:')
         textui.print_entry1(
@@ -72,6 +97,8 @@ can use their Kerberos accounts.''')
                 one_value_per_line=True,
             )
         textui.print_plain('-' * len(self.name))
+        if not all(c.get('done') for c in checkpoint.values()):
+            textui.print_plain(unicode(self.migration_incomplete_msg))
         if not any_migrated:
             textui.print_plain('No users/groups were migrated from %s' %
                                ldapuri)
@@ -21,9 +21,13 @@ from __future__ import print_function
 
 import base64
 import getpass
+import hashlib
+import hmac
 import io
+import itertools
 import json
 import os
+import struct
 import sys
 
 from cryptography.fernet import Fernet, InvalidToken
@@ -44,6 +48,7 @@ from ipalib import Bytes, Flag, Str
 from ipalib.plugable import Registry
 from ipalib import _
 from ipaplatform.paths import paths
+from ipapython import kernel_keyring
 
 
 def validated_read(argname, filename, mode='r', encoding=None):
@@ -76,6 +81,12 @@ register = Registry()
 
 MAX_VAULT_DATA_SIZE = 2**20  # = 1 MB
 
+# larger files are archived as a sequence of chunks of this size
+VAULT_CHUNK_SIZE = MAX_VAULT_DATA_SIZE
+
+# upload ID, chunk index and last chunk flag encrypted with each chunk
+CHUNK_HEADER = struct.Struct('!16sQ?')
+
 
 def get_new_password():
     """
@@ -115,6 +126,56 @@ def generate_symmetric_key(password, salt):
     return base64.b64encode(kdf.derive(password.encode('utf-8')))
 
 
+def get_symmetric_key(api, password, salt):
+    """
+    Returns symmetric key generated from password and salt.
+
+    If vault_key_cache_ttl is set, generated keys are cached in the kernel
+    keyring for the given number of seconds, so that repeated operations
+    with the same vault do not have to derive the key again.
+
+    The cached key is named after the salt only, key names are visible to
+    other users. The password is verified with an HMAC keyed with the
+    cached key itself, which cannot be used to guess the password without
+    knowing the key.
+    """
+    ttl = api.env.vault_key_cache_ttl
+    if not ttl:
+        return generate_symmetric_key(password, salt)
+
+    # the salt is unique for each vault
+    keyname = 'ipa_vault_key:%s' % hashlib.sha256(salt).hexdigest()
+
+    def password_mac(symmetric_key):
+        return hmac.new(symmetric_key, password.encode('utf-8'),
+                        hashlib.sha256).hexdigest().encode('ascii')
+
+    try:
+        mac, _sep, symmetric_key = kernel_keyring.read_key(
+            keyname).partition(b':')
+    except ValueError:
+        pass
+    else:
+        if symmetric_key and hmac.compare_digest(
+                mac, password_mac(symmetric_key)):
+            return symmetric_key
+        # A different password was given, do not replace the cached key
+        # in case the password is wrong.
+        return generate_symmetric_key(password, salt)
+
+    symmetric_key = generate_symmetric_key(password, salt)
+
+    # kernel_keyring only raises ValueError
+    try:
+        kernel_keyring.update_key(
+            keyname, password_mac(symmetric_key) + b':' + symmetric_key)
+        kernel_keyring.set_key_timeout(keyname, ttl)
+    except ValueError:
+        pass
+
+    return symmetric_key
+
+
 def encrypt(data, symmetric_key=None, public_key=None):
     """
     Encrypts data with symmetric key or public key.
@@ -170,6 +231,187 @@ def decrypt(data, symmetric_key=None, private_key=None):
                 message=_('Invalid credentials'))
 
 
+def encrypt_chunk(data, upload_id, index, last, symmetric_key=None):
+    """
+    Encrypts a data chunk with symmetric key.
+
+    The upload ID, position of the chunk and whether it is the last chunk
+    are encrypted along with the data, so chunks cannot be reordered,
+    dropped or mixed with chunks of other uploads undetected.
+    """
+    data = CHUNK_HEADER.pack(upload_id, index, last) + data
+    if symmetric_key:
+        data = encrypt(data, symmetric_key=symmetric_key)
+    return data
+
+
+def decrypt_chunk(data, upload_id, index, last, symmetric_key=None):
+    """
+    Decrypts a data chunk encrypted by encrypt_chunk() and verifies its
+    position.
+    """
+    if symmetric_key:
+        data = decrypt(data, symmetric_key=symmetric_key)
+    header = data[:CHUNK_HEADER.size]
+    if (len(header) != CHUNK_HEADER.size or
+            CHUNK_HEADER.unpack(header) != (upload_id, index, last)):
+        raise errors.AuthenticationError(message=_('Invalid vault data'))
+    return data[CHUNK_HEADER.size:]
+
+
+def create_transport_session(api):
+    """
+    Generates a session key and wraps it with the KRA transport certificate.
+
+    :returns: tuple (mechanism, session key, wrapped session key)
+    """
+    # initialize NSS database
+    current_dbdir = paths.IPA_NSSDB_DIR
+    nss.nss_init(current_dbdir)
+
+    # retrieve transport certificate
+    config = api.Command.vaultconfig_show()['result']
+    transport_cert_der = config['transport_cert']
+    nss_transport_cert = nss.Certificate(transport_cert_der)
+
+    # generate session key
+    mechanism = nss.CKM_DES3_CBC_PAD
+    slot = nss.get_best_slot(mechanism)
+    key_length = slot.get_best_key_length(mechanism)
+    session_key = slot.key_gen(mechanism, None, key_length)
+
+    # wrap session key with transport certificate
+    # pylint: disable=no-member
+    public_key = nss_transport_cert.subject_public_key_info.public_key
+    # pylint: enable=no-member
+    wrapped_session_key = nss.pub_wrap_sym_key(mechanism,
+                                               public_key,
+                                               session_key)
+
+    return mechanism, session_key, wrapped_session_key.data
+
+
+def wrap_vault_data(mechanism, session_key, vault_data):
+    """
+    Serializes vault data and encrypts it with session key.
+
+    :returns: tuple (nonce, wrapped vault data)
+    """
+    nonce_length = nss.get_iv_length(mechanism)
+    nonce = nss.generate_random(nonce_length)
+
+    json_vault_data = json.dumps(vault_data)
+
+    iv_si = nss.SecItem(nonce)
+    iv_param = nss.param_from_iv(mechanism, iv_si)
+
+    encoding_ctx = nss.create_context_by_sym_key(mechanism,
+                                                 nss.CKA_ENCRYPT,
+                                                 session_key,
+                                                 iv_param)
+
+    wrapped_vault_data = encoding_ctx.cipher_op(json_vault_data)\
+        + encoding_ctx.digest_final()
+
+    return nonce, wrapped_vault_data
+
+
+def unwrap_vault_data(mechanism, session_key, nonce, wrapped_vault_data):
+    """
+    Decrypts vault data with session key and deserializes it.
+    """
+    iv_si = nss.SecItem(nonce)
+    iv_param = nss.param_from_iv(mechanism, iv_si)
+
+    decoding_ctx = nss.create_context_by_sym_key(mechanism,
+                                                 nss.CKA_DECRYPT,
+                                                 session_key,
+                                                 iv_param)
+
+    json_vault_data = decoding_ctx.cipher_op(wrapped_vault_data)\
+        + decoding_ctx.digest_final()
+
+    return json.loads(json_vault_data)
+
+
+def iter_vault_data(api, args, options, transport, vault_data,
+                    encryption_key=None):
+    """
+    Generates decrypted data of a vault.
+
+    Data archived in chunks is retrieved from the server chunk by chunk as
+    the generator is consumed.
+    """
+    if u'chunks' not in vault_data:
+        data = base64.b64decode(vault_data[u'data'].encode('utf-8'))
+        if encryption_key:
+            data = decrypt(data, symmetric_key=encryption_key)
+        yield data
+        return
+
+    mechanism, session_key, wrapped_session_key = transport
+    upload_id = base64.b64decode(vault_data[u'upload_id'].encode('utf-8'))
+    chunks = vault_data[u'chunks']
+
+    for index, chunk in enumerate(chunks):
+        result = api.Command.vault_retrieve_chunk_internal(
+            *args,
+            session_key=wrapped_session_key,
+            chunk_id=chunk[u'id'],
+            **options)['result']
+
+        chunk_data = unwrap_vault_data(mechanism, session_key,
+                                       result['nonce'], result['vault_data'])
+        data = base64.b64decode(chunk_data[u'data'].encode('utf-8'))
+
+        if hashlib.sha256(data).hexdigest() != chunk[u'digest']:
+            raise errors.AuthenticationError(message=_('Invalid vault data'))
+
+        yield decrypt_chunk(data, upload_id, index, index == len(chunks) - 1,
+                            symmetric_key=encryption_key)
+
+
+def get_upload_state_file(vault_dn, filename):
+    """
+    Returns path of the file recording progress of a chunked upload of
+    a file into a vault.
+    """
+    name = hashlib.sha256(u'{0}\n{1}'.format(
+        vault_dn, os.path.abspath(filename)).encode('utf-8')).hexdigest()
+    return os.path.join(paths.USER_CACHE_PATH, 'ipa', 'vault',
+                        name + '.json')
+
+
+def read_upload_state(state_file):
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_upload_state(state_file, state):
+    """
+    Replaces the upload state file. The file is readable by the owner only.
+    """
+    dirname = os.path.dirname(state_file)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o700)
+
+    tmp_file = state_file + '.tmp'
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_file, state_file)
+
+
+def remove_upload_state(state_file):
+    try:
+        os.unlink(state_file)
+    except OSError:
+        pass
+
+
 @register(no_fail=True)
 class _fake_vault(Object):
     name = 'vault'
@@ -567,6 +809,12 @@ class _fake_vault_archive_internal(Method):
     NO_CLI = True
 
 
+@register(no_fail=True)
+class _fake_vault_archive_chunk_internal(Method):
+    name = 'vault_archive_chunk_internal'
+    NO_CLI = True
+
+
 @register()
 class vault_archive(Local):
     __doc__ = _('Archive data into a vault.')
@@ -611,7 +859,8 @@ class vault_archive(Local):
 
     def get_options(self):
         for option in self.api.Command.vault_archive_internal.options():
-            if option.name not in ('nonce',
+            if option.name not in ('chunks',
+                                   'nonce',
                                    'session_key',
                                    'vault_data',
                                    'version'):
@@ -648,6 +897,8 @@ class vault_archive(Local):
             del options['password_file']
 
         # get data
+        chunked = False
+
         if data and input_file:
             raise errors.MutuallyExclusiveError(
                 reason=_('Input data specified multiple times'))
@@ -666,12 +917,17 @@ class vault_archive(Local):
                 raise errors.ValidationError(name="in", error=_(
                     "Cannot read file '%(filename)s': %(exc)s")
                     % {'filename': input_file, 'exc': exc.args[1]})
-            if stat.st_size > MAX_VAULT_DATA_SIZE:
+            if stat.st_size <= MAX_VAULT_DATA_SIZE:
+                data = validated_read('in', input_file, mode='rb')
+            elif (self.api.Command.get_plugin('vault_archive_chunk_internal')
+                    is not _fake_vault_archive_chunk_internal):
+                # archive large file in chunks without reading it at once
+                chunked = True
+            else:
                 raise errors.ValidationError(name="in", error=_(
                     "Size of data exceeds the limit. Current vault data size "
                     "limit is %(limit)d B")
                     % {'limit': MAX_VAULT_DATA_SIZE})
-            data = validated_read('in', input_file, mode='rb')
 
         else:
             data = ''
@@ -688,8 +944,11 @@ class vault_archive(Local):
 
         vault_type = vault['ipavaulttype'][0]
 
+        transport = create_transport_session(self.api)
+
         if vault_type == u'standard':
 
+            encryption_key = None
             encrypted_key = None
 
         elif vault_type == u'symmetric':
@@ -714,22 +973,15 @@ class vault_archive(Local):
                 else:
                     password = get_existing_password()
 
-            if not override_password:
-                # verify password by retrieving existing data
-                opts = options.copy()
-                opts['password'] = password
-                try:
-                    self.api.Command.vault_retrieve(*args, **opts)
-                except errors.NotFound:
-                    pass
-
             salt = vault['ipavaultsalt'][0]
 
             # generate encryption key from vault password
-            encryption_key = generate_symmetric_key(password, salt)
+            encryption_key = get_symmetric_key(self.api, password, salt)
 
-            # encrypt data with encryption key
-            data = encrypt(data, symmetric_key=encryption_key)
+            if not override_password:
+                # verify password by decrypting existing data
+                self._verify_encryption_key(args, options, transport,
+                                            encryption_key)
 
             encrypted_key = None
 
@@ -740,9 +992,6 @@ class vault_archive(Local):
             # generate encryption key
             encryption_key = base64.b64encode(os.urandom(32))
 
-            # encrypt data with encryption key
-            data = encrypt(data, symmetric_key=encryption_key)
-
             # encrypt encryption key with public key
             encrypted_key = encrypt(encryption_key, public_key=public_key)
 
@@ -751,34 +1000,14 @@ class vault_archive(Local):
                 name='vault_type',
                 error=_('Invalid vault type'))
 
-        # initialize NSS database
-        current_dbdir = paths.IPA_NSSDB_DIR
-        nss.nss_init(current_dbdir)
-
-        # retrieve transport certificate
-        config = self.api.Command.vaultconfig_show()['result']
-        transport_cert_der = config['transport_cert']
-        nss_transport_cert = nss.Certificate(transport_cert_der)
+        if chunked:
+            return self._archive_chunks(args, options, vault, input_file,
+                                        stat, transport, encryption_key,
+                                        encrypted_key)
 
-        # generate session key
-        mechanism = nss.CKM_DES3_CBC_PAD
-        slot = nss.get_best_slot(mechanism)
-        key_length = slot.get_best_key_length(mechanism)
-        session_key = slot.key_gen(mechanism, None, key_length)
-
-        # wrap session key with transport certificate
-        # pylint: disable=no-member
-        public_key = nss_transport_cert.subject_public_key_info.public_key
-        # pylint: enable=no-member
-        wrapped_session_key = nss.pub_wrap_sym_key(mechanism,
-                                                   public_key,
-                                                   session_key)
-
-        options['session_key'] = wrapped_session_key.data
-
-        nonce_length = nss.get_iv_length(mechanism)
-        nonce = nss.generate_random(nonce_length)
-        options['nonce'] = nonce
+        # encrypt data with encryption key
+        if encryption_key:
+            data = encrypt(data, symmetric_key=encryption_key)
 
         vault_data = {}
         vault_data[u'data'] = base64.b64encode(data).decode('utf-8')
@@ -787,23 +1016,160 @@ class vault_archive(Local):
             vault_data[u'encrypted_key'] = base64.b64encode(encrypted_key)\
                 .decode('utf-8')
 
-        json_vault_data = json.dumps(vault_data)
-
         # wrap vault_data with session key
-        iv_si = nss.SecItem(nonce)
-        iv_param = nss.param_from_iv(mechanism, iv_si)
+        mechanism, session_key, wrapped_session_key = transport
+        options['session_key'] = wrapped_session_key
+        options['nonce'], options['vault_data'] = wrap_vault_data(
+            mechanism, session_key, vault_data)
+
+        return self.api.Command.vault_archive_internal(*args, **options)
+
+    def _verify_encryption_key(self, args, options, transport,
+                               encryption_key):
+        """
+        Verifies encryption key by decrypting existing vault data. Only the
+        first chunk of data archived in chunks is retrieved.
+        """
+        mechanism, session_key, wrapped_session_key = transport
 
-        encoding_ctx = nss.create_context_by_sym_key(mechanism,
-                                                     nss.CKA_ENCRYPT,
-                                                     session_key,
-                                                     iv_param)
+        try:
+            result = self.api.Command.vault_retrieve_internal(
+                *args, session_key=wrapped_session_key, **options)['result']
+        except errors.NotFound:
+            return
+
+        vault_data = unwrap_vault_data(mechanism, session_key,
+                                       result['nonce'], result['vault_data'])
+        next(iter_vault_data(self.api, args, options, transport, vault_data,
+                             encryption_key))
+
+    def _archive_chunks(self, args, options, vault, input_file, stat,
+                        transport, encryption_key, encrypted_key):
+        """
+        Archives a large file into a vault in chunks.
+
+        Each chunk is read, encrypted and archived on its own, so memory use
+        does not depend on the file size. Archived chunks are recorded in
+        an upload state file and an interrupted upload of an unchanged file
+        is resumed by the next vault-archive call.
+
+        Uploads into asymmetric vaults are not resumed, resuming would
+        require the data encryption key to be stored in the state file.
+        """
+        mechanism, session_key, wrapped_session_key = transport
+        vault_type = vault['ipavaulttype'][0]
 
-        wrapped_vault_data = encoding_ctx.cipher_op(json_vault_data)\
-            + encoding_ctx.digest_final()
+        resumable = vault_type != u'asymmetric'
 
-        options['vault_data'] = wrapped_vault_data
+        state_file = get_upload_state_file(vault['dn'], input_file)
+        if resumable:
+            state = read_upload_state(state_file)
+        else:
+            remove_upload_state(state_file)
+            state = None
 
-        return self.api.Command.vault_archive_internal(*args, **options)
+        if state is not None and (state.get(u'type') != vault_type or
+                                  state.get(u'size') != stat.st_size or
+                                  state.get(u'mtime') != stat.st_mtime):
+            state = None
+
+        if state is not None and vault_type == u'symmetric':
+            # the password may have changed since the upload was interrupted
+            try:
+                decrypt(base64.b64decode(state[u'key_check'].encode('utf-8')),
+                        symmetric_key=encryption_key)
+            except errors.AuthenticationError:
+                state = None
+
+        if state is None:
+            upload_id = os.urandom(16)
+            state = {
+                u'type': vault_type,
+                u'size': stat.st_size,
+                u'mtime': stat.st_mtime,
+                u'upload_id': base64.b64encode(upload_id).decode('utf-8'),
+                u'chunks': [],
+            }
+            if vault_type == u'symmetric':
+                state[u'key_check'] = base64.b64encode(
+                    encrypt(upload_id, symmetric_key=encryption_key))\
+                    .decode('utf-8')
+
+        upload_id = base64.b64decode(state[u'upload_id'].encode('utf-8'))
+        chunks = state[u'chunks']
+        count = max(1, -(-stat.st_size // VAULT_CHUNK_SIZE))
+
+        try:
+            with open(input_file, 'rb') as f:
+                f.seek(len(chunks) * VAULT_CHUNK_SIZE)
+                for index in range(len(chunks), count):
+                    data = f.read(VAULT_CHUNK_SIZE)
+                    if len(data) != min(VAULT_CHUNK_SIZE,
+                                        stat.st_size -
+                                        index * VAULT_CHUNK_SIZE):
+                        break
+
+                    data = encrypt_chunk(data, upload_id, index,
+                                         index == count - 1,
+                                         symmetric_key=encryption_key)
+                    nonce, wrapped_vault_data = wrap_vault_data(
+                        mechanism, session_key,
+                        {u'data': base64.b64encode(data).decode('utf-8')})
+
+                    result = self.api.Command.vault_archive_chunk_internal(
+                        *args,
+                        session_key=wrapped_session_key,
+                        vault_data=wrapped_vault_data,
+                        nonce=nonce,
+                        **options)['result']
+
+                    chunks.append({
+                        u'id': result['chunk_id'],
+                        u'digest': hashlib.sha256(data).hexdigest(),
+                    })
+                    if resumable:
+                        write_upload_state(state_file, state)
+
+                # the file must not grow while it is archived
+                f.seek(stat.st_size)
+                changed = bool(f.read(1))
+        except IOError as exc:
+            raise errors.ValidationError(name="in", error=_(
+                "Cannot read file '%(filename)s': %(exc)s")
+                % {'filename': input_file, 'exc': exc.args[1]})
+
+        if changed or len(chunks) != count:
+            remove_upload_state(state_file)
+            raise errors.ValidationError(name="in", error=_(
+                "File '%(filename)s' changed while it was archived")
+                % {'filename': input_file})
+
+        # archive list of the chunks as the vault data
+        vault_data = {
+            u'upload_id': state[u'upload_id'],
+            u'chunks': chunks,
+        }
+
+        if encrypted_key:
+            vault_data[u'encrypted_key'] = base64.b64encode(encrypted_key)\
+                .decode('utf-8')
+
+        options['session_key'] = wrapped_session_key
+        options['nonce'], options['vault_data'] = wrap_vault_data(
+            mechanism, session_key, vault_data)
+        options['chunks'] = [chunk[u'id'] for chunk in chunks]
+
+        try:
+            response = self.api.Command.vault_archive_internal(
+                *args, **options)
+        except errors.NotFound:
+            # chunks of the interrupted upload are gone, start over next time
+            remove_upload_state(state_file)
+            raise
+
+        remove_upload_state(state_file)
+
+        return response
 
 
 @register(no_fail=True)
@@ -812,6 +1178,12 @@ class _fake_vault_retrieve_internal(Method):
     NO_CLI = True
 
 
+@register(no_fail=True)
+class _fake_vault_retrieve_chunk_internal(Method):
+    name = 'vault_retrieve_chunk_internal'
+    NO_CLI = True
+
+
 @register()
 class vault_retrieve(Local):
     __doc__ = _('Retrieve a data from a vault.')
@@ -911,53 +1283,18 @@ class vault_retrieve(Local):
 
         vault_type = vault['ipavaulttype'][0]
 
-        # initialize NSS database
-        current_dbdir = paths.IPA_NSSDB_DIR
-        nss.nss_init(current_dbdir)
-
-        # retrieve transport certificate
-        config = self.api.Command.vaultconfig_show()['result']
-        transport_cert_der = config['transport_cert']
-        nss_transport_cert = nss.Certificate(transport_cert_der)
-
-        # generate session key
-        mechanism = nss.CKM_DES3_CBC_PAD
-        slot = nss.get_best_slot(mechanism)
-        key_length = slot.get_best_key_length(mechanism)
-        session_key = slot.key_gen(mechanism, None, key_length)
-
-        # wrap session key with transport certificate
-        # pylint: disable=no-member
-        public_key = nss_transport_cert.subject_public_key_info.public_key
-        # pylint: enable=no-member
-        wrapped_session_key = nss.pub_wrap_sym_key(mechanism,
-                                                   public_key,
-                                                   session_key)
+        transport = create_transport_session(self.api)
+        mechanism, session_key, wrapped_session_key = transport
 
         # send retrieval request to server
-        options['session_key'] = wrapped_session_key.data
-
-        response = self.api.Command.vault_retrieve_internal(*args, **options)
+        response = self.api.Command.vault_retrieve_internal(
+            *args, session_key=wrapped_session_key, **options)
 
         result = response['result']
-        nonce = result['nonce']
 
         # unwrap data with session key
-        wrapped_vault_data = result['vault_data']
-
-        iv_si = nss.SecItem(nonce)
-        iv_param = nss.param_from_iv(mechanism, iv_si)
-
-        decoding_ctx = nss.create_context_by_sym_key(mechanism,
-                                                     nss.CKA_DECRYPT,
-                                                     session_key,
-                                                     iv_param)
-
-        json_vault_data = decoding_ctx.cipher_op(wrapped_vault_data)\
-            + decoding_ctx.digest_final()
-
-        vault_data = json.loads(json_vault_data)
-        data = base64.b64decode(vault_data[u'data'].encode('utf-8'))
+        vault_data = unwrap_vault_data(mechanism, session_key,
+                                       result['nonce'], result['vault_data'])
 
         encrypted_key = None
 
@@ -967,7 +1304,7 @@ class vault_retrieve(Local):
 
         if vault_type == u'standard':
 
-            pass
+            encryption_key = None
 
         elif vault_type == u'symmetric':
 
@@ -991,10 +1328,7 @@ class vault_retrieve(Local):
                 password = get_existing_password()
 
             # generate encryption key from password
-            encryption_key = generate_symmetric_key(password, salt)
-
-            # decrypt data with encryption key
-            data = decrypt(data, symmetric_key=encryption_key)
+            encryption_key = get_symmetric_key(self.api, password, salt)
 
         elif vault_type == u'asymmetric':
 
@@ -1019,19 +1353,223 @@ class vault_retrieve(Local):
             # decrypt encryption key with private key
             encryption_key = decrypt(encrypted_key, private_key=private_key)
 
-            # decrypt data with encryption key
-            data = decrypt(data, symmetric_key=encryption_key)
-
         else:
             raise errors.ValidationError(
                 name='vault_type',
                 error=_('Invalid vault type'))
 
+        # decrypt data with encryption key
+        data = iter_vault_data(self.api, args, options, transport,
+                               vault_data, encryption_key)
+
         if output_file:
+            # decrypt the first chunk before the file is overwritten, so
+            # it is not destroyed by retrieval with invalid credentials
+            data = itertools.chain([next(data)], data)
             with open(output_file, 'w') as f:
-                f.write(data)
+                for chunk in data:
+                    f.write(chunk)
+
+        else:
+            response['result'] = {'data': b''.join(data)}
+
+        return response
+
+
+@register(no_fail=True)
+class _fake_vault_retrieve_multiple_internal(Method):
+    name = 'vault_retrieve_multiple_internal'
+    NO_CLI = True
+
+
+@register()
+class vault_retrieve_multiple(Local):
+    __doc__ = _('Retrieve data from multiple vaults.')
+
+    takes_options = (
+        Str(
+            'out_dir?',
+            doc=_('Directory to store retrieved data, one file named after '
+                  'each vault'),
+        ),
+        Str(
+            'password?',
+            cli_name='password',
+            doc=_('Password of symmetric vaults'),
+        ),
+        Str(  # TODO: use File parameter
+            'password_file?',
+            cli_name='password_file',
+            doc=_('File containing the password of symmetric vaults'),
+        ),
+        Bytes(
+            'private_key?',
+            cli_name='private_key',
+            doc=_('Private key of asymmetric vaults'),
+        ),
+        Str(  # TODO: use File parameter
+            'private_key_file?',
+            cli_name='private_key_file',
+            doc=_('File containing the private key of asymmetric vaults'),
+        ),
+    )
+
+    has_output_params = (
+        Bytes(
+            'data',
+            label=_('Data'),
+        ),
+    )
+
+    @classmethod
+    def __NO_CLI_getter(cls):
+        return (api.Command.get_plugin('vault_retrieve_multiple_internal') is
+                _fake_vault_retrieve_multiple_internal)
+
+    NO_CLI = classproperty(__NO_CLI_getter)
+
+    def get_args(self):
+        for arg in self.api.Command.vault_retrieve_multiple_internal.args():
+            yield arg
+        for arg in super(vault_retrieve_multiple, self).get_args():
+            yield arg
+
+    def get_options(self):
+        for option in (
+                self.api.Command.vault_retrieve_multiple_internal.options()):
+            if option.name not in ('session_key', 'version'):
+                yield option
+        for option in super(vault_retrieve_multiple, self).get_options():
+            yield option
+
+    def get_output_params(self):
+        for param in (
+                self.api.Command.vault_retrieve_multiple_internal
+                .output_params()):
+            yield param
+        for param in super(vault_retrieve_multiple, self).get_output_params():
+            yield param
 
+    def _iter_output(self):
+        return self.api.Command.vault_retrieve_multiple_internal.output()
+
+    def forward(self, *args, **options):
+        output_dir = options.pop('out_dir', None)
+
+        password = options.pop('password', None)
+        password_file = options.pop('password_file', None)
+        private_key = options.pop('private_key', None)
+        private_key_file = options.pop('private_key_file', None)
+
+        if password and password_file:
+            raise errors.MutuallyExclusiveError(
+                reason=_('Password specified multiple times'))
+
+        if private_key and private_key_file:
+            raise errors.MutuallyExclusiveError(
+                reason=_('Private key specified multiple times'))
+
+        for name in args[-1]:
+            if name in (os.curdir, os.pardir) and output_dir:
+                raise errors.ValidationError(
+                    name='out_dir',
+                    error=_("Cannot store data of vault '%(name)s' in a "
+                            "file") % {'name': name})
+
+        if self.api.env.in_server:
+            backend = self.api.Backend.ldap2
         else:
-            response['result'] = {'data': data}
+            backend = self.api.Backend.rpcclient
+        if not backend.isconnected():
+            backend.connect()
+
+        transport = create_transport_session(self.api)
+        mechanism, session_key, wrapped_session_key = transport
+
+        # retrieve data of all vaults in a single request
+        response = self.api.Command.vault_retrieve_multiple_internal(
+            *args, session_key=wrapped_session_key, **options)
+
+        # options identifying the vaults, used to retrieve data chunks
+        vault_options = dict((k, v) for k, v in options.items()
+                             if k in ('service', 'shared', 'username'))
+
+        results = []
+
+        for vault in response['result']:
+            name = vault['cn'][0]
+            vault_type = vault['ipavaulttype'][0]
+
+            vault_data = unwrap_vault_data(mechanism, session_key,
+                                           vault['nonce'],
+                                           vault['vault_data'])
+
+            if vault_type == u'standard':
+
+                encryption_key = None
+
+            elif vault_type == u'symmetric':
+
+                # the same password is used for all symmetric vaults
+                if password:
+                    pass
+
+                elif password_file:
+                    password = validated_read('password-file',
+                                              password_file,
+                                              encoding='utf-8')
+                    password = password.rstrip('\n')
+
+                else:
+                    password = get_existing_password()
+
+                salt = vault['ipavaultsalt'][0]
+
+                # generate encryption key from password
+                encryption_key = get_symmetric_key(self.api, password, salt)
+
+            elif vault_type == u'asymmetric':
+
+                if private_key:
+                    pass
+
+                elif private_key_file:
+                    private_key = validated_read('private-key-file',
+                                                 private_key_file,
+                                                 mode='rb')
+
+                else:
+                    raise errors.ValidationError(
+                        name='private_key',
+                        error=_('Missing vault private key'))
+
+                encrypted_key = base64.b64decode(
+                    vault_data[u'encrypted_key'].encode('utf-8'))
+
+                # decrypt encryption key with private key
+                encryption_key = decrypt(encrypted_key,
+                                         private_key=private_key)
+
+            else:
+                raise errors.ValidationError(
+                    name='vault_type',
+                    error=_('Invalid vault type'))
+
+            # decrypt data with encryption key
+            data = iter_vault_data(self.api, (name,), vault_options,
+                                   transport, vault_data, encryption_key)
+
+            if output_dir:
+                # decrypt the first chunk before the file is overwritten
+                data = itertools.chain([next(data)], data)
+                with open(os.path.join(output_dir, name), 'w') as f:
+                    for chunk in data:
+                        f.write(chunk)
+                results.append({'cn': vault['cn']})
+
+            else:
+                results.append({'cn': vault['cn'], 'data': b''.join(data)})
+
+        response['result'] = results
 
         return response
@@ -125,6 +125,7 @@ DEFAULT_CONFIG = (
     ('container_ca', DN(('cn', 'cas'), ('cn', 'ca'))),
     ('container_dnsservers', DN(('cn', 'servers'), ('cn', 'dns'))),
     ('container_custodia', DN(('cn', 'custodia'), ('cn', 'ipa'), ('cn', 'etc'))),
+    ('container_migration', DN(('cn', 'migration'), ('cn', 'etc'))),
 
     # Ports, hosts, and URIs:
     ('xmlrpc_uri', 'http://localhost:8888/ipa/xml'),
@@ -198,6 +199,10 @@ DEFAULT_CONFIG = (
     # Ignore TTL. Perform schema call and download schema if not in cache.
     ('force_schema_check', False),
 
+    # Number of seconds vault encryption keys derived from vault passwords
+    # are cached in the kernel keyring. Zero disables the cache.
+    ('vault_key_cache_ttl', 0),
+
     # ********************************************************
     #  The remaining keys are never set from the values here!
     # ********************************************************
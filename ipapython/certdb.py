@@ -22,6 +22,7 @@ import re
 import tempfile
 import shutil
 import base64
+import contextlib
 from nss import nss
 from nss.error import NSPRError
 
@@ -32,6 +33,8 @@ from ipalib import x509
 
 CA_NICKNAME_FMT = "%s IPA CA"
 
+CERT_DB_FILES = ('cert8.db', 'cert9.db')
+
 
 def get_ca_nickname(realm, format=CA_NICKNAME_FMT):
     return format % realm
@@ -63,26 +66,30 @@ def update_ipa_nssdb():
     if not os.path.exists(os.path.join(ipa_db.secdir, 'cert8.db')):
         create_ipa_nssdb()
 
-    for nickname, trust_flags in (('IPA CA', 'CT,C,C'),
-                                  ('External CA cert', 'C,,')):
-        try:
-            cert = sys_db.get_cert(nickname)
-        except RuntimeError:
-            continue
-        try:
-            ipa_db.add_cert(cert, nickname, trust_flags)
-        except ipautil.CalledProcessError as e:
-            raise RuntimeError("Failed to add %s to %s: %s" %
-                               (nickname, ipa_db.secdir, e))
+    try:
+        with ipa_db.batch():
+            for nickname, trust_flags in (('IPA CA', 'CT,C,C'),
+                                          ('External CA cert', 'C,,')):
+                try:
+                    cert = sys_db.get_cert(nickname)
+                except RuntimeError:
+                    continue
+                ipa_db.add_cert(cert, nickname, trust_flags)
+    except ipautil.CalledProcessError as e:
+        raise RuntimeError("Failed to add IPA certs to %s: %s" %
+                           (ipa_db.secdir, e))
 
     # Remove IPA certs from /etc/pki/nssdb
-    for nickname, trust_flags in ipa_db.list_certs():
-        while sys_db.has_nickname(nickname):
-            try:
-                sys_db.delete_cert(nickname)
-            except ipautil.CalledProcessError as e:
-                raise RuntimeError("Failed to remove %s from %s: %s" %
-                                   (nickname, sys_db.secdir, e))
+    ipa_nicknames = set(nickname for nickname, _flags in ipa_db.list_certs())
+    try:
+        with sys_db.batch():
+            # there is one line for every cert with the nickname
+            for nickname, _flags in sys_db.list_certs():
+                if nickname in ipa_nicknames:
+                    sys_db.delete_cert(nickname)
+    except ipautil.CalledProcessError as e:
+        raise RuntimeError("Failed to remove IPA certs from %s: %s" %
+                           (sys_db.secdir, e))
 
 
 def find_cert_from_txt(cert, start=0):
@@ -105,6 +112,19 @@ def find_cert_from_txt(cert, start=0):
     return (cert, e)
 
 
+def _merge_trust_flags(old_flags, new_flags):
+    """Return trust flags listed by certutil after new_flags are set
+
+    The "u" flag of certs with a private key is kept.
+    """
+    merged = []
+    for old, new in zip(old_flags.split(','), new_flags.split(',')):
+        if 'u' in old and 'u' not in new:
+            new += 'u'
+        merged.append(new)
+    return ','.join(merged)
+
+
 class NSSDatabase(object):
     """A general-purpose wrapper around a NSS cert database
 
@@ -113,6 +133,12 @@ class NSSDatabase(object):
     For temporary databases, do not pass nssdir, and call close() when done
     to remove the DB. Alternatively, a NSSDatabase can be used as a
     context manager that calls close() automatically.
+
+    Certificates and trust flags read from the database are cached until
+    the database files change, so repeated list_certs(), get_cert() and
+    has_nickname() calls don't spawn certutil again. Changes made through
+    this class are applied to the cache without reading the database again.
+    Changes made in a batch() context are applied in a single certutil run.
     """
     # Traditionally, we used CertDB for our NSS DB operations, but that class
     # got too tied to IPA server details, killing reusability.
@@ -125,6 +151,9 @@ class NSSDatabase(object):
         else:
             self.secdir = nssdir
             self._is_temporary = False
+        self._snapshot = None
+        self._snapshot_stamp = None
+        self._batch = None
 
     def close(self):
         if self._is_temporary:
@@ -141,29 +170,119 @@ class NSSDatabase(object):
         new_args = new_args + args
         return ipautil.run(new_args, stdin, **kwargs)
 
+    def _get_db_stamp(self):
+        stamp = []
+        for filename in CERT_DB_FILES:
+            try:
+                st = os.stat(os.path.join(self.secdir, filename))
+            except OSError:
+                continue
+            stamp.append((filename, st.st_ino, st.st_size, st.st_mtime))
+        return tuple(stamp)
+
+    def _read_cert_list(self):
+        result = self.run_certutil(["-L"], capture_output=True)
+        certs = result.output.splitlines()
+
+        # FIXME, this relies on NSS never changing the formatting of certutil
+        certlist = []
+        for cert in certs:
+            match = re.match(r'^(.+?)\s+(\w*,\w*,\w*)\s*$', cert)
+            if match:
+                certlist.append(match.groups())
+        return tuple(certlist)
+
+    def _get_snapshot(self):
+        """Return cached content of the database, reading it if it changed
+
+        The snapshot is a dict with the output of list_certs() under the
+        'list' key, DER data of certs by nickname under 'der' and certutil
+        PEM output by nickname under 'pem'. The DER and PEM data are filled
+        in lazily by get_cert(), the list is read again if it is None.
+        """
+        stamp = self._get_db_stamp()
+        if self._snapshot is None or self._snapshot_stamp != stamp:
+            self._snapshot = {
+                'list': self._read_cert_list(),
+                'der': {},
+                'pem': {},
+            }
+            self._snapshot_stamp = stamp
+        elif self._snapshot['list'] is None:
+            self._snapshot['list'] = self._read_cert_list()
+        return self._snapshot
+
+    def _update_snapshot(self, stamp, changes):
+        """Apply changes written to the database to the snapshot
+
+        :param stamp: database stamp from before the changes were written,
+            the snapshot is dropped if it does not match, i.e. the database
+            was modified by someone else
+        :param changes: list of (certutil arguments, cert) of the changes
+        """
+        snapshot = self._snapshot
+        if snapshot is None or self._snapshot_stamp != stamp:
+            self.invalidate_cache()
+            return
+
+        certlist = snapshot['list']
+        for args, _cert in changes:
+            op, nickname = args[0], args[2]
+            snapshot['der'].pop(nickname, None)
+            snapshot['pem'].pop(nickname, None)
+            if certlist is None:
+                continue
+            if op == '-A' or \
+                    [name for name, _flags in certlist].count(nickname) > 1:
+                # trust flags of a cert with a private key get the "u" flag
+                # and it is not known which one of several certs with the
+                # same nickname is changed, the list is read again
+                certlist = None
+            elif op == '-M':
+                certlist = tuple(
+                    (name, _merge_trust_flags(flags, args[4]))
+                    if name == nickname else (name, flags)
+                    for name, flags in certlist)
+            elif op == '-D':
+                certlist = tuple(
+                    (name, flags) for name, flags in certlist
+                    if name != nickname)
+        snapshot['list'] = certlist
+        self._snapshot_stamp = self._get_db_stamp()
+
+    def _run_change(self, args, cert=None):
+        stamp = self._get_db_stamp()
+        try:
+            self.run_certutil(args, stdin=cert)
+        except ipautil.CalledProcessError:
+            self.invalidate_cache()
+            raise
+        self._update_snapshot(stamp, [(args, cert)])
+
+    def invalidate_cache(self):
+        """Drop certs cached from the database
+
+        The cache is dropped automatically when the database files change,
+        this is needed only when the database is modified more than once
+        within the timestamp granularity of the file system.
+        """
+        self._snapshot = None
+        self._snapshot_stamp = None
+
     def create_db(self, password_filename):
         """Create cert DB
 
         :param password_filename: Name of file containing the database password
         """
         self.run_certutil(["-N", "-f", password_filename])
+        self.invalidate_cache()
 
     def list_certs(self):
         """Return nicknames and cert flags for all certs in the database
 
         :return: List of (name, trust_flags) tuples
         """
-        result = self.run_certutil(["-L"], capture_output=True)
-        certs = result.output.splitlines()
-
-        # FIXME, this relies on NSS never changing the formatting of certutil
-        certlist = []
-        for cert in certs:
-            match = re.match(r'^(.+?)\s+(\w*,\w*,\w*)\s*$', cert)
-            if match:
-                certlist.append(match.groups())
-
-        return tuple(certlist)
+        return self._get_snapshot()['list']
 
     def find_server_certs(self):
         """Return nicknames and cert flags for server certs in the database
@@ -206,6 +325,7 @@ class NSSDatabase(object):
             args = args + ["-w", paths.DEV_STDIN]
         try:
             ipautil.run(args, stdin=pkcs12_passwd)
+            self.invalidate_cache()
         except ipautil.CalledProcessError as e:
             if e.returncode == 17:
                 raise RuntimeError("incorrect password for pkcs#12 file %s" %
@@ -417,31 +537,42 @@ class NSSDatabase(object):
         else:
             if trust_flags is None:
                 trust_flags = 'C,,'
+            args = ["-M", "-n", root_nickname, "-t", trust_flags]
+            if self._batch is not None:
+                self._batch.append((args, None))
+                return
             try:
-                self.run_certutil(["-M", "-n", root_nickname,
-                                   "-t", trust_flags])
+                self._run_change(args)
             except ipautil.CalledProcessError:
                 raise RuntimeError(
                     "Setting trust on %s failed" % root_nickname)
 
     def get_cert(self, nickname, pem=False):
-        args = ['-L', '-n', nickname, '-a']
-        try:
-            result = self.run_certutil(args, capture_output=True)
-        except ipautil.CalledProcessError:
-            raise RuntimeError("Failed to get %s" % nickname)
-        cert = result.output
+        snapshot = self._get_snapshot()
+        if not pem and nickname in snapshot['der']:
+            return snapshot['der'][nickname]
+
+        cert = snapshot['pem'].get(nickname)
+        if cert is None:
+            args = ['-L', '-n', nickname, '-a']
+            try:
+                result = self.run_certutil(args, capture_output=True)
+            except ipautil.CalledProcessError:
+                raise RuntimeError("Failed to get %s" % nickname)
+            cert = snapshot['pem'][nickname] = result.output
         if not pem:
             cert, _start = find_cert_from_txt(cert, start=0)
             cert = x509.strip_header(cert)
-            cert = base64.b64decode(cert)
+            cert = snapshot['der'][nickname] = base64.b64decode(cert)
         return cert
 
     def has_nickname(self, nickname):
+        if any(name == nickname for name, _flags in self.list_certs()):
+            return True
+        # certs on other tokens than the internal one are not listed
         try:
-            self.get_cert(nickname)
+            self.get_cert(nickname, pem=True)
         except RuntimeError:
-            # This might be error other than "nickname not found". Beware.
             return False
         else:
             return True
@@ -481,10 +612,76 @@ class NSSDatabase(object):
         args = ["-A", "-n", nick, "-t", flags]
         if pem:
             args.append("-a")
-        self.run_certutil(args, stdin=cert)
+        if self._batch is not None:
+            self._batch.append((args, cert))
+            return
+        self._run_change(args, cert)
 
     def delete_cert(self, nick):
-        self.run_certutil(["-D", "-n", nick])
+        args = ["-D", "-n", nick]
+        if self._batch is not None:
+            self._batch.append((args, None))
+            return
+        self._run_change(args)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Apply certificate changes made in the context in one certutil run
+
+        add_cert(), trust_root_cert() and delete_cert() calls made in the
+        context are recorded and executed, in order, by a single certutil
+        batch run when the context exits. Reads in the context don't see
+        the recorded changes. Nothing is applied if the context is left
+        with an exception.
+
+        Raises ipautil.CalledProcessError if the batch fails. Changes which
+        precede the failing one are applied.
+        """
+        if self._batch is not None:
+            # nested batch, the outermost one applies the changes
+            yield self
+            return
+
+        self._batch = []
+        try:
+            yield self
+            changes = self._batch
+        finally:
+            self._batch = None
+
+        if changes:
+            self._run_batch(changes)
+
+    def _run_batch(self, changes):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            lines = []
+            for i, (args, cert) in enumerate(changes):
+                if cert is not None:
+                    # stdin of certutil is not available in batch mode
+                    cert_filename = os.path.join(tmpdir, 'cert%d' % i)
+                    with open(cert_filename, 'wb') as f:
+                        f.write(cert)
+                    args = args + ["-i", cert_filename]
+                lines.append(' '.join(
+                    '"%s"' % arg if re.search(r'\s', arg) else arg
+                    for arg in args))
+
+            batch_filename = os.path.join(tmpdir, 'batch')
+            with open(batch_filename, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+
+            root_logger.debug("Applying %d changes to %s",
+                              len(changes), self.secdir)
+            stamp = self._get_db_stamp()
+            try:
+                self.run_certutil(["-B", "-i", batch_filename])
+            except ipautil.CalledProcessError:
+                self.invalidate_cache()
+                raise
+            self._update_snapshot(stamp, changes)
+        finally:
+            shutil.rmtree(tmpdir)
 
     def verify_server_cert_validity(self, nickname, hostname):
         """Verify a certificate is valid for a SSL server with given hostname
@@ -5,8 +5,10 @@
 from datetime import datetime
 import dns.name
 import errno
+import glob
+import hashlib
+from multiprocessing.pool import ThreadPool
 import os
-import shutil
 import stat
 
 import ipalib.constants
@@ -23,6 +25,38 @@ time_bindfmt = '%Y%m%d%H%M%S'
 FILE_PERM = (stat.S_IRUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IWUSR)
 DIR_PERM = (stat.S_IRWXU | stat.S_IRWXG)
 
+# attributes which affect files generated by dnssec-keyfromlabel
+KEY_ATTRS = ('idnsSecKeyRef', 'idnsSecAlgorithm', 'idnsSecKeyZone',
+             'idnsSecKeyPublish', 'idnsSecKeyActivate', 'idnsSecKeyInactive',
+             'idnsSecKeyDelete', 'idnsSecKeySep', 'idnsSecKeyRevoke')
+
+# maximal number of zones synchronized in parallel
+SYNC_WORKERS = 4
+
+# allowance for file system timestamps lagging behind time.time()
+MTIME_SLACK = 1
+
+
+def fix_token_permissions(since=None):
+    """Make HSM token files created by HSM synchronization readable by named.
+
+    Only files and directories with wrong permissions are changed. If since
+    is given, only files in directories modified since that time, i.e. files
+    created since then, are checked."""
+    for prefix, dirs, files in os.walk(paths.DNSSEC_TOKENS_DIR, topdown=True):
+        for name in dirs:
+            fpath = os.path.join(prefix, name)
+            if stat.S_IMODE(os.stat(fpath).st_mode) != DIR_PERM | stat.S_ISGID:
+                os.chmod(fpath, DIR_PERM | stat.S_ISGID)
+        if (since is not None and
+                os.stat(prefix).st_mtime < since - MTIME_SLACK):
+            continue
+        for name in files:
+            fpath = os.path.join(prefix, name)
+            if stat.S_IMODE(os.stat(fpath).st_mode) & FILE_PERM != FILE_PERM:
+                os.chmod(fpath, FILE_PERM)
+
+
 class BINDMgr(object):
     """BIND key manager. It does LDAP->BIND key files synchronization.
 
@@ -94,6 +128,14 @@ class BINDMgr(object):
             self.log.info('Key metadata %s updated in zone %s' % (attrs['dn'], zone))
             zone_keys[uuid] = attrs
 
+    def get_key_digest(self, attrs):
+        """Get digest of key metadata used for BIND key files generation."""
+        data = []
+        for attr in KEY_ATTRS:
+            values = sorted(attrs.get(attr, []))
+            data.append('%s: %s' % (attr.lower(), ', '.join(values)))
+        return hashlib.sha1('\n'.join(data)).hexdigest()
+
     def install_key(self, zone, uuid, attrs, workdir):
         """Run dnssec-keyfromlabel on given LDAP object.
         :returns: base file name of output files, e.g. Kaaa.test.+008+19719"""
@@ -120,6 +162,36 @@ class BINDMgr(object):
             uuid_file.write(uuid)
         with open("%s/%s.dn" % (workdir, basename), 'w') as dn_file:
             dn_file.write(attrs['dn'])
+        # metadata digest is used to detect changed keys
+        with open("%s/%s.digest" % (workdir, basename), 'w') as digest_file:
+            digest_file.write(self.get_key_digest(attrs))
+        return basename
+
+    def get_installed_keys(self, keys_dir):
+        """Read keys installed in BIND key directory.
+
+        :returns: dict {uuid: (base file name, metadata digest)}, digest is
+            None for keys installed by older versions
+        """
+        installed = {}
+        for uuid_fn in glob.glob(os.path.join(keys_dir, '*.uuid')):
+            basename = os.path.basename(uuid_fn)[:-len('.uuid')]
+            with open(uuid_fn) as uuid_file:
+                uuid = uuid_file.read().strip()
+            try:
+                with open(os.path.join(keys_dir, '%s.digest' % basename)) \
+                        as digest_file:
+                    digest = digest_file.read().strip()
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                digest = None
+            installed[uuid] = (basename, digest)
+        return installed
+
+    def remove_key_files(self, keys_dir, basename):
+        for fn in glob.glob(os.path.join(keys_dir, '%s.*' % basename)):
+            os.unlink(fn)
 
     def get_zone_dir_name(self, zone):
         """Escape zone name to form suitable for file-system.
@@ -152,42 +224,77 @@ class BINDMgr(object):
         return escaped[:-1]
 
     def sync_zone(self, zone):
+        """Synchronize BIND key files of zone with LDAP.
+
+        Only keys with changed metadata are regenerated.
+        :returns: True if key files were changed
+        """
         self.log.info('Synchronizing zone %s' % zone)
         zone_path = os.path.join(paths.BIND_LDAP_DNS_ZONE_WORKDIR,
                 self.get_zone_dir_name(zone))
+        target_dir = "%s/keys" % zone_path
         try:
-            os.makedirs(zone_path)
+            os.makedirs(target_dir)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise e
+        os.chmod(target_dir, DIR_PERM)
 
-        # fix HSM permissions
-        # TODO: move out
-        for prefix, dirs, files in os.walk(paths.DNSSEC_TOKENS_DIR, topdown=True):
-            for name in dirs:
-                fpath = os.path.join(prefix, name)
-                self.log.debug('Fixing directory permissions: %s', fpath)
-                os.chmod(fpath, DIR_PERM | stat.S_ISGID)
-            for name in files:
-                fpath = os.path.join(prefix, name)
-                self.log.debug('Fixing file permissions: %s', fpath)
-                os.chmod(fpath, FILE_PERM)
-        # TODO: move out
+        installed = self.get_installed_keys(target_dir)
+        ldap_keys = self.ldap_keys.get(zone, {})
+        changed = False
 
+        # keys are generated in a temporary directory and moved to the key
+        # directory file by file, rename() replaces files atomically
         with TemporaryDirectory(zone_path) as tempdir:
-            for uuid, attrs in self.ldap_keys[zone].items():
-                self.install_key(zone, uuid, attrs, tempdir)
-            # keys were generated in a temporary directory, swap directories
-            target_dir = "%s/keys" % zone_path
-            try:
-                shutil.rmtree(target_dir)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise e
-            shutil.move(tempdir, target_dir)
-            os.chmod(target_dir, DIR_PERM)
-
-        self.notify_zone(zone)
+            for uuid, attrs in ldap_keys.items():
+                digest = self.get_key_digest(attrs)
+                old_basename, old_digest = installed.get(uuid, (None, None))
+                if old_digest == digest:
+                    self.log.debug('Key %s of zone %s is up to date',
+                                   attrs['dn'], zone)
+                    continue
+                basename = self.install_key(zone, uuid, attrs, tempdir)
+                for fn in glob.glob(os.path.join(tempdir, '%s.*' % basename)):
+                    os.rename(fn, os.path.join(target_dir,
+                                               os.path.basename(fn)))
+                if old_basename is not None and old_basename != basename:
+                    self.remove_key_files(target_dir, old_basename)
+                changed = True
+
+        for uuid, (basename, _digest) in installed.items():
+            if uuid not in ldap_keys:
+                self.log.info('Removing key %s from zone %s', basename, zone)
+                self.remove_key_files(target_dir, basename)
+                changed = True
+
+        if changed:
+            self.notify_zone(zone)
+        return changed
+
+    def remove_deleted_keys(self, dnssec_zones):
+        """Remove BIND key files of keys deleted from LDAP.
+
+        No key files are generated, so this can be done before keys added
+        to LDAP are available in the local HSM. Zones stay marked as modified
+        and they are fully synchronized by self.sync().
+        """
+        for zone in self.modified_zones.intersection(dnssec_zones):
+            target_dir = os.path.join(paths.BIND_LDAP_DNS_ZONE_WORKDIR,
+                                      self.get_zone_dir_name(zone), 'keys')
+            if not os.path.isdir(target_dir):
+                continue
+            ldap_keys = self.ldap_keys.get(zone, {})
+            changed = False
+            for uuid, (basename, _digest) in \
+                    self.get_installed_keys(target_dir).items():
+                if uuid not in ldap_keys:
+                    self.log.info('Removing key %s from zone %s',
+                                  basename, zone)
+                    self.remove_key_files(target_dir, basename)
+                    changed = True
+            if changed:
+                self.notify_zone(zone)
 
     def sync(self, dnssec_zones):
         """Synchronize list of zones in LDAP with BIND.
@@ -198,12 +305,24 @@ class BINDMgr(object):
         This filter is useful in cases where LDAP contains DNS zones which
         have old metadata objects and DNSSEC disabled. Such zones must be
         ignored to prevent errors while calling dnssec-keyfromlabel or rndc.
+
+        Zones are independent on each other and they are synchronized in
+        parallel.
         """
         self.log.debug('Key metadata in LDAP: %s' % self.ldap_keys)
         self.log.debug('Zones modified but skipped during bindmgr.sync: %s',
                        self.modified_zones - dnssec_zones)
-        for zone in self.modified_zones.intersection(dnssec_zones):
-            self.sync_zone(zone)
+        zones = list(self.modified_zones.intersection(dnssec_zones))
+        if len(zones) > 1:
+            pool = ThreadPool(min(len(zones), SYNC_WORKERS))
+            try:
+                pool.map(self.sync_zone, zones)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for zone in zones:
+                self.sync_zone(zone)
 
         self.modified_zones = set()
 
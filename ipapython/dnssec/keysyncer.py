@@ -4,6 +4,7 @@
 
 import ldap.dn
 import os
+import time
 
 import dns.name
 
@@ -12,11 +13,23 @@ from ipapython import ipautil
 
 from ipapython.dnssec.syncrepl import SyncReplConsumer
 from ipapython.dnssec.odsmgr import ODSMgr
-from ipapython.dnssec.bindmgr import BINDMgr
+from ipapython.dnssec.bindmgr import BINDMgr, fix_token_permissions
 
 SIGNING_ATTR = 'idnsSecInlineSigning'
 OBJCLASS_ATTR = 'objectClass'
 
+# changes are synchronized when no new event arrived for DEBOUNCE_DELAY
+# seconds but at most MAX_DELAY seconds after the first unsynchronized event
+DEBOUNCE_DELAY = 2
+MAX_DELAY = 30
+
+# kinds of pending synchronization
+SYNC_ODS = 'ods'
+SYNC_HSM_MASTER = 'hsm_master'
+SYNC_HSM_REPLICA = 'hsm_replica'
+SYNC_KEY_DEL = 'key_del'
+SYNC_BIND = 'bind'
+
 
 class KeySyncer(SyncReplConsumer):
     def __init__(self, *args, **kwargs):
@@ -35,8 +48,32 @@ class KeySyncer(SyncReplConsumer):
         self.bindmgr = BINDMgr(self.api)
         self.init_done = False
         self.dnssec_zones = set()
+
+        # event queue: kinds of synchronization requested by events
+        # received since the last batch, zones are coalesced by BINDMgr
+        self.pending = set()
+        # kinds of synchronization requested by events received before the
+        # initial LDAP dump is done
+        self.pending_init = set()
+        self.state_restored = False
+        self.first_event_time = None
+        self.last_event_time = None
+        # time of the last token permission fix, None if it was not done yet
+        self.token_permissions_time = None
+        self.stats = dict(events=0, batches=0, ods_syncs=0,
+                          hsm_master_syncs=0, hsm_replica_syncs=0,
+                          bind_syncs=0)
         SyncReplConsumer.__init__(self, *args, **kwargs)
 
+        if self.syncrepl_get_cookie() is not None:
+            # state was restored from the last run which left BIND key files
+            # in sync with it, only zones changed since then have to be
+            # synchronized
+            self.state_restored = True
+            self.bindmgr.modified_zones = set()
+        # events replayed from the restored state are not changes
+        self.pending_init = set()
+
     def _get_objclass(self, attrs):
         """Get object class.
 
@@ -74,7 +111,7 @@ class KeySyncer(SyncReplConsumer):
             self.key_meta_add(uuid, dn, newattrs)
         elif objclass == 'ipk11publickey' and \
                 self.__is_replica_pubkey(newattrs):
-            self.hsm_master_sync()
+            self.queue_sync(SYNC_HSM_MASTER)
 
     def application_del(self, uuid, dn, oldattrs):
         objclass = self._get_objclass(oldattrs)
@@ -84,7 +121,7 @@ class KeySyncer(SyncReplConsumer):
             self.key_meta_del(uuid, dn, oldattrs)
         elif objclass == 'ipk11publickey' and \
                 self.__is_replica_pubkey(oldattrs):
-            self.hsm_master_sync()
+            self.queue_sync(SYNC_HSM_MASTER)
 
     def application_sync(self, uuid, dn, newattrs, oldattrs):
         objclass = self._get_objclass(oldattrs)
@@ -106,36 +143,117 @@ class KeySyncer(SyncReplConsumer):
 
         elif objclass == 'ipk11publickey' and \
                 self.__is_replica_pubkey(newattrs):
-            self.hsm_master_sync()
+            self.queue_sync(SYNC_HSM_MASTER)
 
     def syncrepl_refreshdone(self):
         self.log.info('Initial LDAP dump is done, sychronizing with ODS and BIND')
         self.init_done = True
-        self.ods_sync()
-        self.hsm_replica_sync()
-        self.hsm_master_sync()
-        self.bindmgr.sync(self.dnssec_zones)
+        if self.state_restored:
+            # the last run synchronized everything up to the restored cookie,
+            # only changes received since then have to be synchronized;
+            # BIND sync is limited to zones changed since then
+            self.pending = self.pending_init | set([SYNC_BIND])
+        else:
+            self.pending = set([SYNC_ODS, SYNC_HSM_REPLICA, SYNC_HSM_MASTER,
+                                SYNC_KEY_DEL, SYNC_BIND])
+        self.pending_init = set()
+        self.process_pending(force=True)
+
+    def queue_sync(self, *kinds):
+        """Request synchronization, it is done later by process_pending().
+
+        Events received before the initial LDAP dump is done are recorded
+        and synchronized when the dump is done."""
+        self.stats['events'] += 1
+        if not self.init_done:
+            self.pending_init.update(kinds)
+            return
+        now = time.time()
+        if not self.pending:
+            self.first_event_time = now
+        self.last_event_time = now
+        self.pending.update(kinds)
+
+    def get_poll_timeout(self):
+        """Get number of seconds until pending changes have to be processed.
+
+        :returns: None if there are no pending changes
+        """
+        if not self.pending:
+            return None
+        due = min(self.last_event_time + DEBOUNCE_DELAY,
+                  self.first_event_time + MAX_DELAY)
+        return max(0, due - time.time())
+
+    def process_pending(self, force=False):
+        """Synchronize all changes queued since the last batch in one pass.
+
+        Nothing is done until the debounce window elapsed, unless force is
+        True."""
+        if not self.pending:
+            # there is nothing to synchronize, received changes are done;
+            # before the initial LDAP dump is done nothing was synchronized
+            # yet and the state has to stay at the last synchronized cookie
+            if self.init_done:
+                self.commit_state()
+            return
+        if not force and self.get_poll_timeout() > 0:
+            return
+
+        pending = self.pending
+        self.pending = set()
+        self.stats['batches'] += 1
+
+        if SYNC_ODS in pending:
+            self.ods_sync()
+        if SYNC_HSM_MASTER in pending:
+            self.hsm_master_sync()
+        # BIND key files of deleted keys have to be removed before the keys
+        # are removed from the local HSM, while keys have to be in the local
+        # HSM before BIND key files referring to them are generated
+        if SYNC_KEY_DEL in pending:
+            self.bindmgr_remove_deleted_keys(self.dnssec_zones)
+        if SYNC_HSM_REPLICA in pending:
+            self.hsm_replica_sync()
+        if pending & set([SYNC_HSM_MASTER, SYNC_HSM_REPLICA, SYNC_BIND]):
+            # named has to be able to read token files created by HSM
+            # synchronization or by ODS on DNSSEC master since the last fix
+            since = self.token_permissions_time
+            self.token_permissions_time = time.time()
+            fix_token_permissions(since)
+        if SYNC_BIND in pending:
+            self.bindmgr_sync(self.dnssec_zones)
+        self.commit_state()
+
+        self.log.info(
+            'Synchronization batch done: %(events)d events received, '
+            '%(batches)d batches, %(ods_syncs)d ODS, %(hsm_master_syncs)d '
+            'HSM master, %(hsm_replica_syncs)d HSM replica and '
+            '%(bind_syncs)d BIND synchronizations executed', self.stats)
 
     # idnsSecKey wrapper
     # Assumption: metadata points to the same key blob all the time,
     # i.e. it is not necessary to re-download blobs because of change in DNSSEC
     # metadata - DNSSEC flags or timestamps.
     def key_meta_add(self, uuid, dn, newattrs):
-        self.hsm_replica_sync()
         self.bindmgr.ldap_event('add', uuid, newattrs)
-        self.bindmgr_sync(self.dnssec_zones)
+        self.queue_sync(SYNC_HSM_REPLICA, SYNC_BIND)
 
     def key_meta_del(self, uuid, dn, oldattrs):
         self.bindmgr.ldap_event('del', uuid, oldattrs)
-        self.bindmgr_sync(self.dnssec_zones)
-        self.hsm_replica_sync()
+        self.queue_sync(SYNC_KEY_DEL, SYNC_HSM_REPLICA, SYNC_BIND)
 
     def key_metadata_sync(self, uuid, dn, oldattrs, newattrs):
         self.bindmgr.ldap_event('mod', uuid, newattrs)
-        self.bindmgr_sync(self.dnssec_zones)
+        self.queue_sync(SYNC_BIND)
+
+    def bindmgr_remove_deleted_keys(self, dnssec_zones):
+        if self.init_done:
+            self.bindmgr.remove_deleted_keys(dnssec_zones)
 
     def bindmgr_sync(self, dnssec_zones):
         if self.init_done:
+            self.stats['bind_syncs'] += 1
             self.bindmgr.sync(dnssec_zones)
 
     # idnsZone wrapper
@@ -151,7 +269,7 @@ class KeySyncer(SyncReplConsumer):
 
         if self.__is_dnssec_enabled(newattrs):
             self.odsmgr.ldap_event('add', uuid, newattrs)
-        self.ods_sync()
+        self.queue_sync(SYNC_ODS)
 
     def zone_del(self, uuid, dn, oldattrs):
         zone = dns.name.from_text(oldattrs['idnsname'][0])
@@ -162,13 +280,14 @@ class KeySyncer(SyncReplConsumer):
 
         if self.__is_dnssec_enabled(oldattrs):
             self.odsmgr.ldap_event('del', uuid, oldattrs)
-        self.ods_sync()
+        self.queue_sync(SYNC_ODS)
 
     def ods_sync(self):
         if not self.ismaster:
             return
 
         if self.init_done:
+            self.stats['ods_syncs'] += 1
             self.odsmgr.sync()
 
     # triggered by modification to idnsSecKey objects
@@ -178,6 +297,7 @@ class KeySyncer(SyncReplConsumer):
             return
         if not self.init_done:
             return
+        self.stats['hsm_replica_syncs'] += 1
         ipautil.run([paths.IPA_DNSKEYSYNCD_REPLICA])
 
     # triggered by modification to ipk11PublicKey objects
@@ -188,4 +308,5 @@ class KeySyncer(SyncReplConsumer):
             return
         if not self.init_done:
             return
+        self.stats['hsm_master_syncs'] += 1
         ipautil.run([paths.ODS_SIGNER, 'ipa-hsm-update'])
@@ -116,6 +116,7 @@ class Key(collections.MutableMapping):
     def __init__(self, entry, ldap, ldapkeydb):
         self.entry = entry
         self._delentry = None  # indicates that object was deleted
+        self._dirty = False  # indicates that object was modified
         self.ldap = ldap
         self.ldapkeydb = ldapkeydb
         self.log = ldap.log.getChild(__name__)
@@ -135,10 +136,12 @@ class Key(collections.MutableMapping):
     def __setitem__(self, key, value):
         self.__assert_not_deleted()
         self.entry[key] = value
+        self._dirty = True
 
     def __delitem__(self, key):
         self.__assert_not_deleted()
         del self.entry[key]
+        self._dirty = True
 
     def __iter__(self):
         """generates list of ipa names of all PKCS#11 attributes present in the object"""
@@ -162,6 +165,13 @@ class Key(collections.MutableMapping):
                 del sanitized[attr]
         return repr(sanitized)
 
+    def _set_defaults(self):
+        """add default values not present in LDAP entry"""
+        default_attrs = get_default_attrs(self.entry['objectclass'])
+        for attr in default_attrs:
+            if attr not in self.entry:
+                self.entry[attr] = default_attrs[attr]
+
     def _cleanup_key(self):
         """remove default values from LDAP entry"""
         default_attrs = get_default_attrs(self.entry['objectclass'])
@@ -170,32 +180,12 @@ class Key(collections.MutableMapping):
             if self.get(attr, empty) == default_attrs[attr]:
                 del self[attr]
 
-    def _update_key(self):
-        """remove default values from LDAP entry and write back changes"""
-        if self._delentry:
-            self._delete_key()
-            return
-
-        self._cleanup_key()
-
-        try:
-            self.ldap.update_entry(self.entry)
-        except ipalib.errors.EmptyModlist:
-            pass
-
-    def _delete_key(self):
-        """remove key metadata entry from LDAP
+    def _forget(self):
+        """invalidate the object after its entry was deleted from LDAP
 
         After calling this, the python object is no longer valid and all
         subsequent method calls on it will fail.
         """
-        assert not self.entry, (
-            "Key._delete_key() called before Key.schedule_deletion()")
-        assert self._delentry, "Key._delete_key() called more than once"
-        self.log.debug('deleting key id 0x%s DN %s from LDAP',
-                       hexlify(self._delentry.single_value['ipk11id']),
-                       self._delentry.dn)
-        self.ldap.delete_entry(self._delentry)
         self._delentry = None
         self.ldap = None
         self.ldapkeydb = None
@@ -211,6 +201,7 @@ class Key(collections.MutableMapping):
             "Key.schedule_deletion() called more than once")
         self._delentry = self.entry
         self.entry = None
+        self._dirty = True
 
 
 class ReplicaKey(Key):
@@ -235,7 +226,7 @@ class MasterKey(Key):
 
         for dn in self.entry['ipaSecretKeyRef']:
             try:
-                obj = self.ldap.get_entry(dn)
+                obj = self.ldapkeydb.get_entry(dn)
                 keys.append(obj)
             except ipalib.errors.NotFound:
                 continue
@@ -258,35 +249,102 @@ class MasterKey(Key):
                 hexlify(self['ipk11id']),
                 hexlify(replica_key_id),
                 entry_dn)
-        self.ldap.add_entry(entry)
+        # the entry is added to LDAP by LdapKeyDB.flush()
+        self.ldapkeydb.add_entry(entry)
         if 'ipaSecretKeyRef' not in self.entry:
             self.entry['objectClass'] += ['ipaSecretKeyRefObject']
         self.entry.setdefault('ipaSecretKeyRef', []).append(entry_dn)
+        self._dirty = True
 
 
 class LdapKeyDB(AbstractHSM):
+    """PKCS#11 objects stored in LDAP
+
+    All objects are loaded from LDAP using a single search on first access
+    and kept in memory until refresh() is called. Changes of keys and new
+    objects are written to LDAP by flush(), which pipelines the LDAP
+    operations.
+    """
     def __init__(self, log, ldap, base_dn):
         self.ldap = ldap
         self.base_dn = base_dn
         self.log = log
+        self._entries = None  # {DN: entry} of all PKCS#11 objects
+        self._new_entries = []  # entries to be added by flush()
         self.cache_replica_pubkeys_wrap = None
         self.cache_masterkeys = None
         self.cache_zone_keypairs = None
 
-    def _get_key_dict(self, key_type, ldap_filter):
+    def refresh(self):
+        """load all objects from LDAP
+
+        Changes which were not written to LDAP by flush() are lost."""
+        self._entries = {}
         try:
-            objs = self.ldap.get_entries(base_dn=self.base_dn,
-                    filter=ldap_filter)
+            for entry in self.ldap.iter_entries(
+                    base_dn=self.base_dn, filter='(objectClass=ipk11Object)'):
+                self._entries[entry.dn] = entry
         except ipalib.errors.NotFound:
-            return {}
+            pass
+        self.log.debug('loaded %d objects from %s', len(self._entries),
+                       self.base_dn)
 
+        self.cache_replica_pubkeys_wrap = self._filter_replica_keys(
+            self._get_key_dict(ReplicaKey, self._is_replica_pubkey_wrap))
+
+        self.cache_masterkeys = self._get_key_dict(MasterKey,
+                                                   self._is_master_key)
+        for key in self.cache_masterkeys.values():
+            prefix = 'dnssec-master'
+            assert key['ipk11label'] == prefix, \
+                'secret key dn="%s" ipk11id=0x%s ipk11label="%s" with ipk11UnWrap = TRUE does not have '\
+                '"%s" key label' % (
+                    key.entry.dn,
+                    hexlify(key['ipk11id']),
+                    str(key['ipk11label']),
+                    prefix)
+
+        self.cache_zone_keypairs = self._filter_zone_keys(
+            self._get_key_dict(Key, self._is_zone_keypair))
+
+    def _load(self):
+        if self._entries is None:
+            self.refresh()
+
+    @staticmethod
+    def _objectclasses(entry):
+        return set(o.lower() for o in entry['objectClass'])
+
+    def _is_replica_pubkey_wrap(self, entry):
+        """(&(objectClass=ipk11PublicKey)(ipk11Wrap=TRUE)
+        (objectClass=ipaPublicKeyObject))"""
+        return ({'ipk11publickey', 'ipapublickeyobject'} <=
+                self._objectclasses(entry) and
+                'ipk11Wrap' in entry and
+                ldap_bool(entry.single_value['ipk11Wrap']))
+
+    def _is_master_key(self, entry):
+        """(&(objectClass=ipk11SecretKey)(|(ipk11UnWrap=TRUE)
+        (!(ipk11UnWrap=*)))(ipk11Label=dnssec-master))"""
+        return ('ipk11secretkey' in self._objectclasses(entry) and
+                ('ipk11UnWrap' not in entry or
+                 ldap_bool(entry.single_value['ipk11UnWrap'])) and
+                entry.get('ipk11Label') == [u'dnssec-master'])
+
+    def _is_zone_keypair(self, entry):
+        """(&(objectClass=ipk11PrivateKey)(objectClass=ipaPrivateKeyObject)
+        (objectClass=ipk11PublicKey)(objectClass=ipaPublicKeyObject))"""
+        return ({'ipk11privatekey', 'ipaprivatekeyobject', 'ipk11publickey',
+                 'ipapublickeyobject'} <= self._objectclasses(entry))
+
+    def _get_key_dict(self, key_type, match):
         keys = {}
-        for o in objs:
+        for o in self._entries.values():
+            if not match(o):
+                continue
             # add default values not present in LDAP
             key = key_type(o, self.ldap, self)
-            default_attrs = get_default_attrs(key.entry['objectclass'])
-            for attr in default_attrs:
-                key.setdefault(attr, default_attrs[attr])
+            key._set_defaults()
 
             assert 'ipk11id' in key, 'key is missing ipk11Id in %s' % key.entry.dn
             key_id = key['ipk11id']
@@ -296,22 +354,83 @@ class LdapKeyDB(AbstractHSM):
 
             keys[key_id] = key
 
-        self._update_keys()
         return keys
 
-    def _update_keys(self):
+    def get_entry(self, dn):
+        """get object with given DN, from memory if it was loaded"""
+        self._load()
+        try:
+            return self._entries[dn]
+        except KeyError:
+            return self.ldap.get_entry(dn)
+
+    def add_entry(self, entry):
+        """schedule addition of new object to LDAP"""
+        self._new_entries.append(entry)
+        if self._entries is not None:
+            self._entries[entry.dn] = entry
+
+    def _all_keys(self):
+        keys = {}
         for cache in [self.cache_masterkeys, self.cache_replica_pubkeys_wrap,
                       self.cache_zone_keypairs]:
             if cache:
                 for key in cache.values():
-                    key._update_key()
+                    keys[id(key)] = key
+        return keys.values()
 
     def flush(self):
-        """write back content of caches to LDAP"""
-        self._update_keys()
-        self.cache_masterkeys = None
-        self.cache_replica_pubkeys_wrap = None
-        self.cache_zone_keypairs = None
+        """write back new objects and modified keys to LDAP"""
+        # new objects have to exist before keys referring to them are updated
+        new_entries = self._new_entries
+        self._new_entries = []
+        for entry, error in self.ldap.add_entries(new_entries):
+            if error is not None:
+                raise error
+
+        modified = []
+        deleted = []
+        for key in self._all_keys():
+            if not key._dirty:
+                continue
+            if key._delentry:
+                deleted.append(key)
+                continue
+            key._cleanup_key()
+            modified.append(key)
+
+        for entry, error in self.ldap.update_entries(
+                key.entry for key in modified):
+            if error is not None and not isinstance(
+                    error, ipalib.errors.EmptyModlist):
+                raise error
+        for key in modified:
+            key._set_defaults()
+            key._dirty = False
+
+        for key in deleted:
+            self.log.debug('deleting key id 0x%s DN %s from LDAP',
+                           hexlify(key._delentry.single_value['ipk11id']),
+                           key._delentry.dn)
+        for dn, error in self.ldap.delete_entries(
+                key._delentry.dn for key in deleted):
+            if error is not None:
+                raise error
+        for key in deleted:
+            for cache in [self.cache_masterkeys,
+                          self.cache_replica_pubkeys_wrap,
+                          self.cache_zone_keypairs]:
+                for key_id, cached_key in list(cache.items()):
+                    if cached_key is key:
+                        del cache[key_id]
+            if self._entries is not None:
+                self._entries.pop(key._delentry.dn, None)
+            key._forget()
+
+        if new_entries:
+            # new objects have to be sorted to keys, the DN of objects
+            # added with autogenerated RDN is known only to the server
+            self._entries = None
 
     def _import_keys_metadata(self, source_keys):
         """import key metadata from Key-compatible objects
@@ -340,13 +459,15 @@ class LdapKeyDB(AbstractHSM):
         return new_key
 
     def import_master_key(self, mkey):
+        """schedule addition of master key metadata, see flush()"""
         new_key = self._import_keys_metadata(
                 [(mkey, _ipap11helper.KEY_CLASS_SECRET_KEY)])
-        self.ldap.add_entry(new_key.entry)
+        self._new_entries.append(new_key.entry)
         self.log.debug('imported master key metadata: %s', new_key.entry)
 
     def import_zone_key(self, pubkey, pubkey_data, privkey,
             privkey_wrapped_data, wrapping_mech, master_key_id):
+        """schedule addition of zone key pair, see flush()"""
         new_key = self._import_keys_metadata(
                     [(pubkey, _ipap11helper.KEY_CLASS_PUBLIC_KEY),
                     (privkey, _ipap11helper.KEY_CLASS_PRIVATE_KEY)])
@@ -360,50 +481,22 @@ class LdapKeyDB(AbstractHSM):
         new_key.entry['objectClass'].append('ipaPublicKeyObject')
         new_key.entry['ipaPublicKey'] = pubkey_data
 
-        self.ldap.add_entry(new_key.entry)
+        self._new_entries.append(new_key.entry)
         self.log.debug('imported zone key id: 0x%s', hexlify(new_key['ipk11id']))
 
     @property
     def replica_pubkeys_wrap(self):
-        if self.cache_replica_pubkeys_wrap:
-            return self.cache_replica_pubkeys_wrap
-
-        keys = self._filter_replica_keys(
-                self._get_key_dict(ReplicaKey,
-                '(&(objectClass=ipk11PublicKey)(ipk11Wrap=TRUE)(objectClass=ipaPublicKeyObject))'))
-
-        self.cache_replica_pubkeys_wrap = keys
-        return keys
+        self._load()
+        return self.cache_replica_pubkeys_wrap
 
     @property
     def master_keys(self):
-        if self.cache_masterkeys:
-            return self.cache_masterkeys
-
-        keys = self._get_key_dict(MasterKey,
-                '(&(objectClass=ipk11SecretKey)(|(ipk11UnWrap=TRUE)(!(ipk11UnWrap=*)))(ipk11Label=dnssec-master))')
-        for key in keys.values():
-            prefix = 'dnssec-master'
-            assert key['ipk11label'] == prefix, \
-                'secret key dn="%s" ipk11id=0x%s ipk11label="%s" with ipk11UnWrap = TRUE does not have '\
-                '"%s" key label' % (
-                    key.entry.dn,
-                    hexlify(key['ipk11id']),
-                    str(key['ipk11label']),
-                    prefix)
-
-        self.cache_masterkeys = keys
-        return keys
+        self._load()
+        return self.cache_masterkeys
 
     @property
     def zone_keypairs(self):
-        if self.cache_zone_keypairs:
-            return self.cache_zone_keypairs
-
-        self.cache_zone_keypairs = self._filter_zone_keys(
-                self._get_key_dict(Key,
-                '(&(objectClass=ipk11PrivateKey)(objectClass=ipaPrivateKeyObject)(objectClass=ipk11PublicKey)(objectClass=ipaPublicKeyObject))'))
-
+        self._load()
         return self.cache_zone_keypairs
 
 if __name__ == '__main__':
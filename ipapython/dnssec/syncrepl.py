@@ -5,8 +5,17 @@
 """
 This script implements a syncrepl consumer which syncs data from server
 to a local dict.
+
+The dict and the syncrepl cookie can be persisted in a SQLite database, so
+a restarted consumer receives only changes made since it was stopped.
 """
 
+import base64
+import json
+import sqlite3
+
+import six
+
 # Import the python-ldap modules
 import ldap
 # Import specific classes from python-ldap
@@ -16,14 +25,114 @@ from ldap.syncrepl import SyncreplConsumer
 
 from ipapython import ipa_log_manager
 
+# e-syncRefreshRequired result code, RFC 4533
+SYNC_REFRESH_REQUIRED = 4096
+
+
+class SyncReplStateStore(object):
+    """
+    Crash-safe on-disk copy of syncrepl cookie and entries
+
+    Changes are written in a transaction which is committed only by
+    commit(), so after a crash the store contains the cookie and the entries
+    as of the last commit, which are consistent with each other.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS state '
+                '(key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(uuid TEXT PRIMARY KEY, attributes TEXT)')
+
+    @staticmethod
+    def _encode(attributes):
+        # values are binary, the 'dn' pseudo-attribute is a string
+        data = {}
+        for name, values in attributes.items():
+            if name == 'dn':
+                data[name] = values
+            else:
+                data[name] = [base64.b64encode(value).decode('ascii')
+                              for value in values]
+        return json.dumps(data)
+
+    @staticmethod
+    def _decode(data):
+        attributes = {}
+        for name, values in json.loads(data).items():
+            name = str(name)
+            if name == 'dn':
+                if six.PY2:
+                    values = values.encode('utf-8')
+                attributes[name] = values
+            else:
+                attributes[name] = [base64.b64decode(value)
+                                    for value in values]
+        return attributes
+
+    def get_cookie(self):
+        row = self.conn.execute(
+            "SELECT value FROM state WHERE key = 'cookie'").fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def set_cookie(self, cookie):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES ('cookie', ?)",
+            (cookie,))
+
+    def get_entries(self):
+        """Iterate over (uuid, attributes) of all stored entries"""
+        for uuid, data in self.conn.execute(
+                'SELECT uuid, attributes FROM entries'):
+            yield str(uuid), self._decode(data)
+
+    def put_entry(self, uuid, attributes):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO entries (uuid, attributes) VALUES (?, ?)',
+            (uuid, self._encode(attributes)))
+
+    def delete_entry(self, uuid):
+        self.conn.execute('DELETE FROM entries WHERE uuid = ?', (uuid,))
+
+    def clear_entries(self):
+        self.conn.execute('DELETE FROM entries')
+
+    def clear(self):
+        """Delete the cookie and all entries"""
+        self.conn.execute("DELETE FROM state WHERE key = 'cookie'")
+        self.clear_entries()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        # uncommitted changes are rolled back
+        self.conn.close()
+
 
 class SyncReplConsumer(ReconnectLDAPObject, SyncreplConsumer):
     """
     Syncrepl Consumer interface
+
+    If state_file is given, the cookie and the entries are persisted in it.
+    Entries stored there are passed to application_add() when the consumer
+    is created, so the application can rebuild its state before changes
+    since the stored cookie are received. Subclasses have to call
+    commit_state() when the application processed all received changes.
     """
 
     def __init__(self, *args, **kwargs):
         self.log = ipa_log_manager.log_mgr.get_logger(self)
+        state_file = kwargs.pop('state_file', None)
         # Initialise the LDAP Connection first
         ldap.ldapobject.ReconnectLDAPObject.__init__(self, *args, **kwargs)
         # Now prepare the data store
@@ -32,9 +141,70 @@ class SyncReplConsumer(ReconnectLDAPObject, SyncreplConsumer):
         # We need this for later internal use
         self.__presentUUIDs = cidict()
 
+        self.__store = None
+        if state_file is not None:
+            self.__store = SyncReplStateStore(state_file)
+            self.__load_state()
+
+    def __load_state(self):
+        cookie = self.__store.get_cookie()
+        if cookie is None:
+            # entries left over from an interrupted initial dump are not
+            # consistent with any cookie, the full dump will store them again
+            self.__store.clear_entries()
+            self.__store.commit()
+            return
+        count = 0
+        for uuid, attributes in self.__store.get_entries():
+            attributes = cidict(attributes)
+            self.__data['uuids'][uuid] = attributes
+            self.application_add(uuid, attributes['dn'], attributes)
+            count += 1
+        self.__data['cookie'] = cookie
+        self.log.info('Loaded %d entries from %s', count,
+                      self.__store.filename)
+
+    def is_cookie_refused(self, error):
+        """
+        Check if LDAP error means that the server does not accept the cookie
+        sent in the syncrepl search and a full refresh is required, e.g.
+        after the changelog was trimmed or the database was restored.
+        """
+        if 'cookie' not in self.__data:
+            return False
+        if isinstance(error, (ldap.PROTOCOL_ERROR, ldap.UNWILLING_TO_PERFORM)):
+            # the cookie cannot be parsed or belongs to another server
+            return True
+        info = {}
+        if error.args and isinstance(error.args[0], dict):
+            info = error.args[0]
+        if info.get('result') == SYNC_REFRESH_REQUIRED:
+            return True
+        return 'refresh required' in str(info.get('desc', '')).lower()
+
+    def reset_state(self):
+        """
+        Forget the cookie and all entries, in memory and in the state file.
+        The next syncrepl search does a full refresh.
+        """
+        self.log.info('Discarding syncrepl cookie and entries')
+        if 'cookie' in self.__data:
+            del self.__data['cookie']
+        self.__data['uuids'] = cidict()
+        self.__presentUUIDs = cidict()
+        if self.__store is not None:
+            self.__store.clear()
+            self.__store.commit()
+
+    def commit_state(self):
+        """Make changes received so far persistent"""
+        if self.__store is not None:
+            self.__store.commit()
+
     def close_db(self):
-        # This is useless for dict
-        pass
+        if self.__store is not None:
+            self.__store.close()
+            self.__store = None
 
     def syncrepl_get_cookie(self):
         if 'cookie' in self.__data:
@@ -47,6 +217,8 @@ class SyncReplConsumer(ReconnectLDAPObject, SyncreplConsumer):
     def syncrepl_set_cookie(self, cookie):
         self.log.debug('New cookie is: %s', cookie)
         self.__data['cookie'] = cookie
+        if self.__store is not None:
+            self.__store.set_cookie(cookie)
 
     def syncrepl_entry(self, dn, attributes, uuid):
         attributes = cidict(attributes)
@@ -62,6 +234,8 @@ class SyncReplConsumer(ReconnectLDAPObject, SyncreplConsumer):
         # (including the DN as an attribute for convenience)
         attributes['dn'] = dn
         self.__data['uuids'][uuid] = attributes
+        if self.__store is not None:
+            self.__store.put_entry(uuid, attributes)
         # Debugging
         self.log.debug('Detected %s of entry: %s %s', change_type, dn, uuid)
         if change_type == 'modify':
@@ -79,6 +253,8 @@ class SyncReplConsumer(ReconnectLDAPObject, SyncreplConsumer):
             self.log.debug('Detected deletion of entry: %s %s', dn, uuid)
             self.application_del(uuid, dn, attributes)
             del self.__data['uuids'][uuid]
+            if self.__store is not None:
+                self.__store.delete_entry(uuid)
 
     def syncrepl_present(self, uuids, refreshDeletes=False):
         # If we have not been given any UUID values,
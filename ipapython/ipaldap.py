@@ -51,6 +51,10 @@ if six.PY3:
 SASL_GSSAPI = ldap.sasl.sasl({}, 'GSSAPI')
 
 DEFAULT_TIMEOUT = 10
+# Maximal number of asynchronous write operations waiting for a result
+DEFAULT_PIPELINE_WINDOW = 100
+# Number of entries requested in one page by iter_entries()
+DEFAULT_PAGE_SIZE = 1000
 _debug_log_ldap = False
 
 _missing = object()
@@ -1433,6 +1437,103 @@ class LDAPClient(object):
 
         return (res, truncated)
 
+    def iter_entries(self, filter=None, attrs_list=None, base_dn=None,
+                     scope=ldap.SCOPE_SUBTREE, time_limit=None,
+                     search_refs=False, page_size=DEFAULT_PAGE_SIZE):
+        """
+        Iterate over entries matching specified search parameters.
+
+        The search uses paged results control and only a single page of
+        entries is held in memory at a time, which makes it suitable for
+        processing very large result sets. Other operations may be done on
+        the connection while iterating.
+
+        Keyword arguments:
+        attrs_list -- list of attributes to return, all if None (default None)
+        base_dn -- dn of the entry at which to start the search (default '')
+        scope -- search scope, see LDAP docs (default ldap2.SCOPE_SUBTREE)
+        time_limit -- time limit in seconds for each page
+            (default unlimited)
+        search_refs -- allow search references to be returned
+            (default skips these entries)
+        page_size -- number of entries requested in one page
+
+        :raises: errors.LimitsExceeded if the search is truncated by
+                 the server, after all entries received so far were yielded
+        """
+        if base_dn is None:
+            base_dn = DN()
+        assert isinstance(base_dn, DN)
+        if not filter:
+            filter = '(objectClass=*)'
+
+        if time_limit is None:
+            time_limit = self.time_limit
+        if not time_limit:
+            time_limit = -1.0
+        time_limit = float(time_limit)
+
+        if attrs_list:
+            attrs_list = [a.lower() for a in set(attrs_list)]
+
+        if six.PY2:
+            filter = self.encode(filter)
+            attrs_list = self.encode(attrs_list)
+
+        cookie = ''
+        try:
+            while True:
+                page = []
+                truncated = False
+                sctrls = [SimplePagedResultsControl(0, page_size, cookie)]
+                cookie = ''
+
+                with self.error_handler():
+                    try:
+                        msgid = self.conn.search_ext(
+                            str(base_dn), scope, filter, attrs_list,
+                            serverctrls=sctrls, timeout=time_limit)
+                        while True:
+                            objtype, res_list, _res_id, res_ctrls = (
+                                self.conn.result3(msgid, 0))
+                            res_list = self._convert_result(res_list)
+                            if not res_list:
+                                break
+                            if (objtype == ldap.RES_SEARCH_ENTRY or
+                                    (search_refs and
+                                        objtype == ldap.RES_SEARCH_REFERENCE)):
+                                page.append(res_list[0])
+                    except ldap.ADMINLIMIT_EXCEEDED:
+                        truncated = TRUNCATED_ADMIN_LIMIT
+                    except ldap.SIZELIMIT_EXCEEDED:
+                        truncated = TRUNCATED_SIZE_LIMIT
+                    except ldap.TIMELIMIT_EXCEEDED:
+                        truncated = TRUNCATED_TIME_LIMIT
+                    else:
+                        # Get cookie for the next page
+                        for ctrl in res_ctrls:
+                            if isinstance(ctrl, SimplePagedResultsControl):
+                                cookie = ctrl.cookie
+                                break
+
+                for entry in page:
+                    yield entry
+
+                self.handle_truncated_result(truncated)
+
+                if not cookie:
+                    break
+        finally:
+            # the iteration was interrupted, cancel the paged search
+            if cookie:
+                sctrls = [SimplePagedResultsControl(0, 0, cookie)]
+                try:
+                    self.conn.search_ext_s(
+                        str(base_dn), scope, filter, attrs_list,
+                        serverctrls=sctrls, timeout=time_limit)
+                except ldap.LDAPError as e:
+                    self.log.warning("Error cancelling paged search: %s", e)
+
     def find_entry_by_attr(self, attr, value, object_class, attrs_list=None,
                            base_dn=None):
         """
@@ -1489,6 +1590,98 @@ class LDAPClient(object):
 
         entry.reset_modlist()
 
+    def _pipeline(self, items, send, window):
+        """Send an operation for each item without waiting for its result.
+
+        ``send`` starts the operation for an item and returns its message ID.
+        Up to ``window`` operations are outstanding at a time. Yields
+        ``(item, error)`` tuples in the order of ``items``.
+        """
+        pending = collections.deque()
+
+        def collect():
+            item, msgid = pending.popleft()
+            try:
+                with self.error_handler():
+                    self.conn.result3(msgid)
+            except errors.PublicError as e:
+                return item, e
+            return item, None
+
+        for item in items:
+            try:
+                with self.error_handler():
+                    msgid = send(item)
+            except errors.PublicError as e:
+                # keep the order of results
+                while pending:
+                    yield collect()
+                yield item, e
+                continue
+
+            pending.append((item, msgid))
+            if len(pending) >= window:
+                yield collect()
+
+        while pending:
+            yield collect()
+
+    def add_entries(self, entries, window=DEFAULT_PIPELINE_WINDOW):
+        """Create new entries, pipelining the add operations.
+
+        Up to ``window`` add operations are sent to the server before
+        waiting for their results, which avoids one round trip per entry.
+
+        This is a generator which yields ``(entry, error)`` tuples in the
+        order of ``entries``, ``error`` is None when the entry was created
+        or the exception raised for the entry.
+        """
+        def send(entry):
+            # remove all [] values (python-ldap hates 'em)
+            attrs = dict((k, v) for k, v in entry.raw.items() if v)
+            attrs = self.encode(attrs)
+            return self.conn.add_ext(str(entry.dn), list(attrs.items()))
+
+        for entry, error in self._pipeline(entries, send, window):
+            if error is None:
+                entry.reset_modlist()
+            yield entry, error
+
+    def update_entries(self, entries, window=DEFAULT_PIPELINE_WINDOW):
+        """Update entries' attributes, pipelining the modify operations.
+
+        This is a generator which yields ``(entry, error)`` tuples in the
+        order of ``entries``, see add_entries(). ``error`` is
+        errors.EmptyModlist for entries which were not modified, nothing is
+        sent to the server for them.
+        """
+        def send(entry):
+            modlist = entry.generate_modlist()
+            if not modlist:
+                raise errors.EmptyModlist()
+            modlist = [(a, str(b), self.encode(c)) for a, b, c in modlist]
+            return self.conn.modify_ext(str(entry.dn), modlist)
+
+        for entry, error in self._pipeline(entries, send, window):
+            if error is None:
+                entry.reset_modlist()
+            yield entry, error
+
+    def delete_entries(self, entries_or_dns, window=DEFAULT_PIPELINE_WINDOW):
+        """Delete entries, pipelining the delete operations.
+
+        This is a generator which yields ``(entry_or_dn, error)`` tuples in
+        the order of ``entries_or_dns``, see add_entries().
+        """
+        def send(entry_or_dn):
+            if isinstance(entry_or_dn, DN):
+                dn = entry_or_dn
+            else:
+                dn = entry_or_dn.dn
+            return self.conn.delete_ext(str(dn))
+
+        return self._pipeline(entries_or_dns, send, window)
+
     def move_entry(self, dn, new_dn, del_old=True):
         """
         Move an entry (either to a new superior or/and changing relative distinguished name)
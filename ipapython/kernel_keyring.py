@@ -17,6 +17,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import ctypes
 import os
 import six
 
@@ -33,6 +34,177 @@ from ipapython.ipautil import run
 KEYRING = '@s'
 KEYTYPE = 'user'
 
+# special keyring IDs, see keyctl(1)
+SPECIAL_KEYRINGS = {
+    '@t': -1,
+    '@p': -2,
+    '@s': -3,
+    '@u': -4,
+    '@us': -5,
+    '@g': -6,
+    '@a': -7,
+}
+
+
+def _encode(value):
+    if isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return value
+
+
+class _KeyctlBackend(object):
+    """
+    Keyring access using the keyctl utility
+    """
+    def search(self, keyring, keytype, key):
+        result = run(['keyctl', 'search', keyring, keytype, key],
+                     raiseonerr=False, capture_output=True)
+        if result.returncode:
+            return None
+        return result.raw_output.rstrip()
+
+    def get_persistent(self, keyring, uid):
+        result = run(['keyctl', 'get_persistent', keyring, uid],
+                     raiseonerr=False, capture_output=True)
+        if result.returncode:
+            return None
+        return result.raw_output.rstrip()
+
+    def read(self, real_key):
+        result = run(['keyctl', 'pipe', real_key], raiseonerr=False,
+                     capture_output=True)
+        if result.returncode:
+            raise ValueError('keyctl pipe failed: %s' % result.error_log)
+        return result.raw_output
+
+    def update(self, real_key, value):
+        result = run(['keyctl', 'pupdate', real_key], stdin=value,
+                     raiseonerr=False)
+        if result.returncode:
+            raise ValueError('keyctl pupdate failed: %s' % result.error_log)
+
+    def add(self, keytype, key, value, keyring):
+        result = run(['keyctl', 'padd', keytype, key, keyring],
+                     stdin=value, raiseonerr=False)
+        if result.returncode:
+            raise ValueError('keyctl padd failed: %s' % result.error_log)
+
+    def unlink(self, real_key, keyring):
+        result = run(['keyctl', 'unlink', real_key, keyring],
+                     raiseonerr=False)
+        if result.returncode:
+            raise ValueError('keyctl unlink failed: %s' % result.error_log)
+
+    def set_timeout(self, real_key, timeout):
+        result = run(['keyctl', 'timeout', real_key, str(timeout)],
+                     raiseonerr=False)
+        if result.returncode:
+            raise ValueError('keyctl timeout failed: %s' % result.error_log)
+
+
+class _KeyutilsBackend(object):
+    """
+    Keyring access using libkeyutils directly, without executing keyctl
+    for every operation
+    """
+    def __init__(self):
+        # Load by soname, ctypes.util.find_library() forks ldconfig or gcc
+        self.lib = ctypes.CDLL('libkeyutils.so.1', use_errno=True)
+        self.libc = ctypes.CDLL(None)
+
+        self.lib.add_key.argtypes = [
+            ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p,
+            ctypes.c_size_t, ctypes.c_int32]
+        self.lib.add_key.restype = ctypes.c_int32
+        self.lib.keyctl_search.argtypes = [
+            ctypes.c_int32, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int32]
+        self.lib.keyctl_search.restype = ctypes.c_long
+        self.lib.keyctl_get_persistent.argtypes = [
+            ctypes.c_uint, ctypes.c_int32]
+        self.lib.keyctl_get_persistent.restype = ctypes.c_long
+        self.lib.keyctl_read_alloc.argtypes = [
+            ctypes.c_int32, ctypes.POINTER(ctypes.c_void_p)]
+        self.lib.keyctl_read_alloc.restype = ctypes.c_long
+        self.lib.keyctl_update.argtypes = [
+            ctypes.c_int32, ctypes.c_void_p, ctypes.c_size_t]
+        self.lib.keyctl_update.restype = ctypes.c_long
+        self.lib.keyctl_unlink.argtypes = [ctypes.c_int32, ctypes.c_int32]
+        self.lib.keyctl_unlink.restype = ctypes.c_long
+        self.lib.keyctl_set_timeout.argtypes = [ctypes.c_int32, ctypes.c_uint]
+        self.lib.keyctl_set_timeout.restype = ctypes.c_long
+        self.libc.free.argtypes = [ctypes.c_void_p]
+        self.libc.free.restype = None
+
+    @staticmethod
+    def _keyring_id(keyring):
+        try:
+            return SPECIAL_KEYRINGS[keyring]
+        except KeyError:
+            return int(keyring)
+
+    @staticmethod
+    def _error(operation):
+        errno = ctypes.get_errno()
+        return ValueError('%s failed: %s' % (operation, os.strerror(errno)))
+
+    def search(self, keyring, keytype, key):
+        serial = self.lib.keyctl_search(
+            self._keyring_id(keyring), _encode(keytype), _encode(key), 0)
+        if serial < 0:
+            return None
+        return str(serial).encode('ascii')
+
+    def get_persistent(self, keyring, uid):
+        serial = self.lib.keyctl_get_persistent(
+            int(uid), self._keyring_id(keyring))
+        if serial < 0:
+            return None
+        return str(serial).encode('ascii')
+
+    def read(self, real_key):
+        buf = ctypes.c_void_p()
+        length = self.lib.keyctl_read_alloc(int(real_key), ctypes.byref(buf))
+        if length < 0:
+            raise self._error('keyctl_read')
+        try:
+            return ctypes.string_at(buf, length)
+        finally:
+            self.libc.free(buf)
+
+    def update(self, real_key, value):
+        if self.lib.keyctl_update(int(real_key), value, len(value)) < 0:
+            raise self._error('keyctl_update')
+
+    def add(self, keytype, key, value, keyring):
+        serial = self.lib.add_key(_encode(keytype), _encode(key), value,
+                                  len(value), self._keyring_id(keyring))
+        if serial < 0:
+            raise self._error('add_key')
+
+    def unlink(self, real_key, keyring):
+        if self.lib.keyctl_unlink(int(real_key),
+                                  self._keyring_id(keyring)) < 0:
+            raise self._error('keyctl_unlink')
+
+    def set_timeout(self, real_key, timeout):
+        if self.lib.keyctl_set_timeout(int(real_key), timeout) < 0:
+            raise self._error('keyctl_set_timeout')
+
+
+_backend = None
+
+def _get_backend():
+    """
+    Return the keyring backend, creating it on first use
+    """
+    global _backend
+    if _backend is None:
+        try:
+            _backend = _KeyutilsBackend()
+        except (OSError, AttributeError):
+            _backend = _KeyctlBackend()
+    return _backend
+
 def dump_keys():
     """
     Dump all keys
@@ -47,19 +219,17 @@ def get_real_key(key):
     so find the one we're looking for.
     """
     assert isinstance(key, six.string_types)
-    result = run(['keyctl', 'search', KEYRING, KEYTYPE, key],
-                 raiseonerr=False, capture_output=True)
-    if result.returncode:
+    real_key = _get_backend().search(KEYRING, KEYTYPE, key)
+    if real_key is None:
         raise ValueError('key %s not found' % key)
-    return result.raw_output.rstrip()
+    return real_key
 
 def get_persistent_key(key):
     assert isinstance(key, six.string_types)
-    result = run(['keyctl', 'get_persistent', KEYRING, key],
-                 raiseonerr=False, capture_output=True)
-    if result.returncode:
+    real_key = _get_backend().get_persistent(KEYRING, key)
+    if real_key is None:
         raise ValueError('persistent key %s not found' % key)
-    return result.raw_output.rstrip()
+    return real_key
 
 def is_persistent_keyring_supported():
     uid = os.geteuid()
@@ -89,12 +259,7 @@ def read_key(key):
     """
     assert isinstance(key, six.string_types)
     real_key = get_real_key(key)
-    result = run(['keyctl', 'pipe', real_key], raiseonerr=False,
-                 capture_output=True)
-    if result.returncode:
-        raise ValueError('keyctl pipe failed: %s' % result.error_log)
-
-    return result.raw_output
+    return _get_backend().read(real_key)
 
 def update_key(key, value):
     """
@@ -102,14 +267,12 @@ def update_key(key, value):
     """
     assert isinstance(key, six.string_types)
     assert isinstance(value, bytes)
-    if has_key(key):
+    try:
         real_key = get_real_key(key)
-        result = run(['keyctl', 'pupdate', real_key], stdin=value,
-                     raiseonerr=False)
-        if result.returncode:
-            raise ValueError('keyctl pupdate failed: %s' % result.error_log)
-    else:
+    except ValueError:
         add_key(key, value)
+    else:
+        _get_backend().update(real_key, value)
 
 def add_key(key, value):
     """
@@ -119,10 +282,7 @@ def add_key(key, value):
     assert isinstance(value, bytes)
     if has_key(key):
         raise ValueError('key %s already exists' % key)
-    result = run(['keyctl', 'padd', KEYTYPE, key, KEYRING],
-                 stdin=value, raiseonerr=False)
-    if result.returncode:
-        raise ValueError('keyctl padd failed: %s' % result.error_log)
+    _get_backend().add(KEYTYPE, key, value, KEYRING)
 
 def del_key(key):
     """
@@ -130,7 +290,13 @@ def del_key(key):
     """
     assert isinstance(key, six.string_types)
     real_key = get_real_key(key)
-    result = run(['keyctl', 'unlink', real_key, KEYRING],
-                 raiseonerr=False)
-    if result.returncode:
-        raise ValueError('keyctl unlink failed: %s' % result.error_log)
+    _get_backend().unlink(real_key, KEYRING)
+
+def set_key_timeout(key, timeout):
+    """
+    Set the key to expire after timeout seconds. Zero timeout clears the
+    expiration.
+    """
+    assert isinstance(key, six.string_types)
+    real_key = get_real_key(key)
+    _get_backend().set_timeout(real_key, timeout)
@@ -19,6 +19,7 @@ from time import sleep, time
 
 from ipalib import errors
 from ipalib.dns import record_name_format
+from ipapython.dn import DN
 from ipapython.dnsutil import DNSName, resolve_rrsets
 from ipapython.ipa_log_manager import root_logger
 
@@ -263,44 +264,162 @@ class IPASystemRecords(object):
                 update_dict[option_name].append(unicode(rdata.to_text()))
         return update_dict
 
-    def __update_dns_records(
-            self, record_name, nodes, set_cname_template=True
-    ):
-        update_dict = self.__prepare_records_update_dict(nodes)
-        cname_template = {
-            'addattr': [u'objectclass=idnsTemplateObject'],
-            'setattr': [
-                u'idnsTemplateAttribute;cnamerecord=%s'
-                u'.\{substitutionvariable_ipalocation\}._locations' %
-                record_name.relativize(self.domain_abs)
-            ]
-        }
+    def __get_cname_template(self, record_name):
+        return (
+            u'%s.\{substitutionvariable_ipalocation\}._locations' %
+            record_name.relativize(self.domain_abs)
+        )
+
+    def __get_existing_records(self, zone_dn, record_names, attrs_list):
+        """
+        Read all existing entries for the given record names with one search
+        :return: dict record_name -> LDAPEntry
+        """
+        ldap = self.api_instance.Backend.ldap2
+        ldap_filter = ldap.combine_filters([
+            ldap.make_filter_from_attr('objectclass', 'idnsrecord'),
+            ldap.make_filter_from_attr(
+                'idnsname',
+                [name.relativize(self.domain_abs).ToASCII()
+                 for name in record_names]
+            ),
+        ], rules=ldap.MATCH_ALL)
+
+        # the number of records grows with the number of locations, do not
+        # let the search be truncated by the default limits
         try:
-            if set_cname_template:
-                # only srv records should have configured cname templates
-                update_dict.update(cname_template)
-            self.api_instance.Command.dnsrecord_mod(
-                self.domain_abs, record_name,
-                **update_dict
-            )
+            entries, truncated = ldap.find_entries(
+                ldap_filter, attrs_list, base_dn=zone_dn,
+                scope=ldap.SCOPE_ONELEVEL, size_limit=-1, time_limit=-1,
+                paged_search=True)
         except errors.NotFound:
-            # because internal API magic, addattr and setattr doesn't work with
-            # dnsrecord-add well, use dnsrecord-mod instead later
-            update_dict.pop('addattr', None)
-            update_dict.pop('setattr', None)
+            return {}
+        ldap.handle_truncated_result(truncated)
+
+        return {
+            entry.single_value['idnsname'].derelativize(self.domain_abs): entry
+            for entry in entries
+        }
+
+    def __update_record_entry(self, entry, update_dict, cname_template=None):
+        """
+        Apply desired record values to entry
+        :return: True if entry has been changed
+        """
+        dnsrecord = self.api_instance.Object.dnsrecord
+        changed = False
+
+        for attr, values in update_dict.items():
+            param = dnsrecord.params[attr]
+            current = entry.get(attr, [])
+            if set(param.normalize(tuple(current)) or ()) != set(values):
+                entry[attr] = list(values)
+                changed = True
+
+        if cname_template is not None:
+            objectclasses = entry.get('objectclass', [])
+            if 'idnstemplateobject' not in [
+                    oc.lower() for oc in objectclasses]:
+                entry['objectclass'] = objectclasses + [u'idnsTemplateObject']
+                changed = True
+            if entry.get(
+                    'idnsTemplateAttribute;cnamerecord') != [cname_template]:
+                entry['idnsTemplateAttribute;cnamerecord'] = [cname_template]
+                changed = True
+
+        return changed
+
+    def __normalize_records_update_dict(self, update_dict):
+        dnsrecord = self.api_instance.Object.dnsrecord
+        result = {}
+        for attr, values in update_dict.items():
+            param = dnsrecord.params[attr]
+            values = param(values)
+            param.validate(values)
+            result[attr] = values
+        return result
+
+    def __update_dns_records(self, zone_objs):
+        """
+        Update all records from zone objects in the IPA domain zone
 
-            self.api_instance.Command.dnsrecord_add(
-                self.domain_abs, record_name, **update_dict)
+        Desired records are compared with the current content of LDAP, which
+        is read with a single search, and only changed entries are written
+        directly to LDAP. Record types which are not present in a node are
+        left untouched, the same way as dnsrecord-mod does.
 
-            if set_cname_template:
+        :param zone_objs: list of dns.zone.Zone objects
+        :return: list of ([(record_name, node), ...],
+                          [(record_name, node, error), ...])
+        tuples, one for each zone object
+        """
+        ldap = self.api_instance.Backend.ldap2
+        dnsrecord = self.api_instance.Object.dnsrecord
+        names_requiring_cname_templates = (
+            self.__get_names_requiring_cname_templates())
+
+        results = []
+        desired = []
+        attrs_list = {'idnsname', 'objectclass', 'idnsTemplateAttribute'}
+        for zone_obj in zone_objs:
+            success, fail = [], []
+            results.append((success, fail))
+            for record_name, node in zone_obj.items():
                 try:
-                    self.api_instance.Command.dnsrecord_mod(
-                        self.domain_abs,
-                        record_name, **cname_template)
-                except errors.EmptyModlist:
-                    pass
-        except errors.EmptyModlist:
-            pass
+                    update_dict = self.__normalize_records_update_dict(
+                        self.__prepare_records_update_dict(node))
+                except errors.PublicError as e:
+                    fail.append((record_name, node, e))
+                    continue
+                attrs_list.update(update_dict)
+                desired.append(
+                    (record_name, node, update_dict, success, fail))
+
+        if not desired:
+            return results
+
+        zone_dn = dnsrecord.check_zone(self.domain_abs)
+        existing = self.__get_existing_records(
+            zone_dn, set(d[0] for d in desired), list(attrs_list))
+
+        for record_name, node, update_dict, success, fail in desired:
+            if record_name in names_requiring_cname_templates:
+                cname_template = self.__get_cname_template(record_name)
+            else:
+                cname_template = None
+
+            try:
+                entry = existing.get(record_name)
+                if entry is None:
+                    relative_name = record_name.relativize(self.domain_abs)
+                    entry = ldap.make_entry(
+                        DN(('idnsname', relative_name.ToASCII()), zone_dn),
+                        objectclass=list(dnsrecord.object_class),
+                        idnsname=[relative_name],
+                    )
+                    self.__update_record_entry(
+                        entry, update_dict, cname_template)
+                    ldap.add_entry(entry)
+                    existing[record_name] = entry
+                elif self.__update_record_entry(
+                        entry, update_dict, cname_template):
+                    ldap.update_entry(entry)
+            except errors.PublicError as e:
+                fail.append((record_name, node, e))
+            else:
+                success.append((record_name, node))
+
+        return results
+
+    def __get_names_requiring_cname_templates(self):
+        # only srv records should have configured cname templates
+        return set(
+            rec[0].derelativize(self.domain_abs) for rec in (
+                IPA_DEFAULT_MASTER_SRV_REC +
+                IPA_DEFAULT_ADTRUST_SRV_REC +
+                IPA_DEFAULT_NTP_SRV_REC
+            )
+        )
 
     def get_base_records(
             self, servers=None, roles=None, include_master_role=True,
@@ -363,27 +482,7 @@ class IPASystemRecords(object):
         where the first list contains successfully updated records, and the
         second list contains failed updates with particular exceptions
         """
-        fail = []
-        success = []
-        names_requiring_cname_templates = set(
-            rec[0].derelativize(self.domain_abs) for rec in (
-                IPA_DEFAULT_MASTER_SRV_REC +
-                IPA_DEFAULT_ADTRUST_SRV_REC +
-                IPA_DEFAULT_NTP_SRV_REC
-            )
-        )
-
-        base_zone = self.get_base_records()
-        for record_name, node in base_zone.items():
-            set_cname_template = record_name in names_requiring_cname_templates
-            try:
-                self.__update_dns_records(
-                    record_name, node, set_cname_template)
-            except errors.PublicError as e:
-                fail.append((record_name, node, e))
-            else:
-                success.append((record_name, node))
-        return success, fail
+        return self.__update_dns_records([self.get_base_records()])[0]
 
     def update_locations_records(self):
         """
@@ -392,20 +491,7 @@ class IPASystemRecords(object):
         where the first list contains successfully updated records, and the
         second list contains failed updates with particular exceptions
         """
-        fail = []
-        success = []
-
-        location_zone = self.get_locations_records()
-        for record_name, nodes in location_zone.items():
-            try:
-                self.__update_dns_records(
-                    record_name, nodes,
-                    set_cname_template=False)
-            except errors.PublicError as e:
-                fail.append((record_name, nodes, e))
-            else:
-                success.append((record_name, nodes))
-        return success, fail
+        return self.__update_dns_records([self.get_locations_records()])[0]
 
     def update_dns_records(self):
         """
@@ -421,10 +507,11 @@ class IPASystemRecords(object):
         except errors.NotFound:
             raise IPADomainIsNotManagedByIPAError()
 
-        return (
-            self.update_base_records(),
-            self.update_locations_records()
-        )
+        base_result, locations_result = self.__update_dns_records([
+            self.get_base_records(),
+            self.get_locations_records()
+        ])
+        return base_result, locations_result
 
     def remove_location_records(self, location):
         """
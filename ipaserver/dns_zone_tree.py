@@ -0,0 +1,406 @@
+#
+# Copyright (C) 2016  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Cached tree of DNS zones and delegations stored in LDAP.
+
+Lookups of authoritative zones, forward zones and NS delegations are done
+for every DNS record, host and forward zone operation. Instead of searching
+LDAP each time, all active zones and all NS delegations are loaded into a
+suffix trie which answers these lookups in O(labels). The trie is reused
+as long as no record entry with NS records has been modified and no zone
+has been added, deleted, activated or deactivated, which is checked with a
+single entryUSN search at most once per command. Other modifications of
+zone entries, e.g. SOA serial updates, do not invalidate the trie.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import threading
+
+from ipalib import errors
+from ipalib.request import context
+from ipapython.dn import DN
+from ipapython.dnsutil import DNSName
+from ipapython.ipa_log_manager import root_logger
+
+
+class _DNSZoneTreeNode(object):
+    __slots__ = ('children', 'name', 'master', 'forward', 'delegated_in')
+
+    def __init__(self):
+        self.children = {}
+        # absolute zone name as stored in LDAP
+        self.name = None
+        self.master = False
+        self.forward = False
+        # canonical absolute name of zone which contains NS records for this
+        # node -> record name relative to the zone as stored in LDAP
+        self.delegated_in = None
+
+
+class DNSZoneTree(object):
+    """
+    Suffix trie of DNS names, labels are stored from the root to the leafs.
+
+    Only active master and forward zones are added to the tree. NS records
+    are added as delegations of the zone which contains them.
+    """
+
+    def __init__(self, usn=None):
+        self.usn = usn
+        # (absolute zone name, forward) of all zones in the tree, names are
+        # compared case-insensitively
+        self.zones = set()
+        # (absolute zone name, relative record name) of all entries with NS
+        # records, including NS records in zone apex
+        self.delegations = set()
+        self._root = _DNSZoneTreeNode()
+
+    @staticmethod
+    def _labels(name):
+        assert isinstance(name, DNSName)
+        # skip the root label, all names in the tree are absolute
+        return reversed(name.make_absolute().canonicalize().labels[:-1])
+
+    def _get_node(self, name, create=False):
+        node = self._root
+        for label in self._labels(name):
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[label] = _DNSZoneTreeNode()
+            node = child
+        return node
+
+    def add_zone(self, name, forward=False):
+        name = name.make_absolute()
+        self.zones.add((name, bool(forward)))
+        node = self._get_node(name, create=True)
+        node.name = name
+        if forward:
+            node.forward = True
+        else:
+            node.master = True
+
+    @staticmethod
+    def _split_record_name(zone, name):
+        """
+        :return: (absolute zone name, relative record name, absolute record
+            name)
+        """
+        zone = zone.make_absolute()
+        if not name.is_absolute():
+            return zone, name, name.derelativize(zone)
+        return zone, name.relativize(zone), name
+
+    def has_delegation(self, zone, name):
+        """
+        Check if record name in zone has NS records in the tree
+        :param name: record name, relative to zone or absolute
+        """
+        zone, relative_name, _name = self._split_record_name(zone, name)
+        return (zone, relative_name) in self.delegations
+
+    def add_delegation(self, zone, name):
+        """
+        :param zone: absolute name of zone containing the NS record
+        :param name: record name, relative to zone or absolute
+        """
+        zone, relative_name, name = self._split_record_name(zone, name)
+        self.delegations.add((zone, relative_name))
+        if name == zone:
+            # NS record in zone apex is not a delegation
+            return
+        node = self._get_node(name, create=True)
+        if node.delegated_in is None:
+            node.delegated_in = {}
+        node.delegated_in[zone.canonicalize()] = relative_name
+
+    def get_auth_zone(self, name):
+        """
+        Find the longest active master zone which contains name
+        :return: absolute zone name or None
+        """
+        node = self._root
+        match = None
+        if node.master:
+            match = node.name
+        for label in self._labels(name):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.master:
+                match = node.name
+        return match
+
+    def get_longest_match_ns_delegation(self, zone, name):
+        """
+        Find the deepest delegation for name in zone, NS records in zone
+        apex are not considered.
+        :param name: absolute name, or name relative to zone
+        :return: delegation name relative to zone or None
+        """
+        zone = zone.make_absolute()
+        if not name.is_absolute():
+            name = name.derelativize(zone)
+        if not name.is_subdomain(zone):
+            return None
+
+        zone_key = zone.canonicalize()
+        node = self._get_node(zone)
+        if node is None:
+            return None
+
+        match = None
+        for label in self._labels(name.relativize(zone)):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.delegated_in and zone_key in node.delegated_in:
+                match = node.delegated_in[zone_key]
+        return match
+
+    def find_subtree_forward_zones(self, name, child_zones_only=False):
+        """
+        Find active forward zone name and all its active child forward zones
+        :return: list of absolute zone names
+        """
+        node = self._get_node(name)
+        if node is None:
+            return []
+
+        result = []
+        start_node = node
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.forward and (
+                    not child_zones_only or node is not start_node):
+                result.append(node.name)
+            stack.extend(node.children.values())
+        return result
+
+
+# maximal number of bind principals with a cached tree
+ZONE_TREE_CACHE_SIZE = 16
+
+# maximal number of changed entries checked before the tree is reloaded
+ZONE_TREE_CHANGES_LIMIT = 100
+
+_zone_tree_cache = collections.OrderedDict()
+_zone_tree_cache_lock = threading.Lock()
+
+
+def _get_active_zones(api):
+    """
+    Search names of all active master and forward zones
+    :return: (set of (absolute zone name, forward), truncated)
+    """
+    ldap = api.Backend.ldap2
+
+    zones_filter = ldap.combine_filters([
+        ldap.make_filter(
+            {'objectclass': ['idnszone', 'idnsforwardzone']}),
+        ldap.make_filter({'idnsZoneActive': 'true'}),
+    ], rules=ldap.MATCH_ALL)
+    try:
+        entries, truncated = ldap.find_entries(
+            filter=zones_filter,
+            attrs_list=['idnsname', 'objectclass'],
+            base_dn=DN(api.env.container_dns, api.env.basedn),
+            scope=ldap.SCOPE_ONELEVEL,
+            paged_search=True, time_limit=0, size_limit=0,
+        )
+    except errors.NotFound:
+        entries, truncated = [], False
+
+    zones = set()
+    for entry in entries:
+        objectclasses = [oc.lower() for oc in entry.get('objectclass', [])]
+        zones.add((
+            entry.single_value['idnsname'].make_absolute(),
+            'idnsforwardzone' in objectclasses,
+        ))
+    return zones, truncated
+
+
+def _is_zone_tree_valid(api, tree):
+    """
+    Check that no record entry relevant to the tree has been added, modified
+    or deleted and that no zone has been added, deleted, activated or
+    deactivated since the tree was loaded or last validated. Other
+    modifications of zone entries are not relevant, the USN of the tree is
+    advanced past them.
+    """
+    ldap = api.Backend.ldap2
+
+    # all changed record and zone entries, live entries and tombstones of
+    # deleted entries
+    changes_filter = ldap.combine_filters([
+        '(entryusn>=%d)' % (tree.usn + 1),
+        ldap.make_filter_from_attr(
+            'objectclass', ['idnsrecord', 'idnsforwardzone', 'nstombstone']),
+    ], rules=ldap.MATCH_ALL)
+
+    try:
+        entries, truncated = ldap.find_entries(
+            filter=changes_filter,
+            attrs_list=['idnsname', 'idnszoneactive', 'nsrecord',
+                        'objectclass', 'entryusn'],
+            base_dn=DN(api.env.container_dns, api.env.basedn),
+            size_limit=ZONE_TREE_CHANGES_LIMIT,
+        )
+    except errors.NotFound:
+        entries, truncated = [], False
+    if truncated:
+        return False
+
+    usn = tree.usn
+    # absolute zone name -> (active, forward) of changed zones, live entries
+    # take precedence over tombstones of zones deleted and added again
+    changed_zones = {}
+    for entry in entries:
+        usn = max(usn, int(entry.single_value.get('entryusn', usn)))
+        objectclasses = {oc.lower() for oc in entry.get('objectclass', [])}
+        name = entry.single_value.get('idnsname')
+        if name is None:
+            # tombstone of other entry than DNS record or zone
+            continue
+        if not objectclasses & {'idnszone', 'idnsforwardzone'}:
+            if 'idnsrecord' not in objectclasses:
+                continue
+            # record entry which has, or had NS records
+            if entry.get('nsrecord'):
+                return False
+            try:
+                zone = DNSName(entry.dn[1]['idnsname'])
+            except (IndexError, KeyError):
+                continue
+            if tree.has_delegation(zone, name):
+                return False
+            continue
+        name = name.make_absolute()
+        if 'nstombstone' in objectclasses:
+            changed_zones.setdefault(name, (False, False))
+        else:
+            active = str(entry.single_value.get(
+                'idnszoneactive', False)).upper() == 'TRUE'
+            changed_zones[name] = (
+                active, 'idnsforwardzone' in objectclasses)
+
+    for name, (active, forward) in changed_zones.items():
+        if active:
+            if (name, forward) not in tree.zones:
+                return False
+        elif (name, False) in tree.zones or (name, True) in tree.zones:
+            return False
+
+    tree.usn = usn
+    return True
+
+
+def _load_zone_tree(api):
+    """
+    Load all zones and NS delegations from LDAP
+    :return: DNSZoneTree or None if results were truncated
+    """
+    ldap = api.Backend.ldap2
+    container_dn = DN(api.env.container_dns, api.env.basedn)
+
+    usn = ldap.get_last_usn()
+    if usn is None:
+        return None
+    tree = DNSZoneTree(usn)
+
+    zones, truncated = _get_active_zones(api)
+    if truncated:
+        return None
+
+    for zone, forward in zones:
+        tree.add_zone(zone, forward=forward)
+
+    delegations_filter = ldap.combine_filters([
+        ldap.make_filter({'objectclass': 'idnsrecord'}),
+        ldap.make_filter({'objectclass': 'idnszone'},
+                         rules=ldap.MATCH_NONE),
+        '(nsrecord=*)',
+    ], rules=ldap.MATCH_ALL)
+    try:
+        entries, truncated = ldap.find_entries(
+            filter=delegations_filter,
+            attrs_list=['idnsname'],
+            base_dn=container_dn,
+            scope=ldap.SCOPE_SUBTREE,
+            paged_search=True, time_limit=0, size_limit=0,
+        )
+    except errors.NotFound:
+        entries, truncated = [], False
+    if truncated:
+        return None
+
+    for entry in entries:
+        try:
+            zone = DNSName(entry.dn[1]['idnsname'])
+        except (IndexError, KeyError):
+            continue
+        tree.add_delegation(zone, entry.single_value['idnsname'])
+
+    return tree
+
+
+def invalidate_zone_tree():
+    """
+    Validate the tree again on the next lookup in the current command,
+    e.g. after the command modified zones or NS records.
+    """
+    context.__dict__.pop('dns_zone_tree', None)
+
+
+def get_zone_tree(api):
+    """
+    Return up-to-date DNSZoneTree for the current bind identity, or None if
+    the tree cannot be used and LDAP has to be searched directly.
+
+    The cache is kept per bind principal, as the content of the tree
+    depends on access rights of the bound user. The tree is validated at
+    most once per command, the validated tree is stored in the request
+    context together with the frame of the command. Lookups outside of a
+    command validate the tree every time.
+    """
+    key = getattr(context, 'principal', None)
+    frame = getattr(context, 'current_frame', None)
+
+    validated = getattr(context, 'dns_zone_tree', None)
+    if (frame is not None and validated is not None and
+            validated[:2] == (key, frame)):
+        return validated[2]
+
+    with _zone_tree_cache_lock:
+        tree = _zone_tree_cache.get(key)
+
+    try:
+        if tree is None or not _is_zone_tree_valid(api, tree):
+            tree = _load_zone_tree(api)
+    except errors.PublicError as e:
+        root_logger.debug("Unable to use cached DNS zone tree: %s", e)
+        tree = None
+
+    with _zone_tree_cache_lock:
+        if tree is None:
+            _zone_tree_cache.pop(key, None)
+        else:
+            _zone_tree_cache.pop(key, None)
+            _zone_tree_cache[key] = tree
+            while len(_zone_tree_cache) > ZONE_TREE_CACHE_SIZE:
+                _zone_tree_cache.popitem(last=False)
+
+    if tree is None or frame is None:
+        invalidate_zone_tree()
+    else:
+        context.dns_zone_tree = (key, frame, tree)
+
+    return tree
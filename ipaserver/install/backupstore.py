@@ -0,0 +1,228 @@
+#
+# Copyright (C) 2016  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Content-addressed storage of incremental backups.
+
+An incremental backup stores the backed up directory as a manifest and a
+set of chunks. Every file is split into chunks which are stored under the
+SHA-256 digest of their content, compressed. Chunks already stored in the
+base backup, or in any of its bases, are not stored again, so an
+incremental backup only contains data which changed since its base.
+
+LDIF files are split on entry boundaries. A boundary is selected by
+a checksum of the entry DN, so adding or removing an entry only changes
+the chunk which contains it. Other files, e.g. the db2bak database files,
+are split into fixed size blocks.
+
+The manifest lists all directories and files of the backed up directory
+with the digests of chunks of each file, which is enough to reconstruct
+the complete directory.
+"""
+
+import hashlib
+import json
+import os
+import zlib
+
+from ipapython import admintool
+
+MANIFEST = 'manifest'
+CHUNKS_DIR = 'chunks'
+MANIFEST_VERSION = 1
+
+# size of chunks of files which are not LDIF
+BLOCK_SIZE = 4 * 1024 * 1024
+# LDIF entry ends a chunk when the lowest bits of the DN checksum are zero,
+# which gives chunks of 64 entries on average
+LDIF_BOUNDARY_MASK = 0x3f
+# maximal size of a LDIF chunk
+LDIF_MAX_CHUNK_SIZE = BLOCK_SIZE
+
+
+def iter_ldif_chunks(fd):
+    """
+    Split LDIF file on entry boundaries
+    """
+    chunk = []
+    size = 0
+    boundary = False
+    for line in fd:
+        if boundary and line.strip() == b'':
+            chunk.append(line)
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+            boundary = False
+            continue
+        if line.lower().startswith(b'dn:'):
+            boundary = (
+                (zlib.crc32(line) & LDIF_BOUNDARY_MASK) == 0 or
+                size >= LDIF_MAX_CHUNK_SIZE)
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield b''.join(chunk)
+
+
+def iter_block_chunks(fd):
+    while True:
+        data = fd.read(BLOCK_SIZE)
+        if not data:
+            break
+        yield data
+
+
+def iter_chunks(path):
+    with open(path, 'rb') as fd:
+        if path.endswith('.ldif'):
+            chunks = iter_ldif_chunks(fd)
+        else:
+            chunks = iter_block_chunks(fd)
+        for chunk in chunks:
+            yield chunk
+
+
+def _chunk_path(chunks_dir, digest):
+    return os.path.join(chunks_dir, digest[:2], digest)
+
+
+def read_manifest(backup_dir):
+    """
+    :returns: manifest of backup_dir, or None if it is not an incremental
+        backup
+    """
+    path = os.path.join(backup_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fd:
+        manifest = json.load(fd)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise admintool.ScriptError(
+            'Unsupported version of backup manifest %s' % path)
+    return manifest
+
+
+def get_backup_chain(backup_dir):
+    """
+    :returns: list of backup directories of backup_dir and all its bases
+    """
+    chain = []
+    while backup_dir is not None:
+        if backup_dir in chain:
+            raise admintool.ScriptError(
+                'Backup %s is its own base' % backup_dir)
+        manifest = read_manifest(backup_dir)
+        if manifest is None:
+            raise admintool.ScriptError(
+                'Base backup %s is not an incremental backup or it does '
+                'not exist' % backup_dir)
+        chain.append(backup_dir)
+        base = manifest.get('base')
+        if base is not None:
+            base = os.path.join(os.path.dirname(backup_dir), base)
+        backup_dir = base
+    return chain
+
+
+def _get_chunk_digests(manifest):
+    digests = set()
+    for item in manifest['files']:
+        digests.update(item.get('chunks', []))
+    return digests
+
+
+def write_backup(source_dir, backup_dir, base_dir=None, log=None):
+    """
+    Store content of source_dir as an incremental backup in backup_dir.
+
+    :param base_dir: backup directory of the base backup. Chunks stored in
+        the base backup are not stored again.
+    :returns: tuple (total size, size of newly stored data)
+    """
+    known = set()
+    base = None
+    if base_dir is not None:
+        # the manifest of the base lists all chunks of the whole chain
+        get_backup_chain(base_dir)
+        known = _get_chunk_digests(read_manifest(base_dir))
+        base = os.path.basename(os.path.normpath(base_dir))
+
+    chunks_dir = os.path.join(backup_dir, CHUNKS_DIR)
+    os.mkdir(chunks_dir, 0o700)
+
+    files = []
+    total = 0
+    stored = 0
+    for root, dirs, filenames in os.walk(source_dir):
+        dirs.sort()
+        relroot = os.path.relpath(root, source_dir)
+        if relroot != os.curdir:
+            files.append(dict(path=relroot, type='dir'))
+        for name in sorted(filenames):
+            path = os.path.join(root, name)
+            digests = []
+            for chunk in iter_chunks(path):
+                digest = hashlib.sha256(chunk).hexdigest()
+                digests.append(digest)
+                total += len(chunk)
+                if digest in known:
+                    continue
+                chunk_path = _chunk_path(chunks_dir, digest)
+                if not os.path.isdir(os.path.dirname(chunk_path)):
+                    os.mkdir(os.path.dirname(chunk_path), 0o700)
+                with open(chunk_path, 'wb') as fd:
+                    fd.write(zlib.compress(chunk))
+                known.add(digest)
+                stored += len(chunk)
+            files.append(dict(path=os.path.relpath(path, source_dir),
+                              type='file', chunks=digests))
+        if log is not None:
+            log.debug('Stored %s', root)
+
+    manifest = dict(version=MANIFEST_VERSION, base=base, files=files)
+    with open(os.path.join(backup_dir, MANIFEST), 'w') as fd:
+        json.dump(manifest, fd)
+
+    return total, stored
+
+
+def restore_backup(backup_dir, dest_dir):
+    """
+    Reconstruct content of incremental backup backup_dir in dest_dir
+    """
+    manifest = read_manifest(backup_dir)
+    if manifest is None:
+        raise admintool.ScriptError(
+            '%s is not an incremental backup' % backup_dir)
+    chunks_dirs = [os.path.join(d, CHUNKS_DIR)
+                   for d in get_backup_chain(backup_dir)]
+
+    def read_chunk(digest):
+        for chunks_dir in chunks_dirs:
+            path = _chunk_path(chunks_dir, digest)
+            if os.path.exists(path):
+                break
+        else:
+            raise admintool.ScriptError(
+                'Chunk %s of backup %s is missing' % (digest, backup_dir))
+        with open(path, 'rb') as fd:
+            data = zlib.decompress(fd.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise admintool.ScriptError(
+                'Chunk %s of backup %s is corrupted' % (digest, backup_dir))
+        return data
+
+    for item in manifest['files']:
+        path = os.path.join(dest_dir, item['path'])
+        if os.path.relpath(path, dest_dir).startswith(os.pardir):
+            raise admintool.ScriptError(
+                'Invalid path %s in backup manifest' % item['path'])
+        if item['type'] == 'dir':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        else:
+            with open(path, 'wb') as fd:
+                for digest in item['chunks']:
+                    fd.write(read_chunk(digest))
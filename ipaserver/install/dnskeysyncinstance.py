@@ -398,6 +398,24 @@ class DNSKeySyncInstance(service.Service):
         finally:
             p11.finalize()
 
+        self.set_token_permissions()
+
+    def set_token_permissions(self):
+        """
+        Make token files accessible by ipa-dnskeysyncd and named
+
+        Token files are created by ipa-dnskeysyncd and ODS later on, the
+        daemons fix permissions of files they create.
+        """
+        if self.named_gid is None:
+            self.named_gid = self.__get_named_gid()
+
+        if self.ods_uid is None:
+            try:
+                self.ods_uid = pwd.getpwnam(constants.ODS_USER).pw_uid
+            except KeyError:
+                raise RuntimeError("OpenDNSSEC UID not found")
+
         # change tokens mod/owner
         self.logger.debug("Changing ownership of token files")
         for (root, dirs, files) in os.walk(paths.DNSSEC_TOKENS_DIR):
@@ -502,4 +520,12 @@ class DNSKeySyncInstance(service.Service):
         except Exception:
             pass
 
+        # remove synchronization state, to make sure new installation will
+        # synchronize all keys
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(paths.IPA_DNSKEYSYNCD_STATE + suffix)
+            except OSError:
+                pass
+
         installutils.remove_keytab(paths.IPA_DNSKEYSYNCD_KEYTAB)
@@ -19,6 +19,7 @@
 
 import os
 import shutil
+import subprocess
 import tempfile
 import time
 import pwd
@@ -32,8 +33,10 @@ from ipapython import version
 from ipapython.ipautil import run, write_tmp_file
 from ipapython import admintool
 from ipapython.dn import DN
+from ipapython.ipa_log_manager import root_logger
 from ipaserver.install.replication import wait_for_task
 from ipaserver.install import installutils
+from ipaserver.install import backupstore
 from ipaserver.session import ISO8601_DATETIME_FMT
 from ipapython import ipaldap
 from ipalib.constants import CACERT
@@ -62,14 +65,14 @@ EOF
 """
 
 
-def encrypt_file(filename, keyring, remove_original=True):
-    source = filename
-    dest = filename + '.gpg'
-
+def get_encrypt_args(keyring):
+    """
+    Return gpg command which encrypts its standard input, or a file given
+    as an additional argument
+    """
     args = [paths.GPG,
             '--batch',
-            '--default-recipient-self',
-            '-o', dest]
+            '--default-recipient-self']
 
     if keyring is not None:
         args.append('--no-default-keyring')
@@ -79,6 +82,77 @@ def encrypt_file(filename, keyring, remove_original=True):
         args.append(keyring + '.sec')
 
     args.append('-e')
+    return args
+
+
+def get_compress_args():
+    """
+    Return command which gzip compresses its standard input. pigz is used
+    when available to compress using all processors.
+    """
+    if os.path.exists(paths.PIGZ):
+        return [paths.PIGZ, '-c']
+    return ['gzip', '-c']
+
+
+def run_pipeline(commands, output):
+    """
+    Run commands connected with pipes, the output of the last one is
+    written to file output. All the commands run in parallel and the data
+    are never stored in an intermediate file.
+
+    :raises ScriptError: when any of the commands fails
+    """
+    processes = []
+    error_logs = []
+    try:
+        with open(output, 'wb') as out:
+            stdin = None
+            for i, args in enumerate(commands):
+                root_logger.debug('Starting external process')
+                root_logger.debug('args=%s' % ' '.join(args))
+                error_log = tempfile.TemporaryFile()
+                error_logs.append(error_log)
+                if i == len(commands) - 1:
+                    stdout = out
+                else:
+                    stdout = subprocess.PIPE
+                p = subprocess.Popen(args, stdin=stdin, stdout=stdout,
+                                     stderr=error_log, close_fds=True)
+                if stdin is not None:
+                    # only the next process reads the pipe
+                    stdin.close()
+                stdin = p.stdout
+                processes.append(p)
+
+            for p in processes:
+                p.wait()
+    finally:
+        for p in processes:
+            if p.returncode is None:
+                p.kill()
+                p.wait()
+
+    failures = []
+    for args, p, error_log in zip(commands, processes, error_logs):
+        error_log.seek(0)
+        error = error_log.read()
+        error_log.close()
+        root_logger.debug('Process %s finished, return code=%s',
+                          args[0], p.returncode)
+        if p.returncode != 0:
+            failures.append('%s returned non-zero code %d: %s' %
+                            (os.path.basename(args[0]), p.returncode, error))
+    if failures:
+        raise admintool.ScriptError('; '.join(failures))
+
+
+def encrypt_file(filename, keyring, remove_original=True):
+    source = filename
+    dest = filename + '.gpg'
+
+    args = get_encrypt_args(keyring)
+    args[-1:-1] = ['-o', dest]
     args.append(source)
 
     result = run(args, raiseonerr=False)
@@ -220,6 +294,12 @@ class Backup(admintool.AdminTool):
             default=False, help="Include log files in backup")
         parser.add_option("--online", dest="online", action="store_true",
             default=False, help="Perform the LDAP backups online, for data only.")
+        parser.add_option("--incremental", dest="incremental",
+            action="store_true", default=False,
+            help="Store only data which changed since the base backup")
+        parser.add_option("--base", dest="base",
+            help="The base of incremental backup. The most recent "
+                 "incremental backup is used by default.")
 
 
     def setup_logging(self, log_file_mode='a'):
@@ -250,6 +330,24 @@ class Backup(admintool.AdminTool):
             self.option_parser.error("You cannot specify --data "
                 "with --logs")
 
+        if options.base and not options.incremental:
+            self.option_parser.error("You cannot specify --base "
+                "without --incremental")
+
+        if options.incremental:
+            if options.gpg:
+                self.option_parser.error("You cannot specify --gpg "
+                    "with --incremental")
+            if options.base:
+                if not os.path.isabs(options.base):
+                    options.base = os.path.join(paths.IPA_BACKUP_DIR,
+                                                options.base)
+                if backupstore.read_manifest(options.base) is None:
+                    self.option_parser.error(
+                        "%s is not an incremental backup" % options.base)
+            else:
+                options.base = self.find_base_backup()
+
 
     def run(self):
         options = self.options
@@ -305,7 +403,9 @@ class Backup(admintool.AdminTool):
                 auth_backup_path = os.path.join(paths.VAR_LIB_IPA, 'auth_backup')
                 tasks.backup_auth_configuration(auth_backup_path)
                 self.file_backup(options)
-            self.finalize_backup(options.data_only, options.gpg, options.gpg_keyring)
+            self.finalize_backup(options.data_only, options.gpg,
+                                 options.gpg_keyring, options.incremental,
+                                 options.base)
 
             if options.data_only:
                 if not options.online:
@@ -476,6 +576,7 @@ class Backup(admintool.AdminTool):
         self.log.info("Backing up files")
         args = ['tar',
                 '--exclude=/var/lib/ipa/backup',
+                '--exclude=%s*' % paths.IPA_DNSKEYSYNCD_STATE,
                 '--xattrs',
                 '--selinux',
                 '-cf',
@@ -501,6 +602,7 @@ class Backup(admintool.AdminTool):
         if missing_directories:
             args = ['tar',
                     '--exclude=/var/lib/ipa/backup',
+                    '--exclude=%s*' % paths.IPA_DNSKEYSYNCD_STATE,
                     '--xattrs',
                     '--selinux',
                     '--no-recursion',
@@ -516,17 +618,30 @@ class Backup(admintool.AdminTool):
                     'when adding directory structure: %s' %
                     (result.returncode, result.error_log))
 
-        # Compress the archive. This is done separately, since 'tar' cannot
-        # append to a compressed archive.
-        result = run(['gzip', tarfile], raiseonerr=False)
-        if result.returncode != 0:
-            raise admintool.ScriptError(
-                'gzip returned non-zero code %d '
-                'when compressing the backup: %s' %
-                (result.returncode, result.error_log))
+        # The archive is not compressed here, it is compressed only once
+        # as a part of the final backup archive. Until then it is stored
+        # uncompressed in the temporary directory, which needs free space
+        # for the full size of the backed up files.
+
+
+    def find_base_backup(self):
+        '''
+        Find the most recent incremental backup.
 
-        # Rename the archive back to files.tar to preserve compatibility
-        os.rename(os.path.join(self.dir, 'files.tar.gz'), tarfile)
+        :returns: backup directory or None if there is no incremental backup
+        '''
+        base = None
+        base_mtime = None
+        for name in os.listdir(paths.IPA_BACKUP_DIR):
+            backup_dir = os.path.join(paths.IPA_BACKUP_DIR, name)
+            manifest = os.path.join(backup_dir, backupstore.MANIFEST)
+            if not os.path.exists(manifest):
+                continue
+            mtime = os.path.getmtime(manifest)
+            if base is None or mtime > base_mtime:
+                base = backup_dir
+                base_mtime = mtime
+        return base
 
 
     def create_header(self, data_only):
@@ -564,7 +679,8 @@ class Backup(admintool.AdminTool):
             config.write(fd)
 
 
-    def finalize_backup(self, data_only=False, encrypt=False, keyring=None):
+    def finalize_backup(self, data_only=False, encrypt=False, keyring=None,
+                        incremental=False, base=None):
         '''
         Create the final location of the backup files and move the files
         we've backed up there, optionally encrypting them.
@@ -575,6 +691,13 @@ class Backup(admintool.AdminTool):
 
         These, along with the header, are moved into a new subdirectory
         in /var/lib/ipa/backup.
+
+        The archive is created, compressed and encrypted in a single pass
+        by a pipeline of tar, gzip (or pigz) and gpg. The files tarball is
+        read from the temporary directory, where it is stored uncompressed.
+
+        Incremental backups are not archived, the files are stored as
+        chunks which are not already stored in the base backup.
         '''
 
         if data_only:
@@ -587,23 +710,32 @@ class Backup(admintool.AdminTool):
         os.mkdir(backup_dir)
         os.chmod(backup_dir, 0o700)
 
-        os.chdir(self.dir)
+        if incremental:
+            if base is not None:
+                self.log.info('Storing incremental backup based on %s', base)
+            total, stored = backupstore.write_backup(
+                self.dir, backup_dir, base, log=self.log)
+            self.log.info('Stored %d of %d bytes of backed up data',
+                          stored, total)
+            shutil.move(self.header, backup_dir)
+            self.log.info('Backed up to %s', backup_dir)
+            return
+
         args = ['tar',
                 '--xattrs',
                 '--selinux',
-                '-czf',
-                filename,
+                '-C', self.dir,
+                '-cf', '-',
                 '.'
                ]
-        result = run(args, raiseonerr=False)
-        if result.returncode != 0:
-            raise admintool.ScriptError(
-                'tar returned non-zero code %s: %s' %
-                (result.returncode, result.error_log))
+        commands = [args, get_compress_args()]
 
         if encrypt:
+            filename = filename + '.gpg'
             self.log.info('Encrypting %s' % filename)
-            filename = encrypt_file(filename, keyring)
+            commands.append(get_encrypt_args(keyring))
+
+        run_pipeline(commands, filename)
 
         shutil.move(self.header, backup_dir)
 
@@ -19,10 +19,14 @@
 
 import abc
 import base64
+import contextlib
 import datetime
 import hashlib
 import hmac
+import itertools
+from multiprocessing.pool import ThreadPool
 import os
+import time
 import uuid
 import struct
 
@@ -37,11 +41,17 @@ from six.moves import xrange
 from ipapython import admintool
 from ipalib import api, errors
 from ipaserver.plugins.ldap2 import AUTOBIND_DISABLED
+from ipaserver.plugins.otptoken import prepare_token_entry
 
 if six.PY3:
     unicode = str
     long = int
 
+# number of key packages processed at once in bulk mode
+BULK_BATCH_SIZE = 1000
+# default number of threads decrypting key packages in bulk mode
+BULK_WORKERS = 4
+
 
 class ValidationError(Exception):
     pass
@@ -335,6 +345,9 @@ class PSKCKeyPackage(object):
     def remove(self):
         self.__element.getparent().remove(self.__element)
 
+    def write(self, xf):
+        xf.write(self.__element)
+
     def __process(self):
         # Parse and validate.
         data = self.__parse(self.__decryptor, self.__element, ".", self._XML)
@@ -412,57 +425,118 @@ class PSKCKeyPackage(object):
             out['ipatoken' + key] = unicode(reducer(dates).strftime("%Y%m%d%H%M%SZ"))
 
 
-class PSKCDocument(object):
+class PSKCKeyContainer(object):
+    "Encryption and MAC parameters of a PSKC KeyContainer."
+
     @property
     def keyname(self):
-        return self.__keyname
+        return self._keyname
 
-    def __init__(self, filename):
-        self.__keyname = None
-        self.__decryptor = None
-        self.__doc = etree.parse(filename)
-        self.__mkey = fetch(self.__doc, "./pskc:MACMethod/pskc:MACKey")
-        self.__algo = fetch(self.__doc, "./pskc:MACMethod/@Algorithm", convertHMACType)
+    def __init__(self):
+        self._keyname = None
+        self._decryptor = None
+        self._mkey = None
+        self._algo = None
+        self._enckey = None
 
-        self.__keypackages = fetchAll(self.__doc, "./pskc:KeyPackage")
-        if not self.__keypackages:
-            raise ValueError("PSKC file is invalid!")
+    def _load_header(self, root):
+        self._mkey = fetch(root, "./pskc:MACMethod/pskc:MACKey")
+        self._algo = fetch(root, "./pskc:MACMethod/@Algorithm", convertHMACType)
 
-        self.__enckey = fetch(self.__doc, "./pskc:EncryptionKey")
-        if self.__enckey is not None:
+        self._enckey = fetch(root, "./pskc:EncryptionKey")
+        if self._enckey is not None:
             # Check for x509 key.
-            x509key = fetch(self.__enckey, "./ds:X509Data")
+            x509key = fetch(self._enckey, "./ds:X509Data")
             if x509key is not None:
                 raise NotImplementedError("X.509 keys are not currently supported!")
 
             # Get the keyname.
-            self.__keyname = fetch(self.__enckey, "./ds:KeyName/text()")
-            if self.__keyname is None:
-                self.__keyname = fetch(self.__enckey,
-                                       "./xenc11:DerivedKey/xenc11:MasterKeyName/text()")
+            self._keyname = fetch(self._enckey, "./ds:KeyName/text()")
+            if self._keyname is None:
+                self._keyname = fetch(self._enckey,
+                                      "./xenc11:DerivedKey/xenc11:MasterKeyName/text()")
 
     def setKey(self, key):
         # Derive the enckey if required.
-        kd = fetch(self.__enckey,
+        kd = fetch(self._enckey,
                    "./xenc11:DerivedKey/xenc11:KeyDerivationMethod/@Algorithm",
                    convertKeyDerivation)
         if kd is not None:
-            key = kd(self.__enckey).derive(key)
+            key = kd(self._enckey).derive(key)
 
         # Load the decryptor.
-        self.__decryptor = XMLDecryptor(key)
-        if self.__mkey is not None and self.__algo is not None:
-            tmp = hmac.HMAC(self.__decryptor(self.__mkey), digestmod=self.__algo)
-            self.__decryptor = XMLDecryptor(key, tmp)
+        self._decryptor = XMLDecryptor(key)
+        if self._mkey is not None and self._algo is not None:
+            tmp = hmac.HMAC(self._decryptor(self._mkey), digestmod=self._algo)
+            self._decryptor = XMLDecryptor(key, tmp)
+
+
+class PSKCDocument(PSKCKeyContainer):
+    def __init__(self, filename):
+        super(PSKCDocument, self).__init__()
+        self.__doc = etree.parse(filename)
+
+        self.__keypackages = fetchAll(self.__doc, "./pskc:KeyPackage")
+        if not self.__keypackages:
+            raise ValueError("PSKC file is invalid!")
+
+        self._load_header(self.__doc.getroot())
 
     def getKeyPackages(self):
         for kp in self.__keypackages:
-            yield PSKCKeyPackage(kp, self.__decryptor)
+            yield PSKCKeyPackage(kp, self._decryptor)
 
     def save(self, dest):
         self.__doc.write(dest)
 
 
+class PSKCStream(PSKCKeyContainer):
+    """Reads a PSKC file incrementally.
+
+    Only the KeyContainer header is parsed up front, key packages are parsed
+    while they are iterated. Each key package stays in memory until its
+    remove() method is called.
+    """
+    KEYPACKAGE = '{urn:ietf:params:xml:ns:keyprov:pskc}KeyPackage'
+
+    def __init__(self, filename):
+        super(PSKCStream, self).__init__()
+        self.__root = None
+        self.__events = etree.iterparse(filename, events=('start', 'end'))
+
+        # Everything preceding the first key package is the header.
+        for event, element in self.__events:
+            if self.__root is None:
+                self.__root = element
+            elif (event == 'start' and element.tag == self.KEYPACKAGE and
+                    element.getparent() is self.__root):
+                break
+        else:
+            raise ValueError("PSKC file is invalid!")
+
+        self.__header = list(self.__root)[:-1]
+        self._load_header(self.__root)
+
+    def getKeyPackages(self):
+        for event, element in self.__events:
+            if (event == 'end' and element.tag == self.KEYPACKAGE and
+                    element.getparent() is self.__root):
+                yield PSKCKeyPackage(element, self._decryptor)
+
+    @contextlib.contextmanager
+    def writer(self, dest):
+        """Write a PSKC file with the header of this file to dest.
+
+        Yields a function which appends a key package to the file.
+        """
+        with etree.xmlfile(dest) as xf:
+            with xf.element(self.__root.tag, dict(self.__root.attrib),
+                            nsmap=self.__root.nsmap):
+                for element in self.__header:
+                    xf.write(element)
+                yield lambda keypkg: keypkg.write(xf)
+
+
 class OTPTokenImport(admintool.AdminTool):
     command_name = 'ipa-otptoken-import'
     description = "Import OTP tokens."
@@ -482,14 +556,28 @@ class OTPTokenImport(admintool.AdminTool):
 
         parser.add_option("-k", "--keyfile", dest="keyfile",
                           help="File containing the key used to decrypt token secrets")
+        parser.add_option("--bulk", dest="bulk", action="store_true",
+                          default=False,
+                          help="Read the PSKC file as a stream and add tokens "
+                               "in batches, suitable for large files")
+        parser.add_option("--workers", dest="workers", type="int",
+                          default=BULK_WORKERS,
+                          help="Number of threads decrypting tokens in bulk "
+                               "mode (default: %d)" % BULK_WORKERS)
 
     def validate_options(self):
         super(OTPTokenImport, self).validate_options()
 
+        if self.safe_options.workers < 1:  # pylint: disable=no-member
+            raise admintool.ScriptError("Number of workers must be positive!")
+
         # Parse the file.
         if len(self.args) < 1:
             raise admintool.ScriptError("Import file required!")
-        self.doc = PSKCDocument(self.args[0])
+        if self.safe_options.bulk:  # pylint: disable=no-member
+            self.doc = PSKCStream(self.args[0])
+        else:
+            self.doc = PSKCDocument(self.args[0])
 
         # Get the output file.
         if len(self.args) < 2:
@@ -519,6 +607,10 @@ class OTPTokenImport(admintool.AdminTool):
             raise admintool.ScriptError("Unable to connect to LDAP! Did you kinit?")
 
         try:
+            if self.safe_options.bulk:  # pylint: disable=no-member
+                self.bulk_import()
+                return
+
             # Parse tokens
             for keypkg in self.doc.getKeyPackages():
                 try:
@@ -533,3 +625,104 @@ class OTPTokenImport(admintool.AdminTool):
 
         # Write out the XML file without the tokens that succeeded.
         self.doc.save(self.output)
+
+    def bulk_import(self):
+        """Import the tokens of a PSKC stream in batches.
+
+        Key packages are decrypted by a pool of worker threads and the token
+        entries are written through pipelined LDAP adds. Tokens which could
+        not be imported are written to the output file.
+        """
+        ldap = api.Backend.ldap2
+        self._current_user = None
+        self._owners = {}
+
+        added = failed = 0
+        start = time.time()
+        keypkgs = self.doc.getKeyPackages()
+        pool = ThreadPool(self.safe_options.workers)  # pylint: disable=no-member
+        try:
+            with self.doc.writer(self.output) as save:
+                while True:
+                    batch = list(itertools.islice(keypkgs, BULK_BATCH_SIZE))
+                    if not batch:
+                        break
+
+                    tokens = []
+                    for keypkg, (params, error) in zip(
+                            batch, pool.map(self._prepare_token, batch)):
+                        if error is None:
+                            try:
+                                tokens.append(
+                                    (keypkg, self._make_token_entry(*params)))
+                                continue
+                            except Exception as e:
+                                error = e
+                        self.log.warning("Error adding token: %s", error)
+                        save(keypkg)
+                        failed += 1
+
+                    entries = [entry for _keypkg, entry in tokens]
+                    for (keypkg, entry), (_entry, error) in zip(
+                            tokens, ldap.add_entries(entries)):
+                        if error is not None:
+                            self.log.warning("Error adding token: %s", error)
+                            save(keypkg)
+                            failed += 1
+                        else:
+                            self.log.debug("Added token: %s", keypkg.id)
+                            added += 1
+
+                    # The key packages are not needed any more, drop them
+                    # to keep memory usage bounded.
+                    for keypkg in batch:
+                        keypkg.remove()
+
+                    self.log.info(
+                        "Processed %d tokens: %d added, %d failed "
+                        "(%.1f tokens/s)", added + failed, added, failed,
+                        (added + failed) / max(time.time() - start, 0.001))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _prepare_token(self, keypkg):
+        """Decrypt a key package and convert it to otptoken_add parameters.
+
+        Runs in a worker thread, returns a ``((args, options), error)``
+        tuple.
+        """
+        cmd = api.Command.otptoken_add
+        try:
+            params = cmd.args_options_2_params(keypkg.id, **keypkg.options)
+            params.update(cmd.get_default(**params))
+            params = cmd.normalize(**params)
+            params = cmd.convert(**params)
+            cmd.validate(**params)
+            return cmd.params_2_args_options(**params), None
+        except Exception as e:
+            return None, e
+
+    def _find_current_user(self):
+        if self._current_user is None:
+            result = api.Command.user_find(
+                whoami=True, no_members=False)['result']
+            self._current_user = result[0] if result else {}
+        return self._current_user
+
+    def _make_token_entry(self, args, options):
+        """Build the LDAP entry otptoken_add would create for a token.
+
+        The owner and the current user are looked up once for all tokens.
+        """
+        ldap = api.Backend.ldap2
+        cmd = api.Command.otptoken_add
+        otptoken = api.Object.otptoken
+
+        entry = ldap.make_entry(otptoken.get_dn(*args),
+                                cmd.args_options_2_entry(*args, **options))
+        prepare_token_entry(api, entry,
+                            find_current_user=self._find_current_user,
+                            owners=self._owners, **options)
+
+        return entry
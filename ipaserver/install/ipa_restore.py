@@ -17,7 +17,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import collections
+import io
+import multiprocessing
 import os
+import re
 import shutil
 import tempfile
 import time
@@ -39,6 +43,7 @@ from ipaserver.install.replication import (wait_for_task, ReplicationManager,
                                            get_cs_replication_manager)
 from ipaserver.install import installutils
 from ipaserver.install import dsinstance, httpinstance, cainstance
+from ipaserver.install import backupstore
 from ipapython import ipaldap
 import ipapython.errors
 from ipaplatform.constants import constants
@@ -95,30 +100,133 @@ def decrypt_file(tmpdir, filename, keyring):
     return dest
 
 
-class RemoveRUVParser(ldif.LDIFParser):
-    def __init__(self, input_file, writer, logger):
-        ldif.LDIFParser.__init__(self, input_file)
-        self.writer = writer
-        self.log = logger
+RUV_UNIQUEID = 'ffffffff-ffffffff-ffffffff-ffffffff'
+# entries which may be RUV entries are found by searching for the RUV
+# unique ID, only those are parsed
+_RUV_CANDIDATE_RE = re.compile(RUV_UNIQUEID.encode('ascii'), re.IGNORECASE)
 
-    def handle(self, dn, entry):
-        objectclass = None
-        nsuniqueid = None
+# size of LDIF data processed at once by remove_ruv_entries()
+LDIF_CHUNK_SIZE = 8 * 1024 * 1024
 
-        for name, value in entry.items():
-            name = name.lower()
-            if name == 'objectclass':
-                objectclass = [x.lower() for x in value]
-            elif name == 'nsuniqueid':
-                nsuniqueid = [x.lower() for x in value]
 
-        if (objectclass and nsuniqueid and
-            'nstombstone' in objectclass and
-            'ffffffff-ffffffff-ffffffff-ffffffff' in nsuniqueid):
-            self.log.debug("Removing RUV entry %s", dn)
-            return
+def is_ruv_entry(dn, entry):
+    objectclass = None
+    nsuniqueid = None
+
+    for name, value in entry.items():
+        name = name.lower()
+        if name == 'objectclass':
+            objectclass = [x.lower() for x in value]
+        elif name == 'nsuniqueid':
+            nsuniqueid = [x.lower() for x in value]
+
+    return bool(objectclass and nsuniqueid and
+                'nstombstone' in objectclass and
+                RUV_UNIQUEID in nsuniqueid)
+
 
-        self.writer.unparse(dn, entry)
+def _is_ruv_candidate(data):
+    if _RUV_CANDIDATE_RE.search(data):
+        return True
+    # the unique ID may be folded onto continuation lines
+    return (b'\n ' in data and
+            _RUV_CANDIDATE_RE.search(data.replace(b'\n ', b'')) is not None)
+
+
+def _remove_ruv_entries_from_chunk(data):
+    """
+    Remove RUV entries from LDIF data which contain complete entries
+    separated by empty lines.
+
+    :returns: tuple (filtered data, DNs of removed entries)
+    """
+    if not _is_ruv_candidate(data):
+        return data, []
+
+    removed = []
+    kept = []
+    for block in data.split(b'\n\n'):
+        if _is_ruv_candidate(block):
+            parser = ldif.LDIFRecordList(io.BytesIO(block + b'\n'))
+            parser.parse()
+            if parser.all_records and all(is_ruv_entry(dn, entry)
+                                          for dn, entry in parser.all_records):
+                removed.extend(dn for dn, entry in parser.all_records)
+                continue
+        kept.append(block)
+
+    data = b'\n\n'.join(kept)
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+    return data, removed
+
+
+def _iter_ldif_chunks(in_file, chunk_size):
+    """
+    Split LDIF file into chunks of complete entries
+    """
+    buf = b''
+    while True:
+        data = in_file.read(chunk_size)
+        if not data:
+            break
+        buf += data
+        end = buf.rfind(b'\n\n')
+        if end < 0:
+            continue
+        yield buf[:end + 2]
+        buf = buf[end + 2:]
+    if buf:
+        yield buf
+
+
+def remove_ruv_entries(in_file, out_file, log, processes=1):
+    """
+    Copy LDIF file without the RUV entries.
+
+    The file is not parsed. It is split into chunks on entry boundaries and
+    only entries which contain the RUV unique ID are parsed. With more than
+    one process the chunks are filtered in parallel, the output keeps the
+    order of the input.
+    """
+    # the blank line ending a chunk is written with the next data, so that
+    # it is not left at the end of the file when the last entry is removed
+    separator = [b'']
+
+    def write(result):
+        data, removed = result
+        for dn in removed:
+            log.debug("Removing RUV entry %s", dn)
+        if not data:
+            return
+        out_file.write(separator[0])
+        if data.endswith(b'\n\n'):
+            data, separator[0] = data[:-1], b'\n'
+        else:
+            separator[0] = b''
+        out_file.write(data)
+
+    chunks = _iter_ldif_chunks(in_file, LDIF_CHUNK_SIZE)
+
+    if processes <= 1:
+        for chunk in chunks:
+            write(_remove_ruv_entries_from_chunk(chunk))
+        return
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(
+                pool.apply_async(_remove_ruv_entries_from_chunk, (chunk,)))
+            # limit the amount of data held in memory
+            if len(pending) >= processes * 2:
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 class Restore(admintool.AdminTool):
@@ -380,11 +488,19 @@ class Restore(admintool.AdminTool):
                     create_ca_user()
                 self.cert_restore_prepare()
                 self.file_restore(options.no_logs)
+                self.remove_dnskeysyncd_state()
                 self.cert_restore()
                 if 'CA' in self.backup_services:
                     self.__create_dogtag_log_dirs()
                 if http.is_kdcproxy_configured():
                     httpinstance.create_kdcproxy_user()
+            else:
+                # the syncrepl state does not match the restored data
+                dnskeysyncd = services.service('ipa-dnskeysyncd')
+                dnskeysyncd_running = dnskeysyncd.is_running()
+                if dnskeysyncd_running:
+                    dnskeysyncd.stop(capture_output=False)
+                self.remove_dnskeysyncd_state()
 
             # Always restore the data from ldif
             # We need to restore both userRoot and ipaca.
@@ -395,6 +511,8 @@ class Restore(admintool.AdminTool):
                 if not options.online:
                     self.log.info('Starting Directory Server')
                     dirsrv.start(capture_output=False)
+                if dnskeysyncd_running:
+                    dnskeysyncd.start(capture_output=False)
             else:
                 # restore access controll configuration
                 auth_backup_path = os.path.join(paths.VAR_LIB_IPA, 'auth_backup')
@@ -536,11 +654,14 @@ class Restore(admintool.AdminTool):
             os.chown(ldifdir, pent.pw_uid, pent.pw_gid)
 
         ipautil.backup_file(ldiffile)
+        if os.path.getsize(srcldiffile) > LDIF_CHUNK_SIZE:
+            processes = multiprocessing.cpu_count()
+        else:
+            processes = 1
         with open(ldiffile, 'wb') as out_file:
-            ldif_writer = ldif.LDIFWriter(out_file)
             with open(srcldiffile, 'rb') as in_file:
-                ldif_parser = RemoveRUVParser(in_file, ldif_writer, self.log)
-                ldif_parser.parse()
+                remove_ruv_entries(in_file, out_file, self.log,
+                                   processes=processes)
 
         if online:
             conn = self.get_connection()
@@ -645,7 +766,7 @@ class Restore(admintool.AdminTool):
         args = ['tar',
                 '--xattrs',
                 '--selinux',
-                '-xzf',
+                '-xf',
                 os.path.join(self.dir, 'files.tar'),
                 paths.IPA_DEFAULT_CONF[1:],
                ]
@@ -676,6 +797,22 @@ class Restore(admintool.AdminTool):
                 if e.errno != 2:  # 2: file does not exist
                     self.log.warning("Could not remove file: %s (%s)", f, e)
 
+    def remove_dnskeysyncd_state(self):
+        """
+        Remove the syncrepl state of ipa-dnskeysyncd. The stored cookie and
+        entries do not match the restored data, so the daemon has to start
+        with a full refresh. Backups created by older versions contain the
+        state file.
+        """
+        for suffix in ('', '-wal', '-shm'):
+            filename = paths.IPA_DNSKEYSYNCD_STATE + suffix
+            try:
+                os.remove(filename)
+            except OSError as e:
+                if e.errno != 2:  # 2: file does not exist
+                    self.log.warning("Could not remove file: %s (%s)",
+                                     filename, e)
+
     def file_restore(self, nologs=False):
         '''
         Restore all the files in the tarball.
@@ -686,10 +823,12 @@ class Restore(admintool.AdminTool):
         self.log.info("Restoring files")
         cwd = os.getcwd()
         os.chdir('/')
+        # files.tar is compressed in backups created by older versions,
+        # tar detects the compression automatically
         args = ['tar',
                 '--xattrs',
                 '--selinux',
-                '-xzf',
+                '-xf',
                 os.path.join(self.dir, 'files.tar')
                ]
         if nologs:
@@ -724,8 +863,20 @@ class Restore(admintool.AdminTool):
         '''
         Extract the contents of the tarball backup into a temporary location,
         decrypting if necessary.
+
+        Incremental backups are reconstructed from the chunks stored in the
+        backup and its base backups.
         '''
 
+        if backupstore.read_manifest(self.backup_dir) is not None:
+            self.log.info('Reconstructing incremental backup')
+            backupstore.restore_backup(self.backup_dir, self.dir)
+
+            pent = pwd.getpwnam(constants.DS_USER)
+            os.chown(self.top_dir, pent.pw_uid, pent.pw_gid)
+            recursive_chown(self.dir, pent.pw_uid, pent.pw_gid)
+            return
+
         encrypt = False
         filename = None
         if self.backup_type == 'FULL':
@@ -20,7 +20,9 @@ class ServerUpgrade(admintool.AdminTool):
         super(ServerUpgrade, cls).add_options(parser)
         parser.add_option("--force", action="store_true",
                           dest="force", default=False,
-                          help="force upgrade (alias for --skip-version-check)")
+                          help="force upgrade (alias for --skip-version-check,"
+                               " also applies update files which were "
+                               "already applied)")
         parser.add_option("--skip-version-check", action="store_true",
                           dest="skip_version_check", default=False,
                           help="skip version check. WARNING: this may break "
@@ -43,7 +45,7 @@ class ServerUpgrade(admintool.AdminTool):
 
         try:
             server.upgrade_check(self.options)
-            server.upgrade()
+            server.upgrade(force=self.options.force)
         except RuntimeError as e:
             raise admintool.ScriptError(str(e))
 
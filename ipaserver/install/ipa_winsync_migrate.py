@@ -18,13 +18,17 @@
 #
 
 import gssapi
+import itertools
+from multiprocessing.pool import ThreadPool
 import sys
+import time
 
 import six
 
 from ipalib import api
 from ipalib import errors
-from ipapython import admintool
+from ipaplatform.paths import paths
+from ipapython import admintool, sysrestore
 from ipapython.dn import DN
 from ipapython.ipautil import realm_to_suffix, posixify
 from ipaserver.install import replication, installutils
@@ -34,6 +38,13 @@ if six.PY3:
 
 DEFAULT_TRUST_VIEW_NAME = u'Default Trust View'
 
+# number of users migrated in one batch
+MIGRATION_BATCH_SIZE = 500
+# default number of threads creating ID overrides
+MIGRATION_WORKERS = 4
+
+STATEFILE_FILE = 'winsync-migrate.state'
+
 
 class WinsyncMigrate(admintool.AdminTool):
     """
@@ -72,16 +83,29 @@ class WinsyncMigrate(admintool.AdminTool):
             action="store_false",
             default=True,
             help="Never prompt for user input")
+        parser.add_option(
+            "--workers",
+            dest="workers",
+            type="int",
+            default=MIGRATION_WORKERS,
+            help="Number of threads creating ID overrides (default: %d)"
+                 % MIGRATION_WORKERS)
 
     def validate_options(self):
         """
         Validates the options passed by the user:
             - Checks that trust has been established with
               the realm passed via --realm option
+            - Checks that the winsync agreement exists, unless an
+              interrupted migration from the given server is resumed
         """
 
         super(WinsyncMigrate, self).validate_options(needs_root=True)
 
+        if self.options.workers < 1:
+            raise admintool.ScriptError(
+                "Number of workers must be positive.")
+
         if self.options.realm is None:
             raise admintool.ScriptError(
                 "AD realm the winsynced users belong to needs to be "
@@ -99,10 +123,28 @@ class WinsyncMigrate(admintool.AdminTool):
                     "An error occured during detection of the established "
                     "trust with %s: %s" % (self.options.realm, str(e)))
 
+        self.sstore = sysrestore.StateFile(paths.STATEFILE_DIR,
+                                           STATEFILE_FILE)
+        self.resume = False
+
         if self.options.server is None:
             raise admintool.ScriptError(
                 "The AD DC the winsync agreement is established with "
                 "needs to be specified.")
+        elif self.sstore.has_state('winsync_migrate'):
+            # The agreement was already deleted by an interrupted migration
+            server = self.sstore.get_state('winsync_migrate', 'server')
+            realm = self.sstore.get_state('winsync_migrate', 'realm')
+            if (server != self.options.server or
+                    realm != self.options.realm):
+                raise admintool.ScriptError(
+                    "An interrupted migration of %s users from %s was "
+                    "found, please finish it first." % (realm, server))
+            self.resume = True
+            self.manager = replication.ReplicationManager(
+                api.env.realm,
+                api.env.host,
+                None)  # Use GSSAPI instead of raw directory manager access
         else:
             # Validate the replication agreement between given host and localhost
             try:
@@ -134,10 +176,17 @@ class WinsyncMigrate(admintool.AdminTool):
         """
         Deletes the winsync agreement between the current master and the
         given AD server.
+
+        Parts which were already deleted by an interrupted migration are
+        skipped.
         """
 
         try:
-            self.manager.delete_agreement(self.options.server)
+            try:
+                self.manager.delete_agreement(self.options.server)
+            except errors.NotFound:
+                if not self.resume:
+                    raise
             self.manager.delete_referral(self.options.server)
 
             dn = DN(('cn', self.options.server),
@@ -145,8 +194,13 @@ class WinsyncMigrate(admintool.AdminTool):
                     ('cn', 'ipa'),
                     ('cn', 'etc'),
                     realm_to_suffix(api.env.realm))
-            entries = self.manager.conn.get_entries(dn,
-                                                    self.ldap.SCOPE_SUBTREE)
+            try:
+                entries = self.manager.conn.get_entries(
+                    dn, self.ldap.SCOPE_SUBTREE)
+            except errors.NotFound:
+                if not self.resume:
+                    raise
+                entries = []
             if entries:
                 entries.sort(key=len, reverse=True)
                 for entry in entries:
@@ -157,9 +211,18 @@ class WinsyncMigrate(admintool.AdminTool):
                 "Deletion of the winsync agreement failed: %s" % str(e))
 
 
+    def connect_worker(self):
+        """
+        Connects the LDAP backend in a worker thread of the pool creating
+        ID overrides.
+        """
+        api.Backend.ldap2.connect()
+
     def create_id_user_override(self, entry):
         """
         Creates ID override corresponding to this user entry.
+
+        Runs in a worker thread.
         """
 
         user_identifier = u"%s@%s" % (entry['uid'][0], self.options.realm)
@@ -179,29 +242,87 @@ class WinsyncMigrate(admintool.AdminTool):
                 **kwargs
             )
         except Exception as e:
-            self.log.warning("Migration failed: %s (%s)"
-                             % (user_identifier, str(e)))
+            if self.resume and isinstance(e, errors.DuplicateEntry):
+                # created before the migration was interrupted
+                self.log.debug("Already migrated: %s" % user_identifier)
+            else:
+                self.log.warning("Migration failed: %s (%s)"
+                                 % (user_identifier, str(e)))
         else:
             self.log.debug("Migrated: %s" % user_identifier)
 
     def find_winsync_users(self):
         """
         Finds all users that were mirrored from AD using winsync.
+
+        This is a generator, users are read from LDAP page by page.
         """
 
         user_filter = "(&(objectclass=ntuser)(ntUserDomainId=*))"
         user_base = DN(api.env.container_user, api.env.basedn)
-        entries, _truncated = self.ldap.find_entries(
+        entries = self.ldap.iter_entries(
             filter=user_filter,
-            base_dn=user_base,
-            paged_search=True)
+            attrs_list=['uid', 'uidnumber', 'gidnumber', 'gecos',
+                        'loginshell', 'memberof'],
+            base_dn=user_base)
 
         for entry in entries:
             self.log.debug("Discovered entry: %s" % entry)
+            yield entry
 
-        return entries
+    def get_group_memberof(self, group_dns):
+        """
+        Returns dict of sets of DNs of objects the given groups are members
+        of, directly or indirectly. The memberships are read only once for
+        every group.
+        """
 
-    def migrate_memberships(self, user_entry, winsync_group_prefix,
+        group_container_dn = DN(api.env.container_group, api.env.basedn)
+        missing = [dn for dn in group_dns if dn not in self.group_memberof]
+        if missing:
+            group_filter = self.ldap.make_filter_from_attr(
+                'cn', [dn[0]['cn'] for dn in missing],
+                rules=self.ldap.MATCH_ANY)
+            for entry in self.ldap.iter_entries(
+                    group_filter,
+                    attrs_list=['memberof'],
+                    base_dn=group_container_dn,
+                    scope=self.ldap.SCOPE_ONELEVEL):
+                self.group_memberof[entry.dn] = set(entry.get('memberof', []))
+            for dn in missing:
+                self.group_memberof.setdefault(dn, set())
+
+        return dict((dn, self.group_memberof[dn]) for dn in group_dns)
+
+    def get_memberships(self, user_entries):
+        """
+        Returns dict of memberships of the given users by user DN. Each
+        membership is a tuple of sets of object DNs:
+            (all memberships, memberships inherited from groups)
+
+        The memberships are read from the memberOf attribute of the users,
+        which covers both member and memberUser. An object can be found in
+        both sets, if the user is its direct member and also a member of
+        its member group.
+        """
+
+        group_container_dn = DN(api.env.container_group, api.env.basedn)
+        memberof = dict((entry.dn, set(entry.get('memberof', [])))
+                        for entry in user_entries)
+        group_dns = set(
+            dn for dns in memberof.values() for dn in dns
+            if dn[1:] == group_container_dn)
+        group_memberof = self.get_group_memberof(group_dns)
+
+        memberships = {}
+        for dn, dns in memberof.items():
+            inherited = set()
+            for group_dn in dns & group_dns:
+                inherited.update(group_memberof[group_dn])
+            memberships[dn] = (dns, inherited)
+        return memberships
+
+    def migrate_memberships(self, user_entries, winsync_group_prefix,
                             object_membership_command,
                             object_info_command,
                             user_dn_attribute,
@@ -212,7 +333,8 @@ class WinsyncMigrate(admintool.AdminTool):
 
         All migrated users for the given object are migrated to a common
         external group which is then assigned to the given object as a
-        (user) member group.
+        (user) member group. Users of a batch are added to the external
+        group of each object at once.
         """
 
         def winsync_group_name(object_entry):
@@ -250,22 +372,63 @@ class WinsyncMigrate(admintool.AdminTool):
                 api.Command['group_add'](name, external=True)
             except errors.DuplicateEntry:
                 # If there is a collision, let's try again with a higher suffix
-                create_winsync_group(object_entry, suffix=suffix+1)
+                return create_winsync_group(object_entry, suffix=suffix+1)
             else:
                 # In case of no collision, add the membership
                 api.Command[object_membership_command](object_entry['cn'][0], group=[name])
+                return name
 
-        # Search for all objects containing the given user as a direct member
-        member_filter = self.ldap.make_filter_from_attr(user_dn_attribute,
-                                                        user_entry.dn)
+        def find_winsync_group(object_entry):
+            """
+            Returns the name of the winsync external group which is
+            a member of the object, None if there is none.
+            """
 
-        try:
-            objects, _truncated = self.ldap.find_entries(
-                member_filter,
-                base_dn=object_container_dn)
-        except errors.EmptyResult:
-            # If there's nothing to migrate, then let's get out of here
-            return
+            name = winsync_group_name(object_entry)
+            info = api.Command[object_info_command](
+                object_entry['cn'][0])['result']
+            for group in info.get(object_group_membership_key, []):
+                suffix = group[len(name):]
+                if group.startswith(name) and (not suffix or suffix.isdigit()):
+                    return group
+            return None
+
+        def get_direct_members(object_entry):
+            """
+            Returns the users of the batch which are direct members of the
+            object.
+            """
+
+            members = []
+            for entry in user_entries:
+                memberof, inherited = self.memberships[entry.dn]
+                if object_entry.dn not in memberof:
+                    continue
+                if object_entry.dn in inherited:
+                    # member of the object through a group, check whether
+                    # the user is also a direct member
+                    try:
+                        self.ldap.get_entries(
+                            object_entry.dn, self.ldap.SCOPE_BASE,
+                            self.ldap.make_filter(
+                                {user_dn_attribute: entry.dn}),
+                            ['cn'])
+                    except errors.NotFound:
+                        continue
+                members.append(entry)
+            return members
+
+        # Search for all objects containing any of the given users as
+        # a direct member, the members themselves are taken from memberOf
+        # of the users, so member lists of large objects are not read
+        member_filter = self.ldap.make_filter_from_attr(
+            user_dn_attribute, [entry.dn for entry in user_entries],
+            rules=self.ldap.MATCH_ANY)
+
+        objects = self.ldap.iter_entries(
+            member_filter,
+            attrs_list=['cn'],
+            base_dn=object_container_dn)
 
         # The external user cannot be added directly as member of the IPA
         # objects, hence we need to wrap all the external users into one
@@ -273,21 +436,27 @@ class WinsyncMigrate(admintool.AdminTool):
         # object as a member.
 
         for obj in objects:
-            # Check for existence of winsync external group
-            name = winsync_group_name(obj)
-            info = api.Command[object_info_command](obj['cn'][0])['result']
-
-            # If it was not created yet, do it now
-            if name not in info.get(object_group_membership_key, []):
-                create_winsync_group(obj)
-
-            # Add the user to the external group. Membership is migrated
+            # Check for existence of winsync external group, if it was not
+            # created yet, do it now
+            key = (winsync_group_prefix, obj.dn)
+            if key not in self.winsync_groups:
+                name = find_winsync_group(obj)
+                if name is None:
+                    name = create_winsync_group(obj)
+                self.winsync_groups[key] = name
+            name = self.winsync_groups[key]
+
+            # Add the users to the external group. Membership is migrated
             # at this point.
-            user_identifier = u"%s@%s" % (user_entry['uid'][0], self.options.realm)
-            api.Command['group_add_member'](name, ipaexternalmember=[user_identifier])
-
-    def migrate_group_memberships(self, user_entry):
-        return self.migrate_memberships(user_entry,
+            user_identifiers = [
+                u"%s@%s" % (entry['uid'][0], self.options.realm)
+                for entry in get_direct_members(obj)]
+            if user_identifiers:
+                api.Command['group_add_member'](
+                    name, ipaexternalmember=user_identifiers)
+
+    def migrate_group_memberships(self, user_entries):
+        return self.migrate_memberships(user_entries,
             winsync_group_prefix="group",
             user_dn_attribute="member",
             object_membership_command="group_add_member",
@@ -296,8 +465,8 @@ class WinsyncMigrate(admintool.AdminTool):
             object_container_dn=DN(api.env.container_group, api.env.basedn),
         )
 
-    def migrate_role_memberships(self, user_entry):
-        return self.migrate_memberships(user_entry,
+    def migrate_role_memberships(self, user_entries):
+        return self.migrate_memberships(user_entries,
             winsync_group_prefix="role",
             user_dn_attribute="member",
             object_membership_command="role_add_member",
@@ -306,8 +475,8 @@ class WinsyncMigrate(admintool.AdminTool):
             object_container_dn=DN(api.env.container_rolegroup, api.env.basedn),
         )
 
-    def migrate_hbac_memberships(self, user_entry):
-        return self.migrate_memberships(user_entry,
+    def migrate_hbac_memberships(self, user_entries):
+        return self.migrate_memberships(user_entries,
             winsync_group_prefix="hbacrule",
             user_dn_attribute="memberuser",
             object_membership_command="hbacrule_add_user",
@@ -316,8 +485,8 @@ class WinsyncMigrate(admintool.AdminTool):
             object_container_dn=DN(api.env.container_hbac, api.env.basedn),
         )
 
-    def migrate_selinux_memberships(self, user_entry):
-        return self.migrate_memberships(user_entry,
+    def migrate_selinux_memberships(self, user_entries):
+        return self.migrate_memberships(user_entries,
             winsync_group_prefix="selinux",
             user_dn_attribute="memberuser",
             object_membership_command="selinuxusermap_add_user",
@@ -362,20 +531,75 @@ class WinsyncMigrate(admintool.AdminTool):
 
         super(WinsyncMigrate, cls).main(argv)
 
+    def migrate_users(self, user_entries, pool):
+        """
+        Migrates a batch of users and removes their winsync entries.
+        """
+
+        pool.map(self.create_id_user_override, user_entries)
+
+        self.memberships = self.get_memberships(user_entries)
+        self.migrate_group_memberships(user_entries)
+        self.migrate_role_memberships(user_entries)
+        self.migrate_hbac_memberships(user_entries)
+        self.migrate_selinux_memberships(user_entries)
+
+        for entry, error in self.ldap.delete_entries(user_entries):
+            if error is not None:
+                self.log.warning("Removal of %s failed: %s"
+                                 % (entry.dn, str(error)))
+
     def run(self):
         super(WinsyncMigrate, self).run()
 
+        if self.resume:
+            migrated = int(self.sstore.get_state('winsync_migrate',
+                                                 'migrated') or 0)
+            self.log.info("Resuming interrupted migration, %d users were "
+                          "already migrated" % migrated)
+        else:
+            # From now on the migration can only be resumed, the state is
+            # recorded before the agreement is deleted, so an interrupted
+            # deletion is retried by the resumed migration
+            migrated = 0
+            self.sstore.backup_state('winsync_migrate', 'realm',
+                                     self.options.realm)
+            self.sstore.backup_state('winsync_migrate', 'server',
+                                     self.options.server)
+
         # Stop winsync agreement with the given host
         self.delete_winsync_agreement()
 
-        # Create ID overrides replacing the user winsync entries
+        # Create ID overrides replacing the user winsync entries, users are
+        # migrated in batches and the progress is recorded after each batch.
+        # The winsync entries are removed, a resumed migration finds only
+        # the users which were not migrated yet.
+        self.winsync_groups = {}
+        self.group_memberof = {}
+        start = time.time()
+        count = 0
         entries = self.find_winsync_users()
-        for entry in entries:
-            self.create_id_user_override(entry)
-            self.migrate_group_memberships(entry)
-            self.migrate_role_memberships(entry)
-            self.migrate_hbac_memberships(entry)
-            self.migrate_selinux_memberships(entry)
-            self.ldap.delete_entry(entry)
+        pool = ThreadPool(self.options.workers,
+                          initializer=self.connect_worker)
+        try:
+            while True:
+                batch = list(itertools.islice(entries, MIGRATION_BATCH_SIZE))
+                if not batch:
+                    break
+
+                self.migrate_users(batch, pool)
+
+                count += len(batch)
+                self.sstore.backup_state('winsync_migrate', 'migrated',
+                                         str(migrated + count))
+                self.log.info("Migrated %d users (%.1f users/s)"
+                              % (migrated + count,
+                                 count / max(time.time() - start, 0.001)))
+        finally:
+            pool.close()
+            pool.join()
+
+        for key in ('realm', 'server', 'migrated'):
+            self.sstore.delete_state('winsync_migrate', key)
 
         self.warn_passsync()
@@ -23,6 +23,7 @@
 # save undo files?
 
 import base64
+import hashlib
 import sys
 import uuid
 import platform
@@ -35,7 +36,7 @@ import ldap
 import six
 
 from ipaserver.install import installutils
-from ipapython import ipautil, ipaldap
+from ipapython import ipautil, ipaldap, version
 from ipalib import errors
 from ipalib import api, create_api
 from ipalib import constants
@@ -49,6 +50,11 @@ if six.PY3:
 
 UPDATES_DIR=paths.UPDATES_DIR
 UPDATE_SEARCH_TIME_LIMIT = 30  # seconds
+# maximal number of entries read by a single prefetch search
+PREFETCH_BATCH_SIZE = 100
+# per-server record of applied update files and update plugins, stored in
+# cn=config so it is not replicated
+UPGRADE_MANIFEST_DN = DN(('cn', 'IPA Upgrade Manifest'), ('cn', 'config'))
 
 
 def connect(ldapi=False, realm=None, fqdn=None, dm_password=None, pw_name=None):
@@ -89,6 +95,105 @@ class BadSyntax(installutils.ScriptError):
     def __str__(self):
         return repr(self.value)
 
+
+class UpgradeManifest(object):
+    """
+    Record of update files and update plugins already applied on this
+    server.
+
+    Every applied update file is stored with a digest of its content and
+    of the substitution values, every executed update plugin with the IPA
+    version it was executed by. An update file which was already applied
+    with the same digest and whose plugins were already executed by the
+    current version does not have to be applied again.
+
+    Update files whose effect depends on the directory content, i.e. files
+    with default entries or with onlyifexist or addifexist updates, are
+    never recorded. They are applied in every run, so that entries created
+    later (e.g. when DNS or KRA is installed) get updated and default
+    entries deleted by an administrator are restored.
+
+    The manifest is stored as ipaConfigString values of
+    UPGRADE_MANIFEST_DN:
+
+        file:<update file name>:<digest>
+        plugin:<plugin name>:<version>
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.files = {}
+        self.plugins = {}
+        self.entry = None
+
+    def load(self):
+        self.files = {}
+        self.plugins = {}
+        try:
+            self.entry = self.conn.get_entry(UPGRADE_MANIFEST_DN,
+                                             ['ipaConfigString'])
+        except errors.NotFound:
+            self.entry = None
+            return
+
+        for value in self.entry.get('ipaConfigString', []):
+            kind, sep, rest = value.partition(':')
+            name, sep2, data = rest.rpartition(':')
+            if not sep or not sep2:
+                continue
+            if kind == 'file':
+                self.files[name] = data
+            elif kind == 'plugin':
+                self.plugins[name] = data
+
+    def save(self):
+        values = sorted(
+            ['file:%s:%s' % item for item in self.files.items()] +
+            ['plugin:%s:%s' % item for item in self.plugins.items()]
+        )
+        if self.entry is None:
+            self.entry = self.conn.make_entry(
+                UPGRADE_MANIFEST_DN,
+                objectclass=['top', 'nsContainer', 'ipaConfigObject'],
+                cn=[UPGRADE_MANIFEST_DN[0].value],
+                ipaConfigString=values,
+            )
+            self.conn.add_entry(self.entry)
+        else:
+            self.entry['ipaConfigString'] = values
+            try:
+                self.conn.update_entry(self.entry)
+            except errors.EmptyModlist:
+                pass
+
+    @staticmethod
+    def is_recordable(updates):
+        """Return True if the effect of updates does not depend on the
+        directory content, so that they can be skipped once applied"""
+        for update in updates:
+            if 'default' in update:
+                return False
+            for item in update.get('updates', []):
+                if item['action'] in ('onlyifexist', 'addifexist'):
+                    return False
+        return True
+
+    def is_applied(self, name, digest, plugins):
+        if self.files.get(name) != digest:
+            return False
+        return all(self.plugins.get(plugin) == version.VERSION
+                   for plugin in plugins)
+
+    def set_applied(self, name, digest, plugins):
+        self.files[name] = digest
+        for plugin in plugins:
+            self.plugins[plugin] = version.VERSION
+
+    def prune(self, names):
+        """Forget update files which are no longer installed or recordable"""
+        for name in set(self.files) - set(names):
+            del self.files[name]
+
+
 def safe_output(attr, values):
     """
     Sanitizes values we do not want logged, like passwords.
@@ -258,6 +363,10 @@ class LDAPUpdate(object):
         self.dm_password = dm_password
         self.conn = None
         self.modified = False
+        # number of updates which failed to apply
+        self.failures = 0
+        # existing entries read in advance by _prefetch_entries(), by DN
+        self.prefetched_entries = {}
         self.online = online
         self.ldapi = ldapi
         self.pw_name = pwd.getpwuid(os.geteuid()).pw_name
@@ -638,6 +747,70 @@ class LDAPUpdate(object):
 
         return self.conn.get_entries(dn, scope, searchfilter, sattrs)
 
+    def _prefetch_entries(self, all_updates):
+        """
+        Read existing entries which are targets of updates in advance.
+
+        Instead of a base search for every update, entries with the same
+        parent are read by a single one-level search filtered by their RDNs
+        and only the attributes referenced by the updates are requested.
+        Entries which are not found are looked up again by
+        `_update_record()`, so an entry is never assumed to be missing
+        based on the prefetch.
+        """
+        self.prefetched_entries = {}
+
+        attrs_by_dn = {}
+        for update in all_updates:
+            if 'plugin' in update or 'deleteentry' in update:
+                continue
+            # addifnew and addifexist check objectclass of the entry, RDN
+            # attribute is used to create index tasks
+            dn = update['dn']
+            attrs = attrs_by_dn.setdefault(
+                dn, {'objectclass', dn[0].attr.lower()})
+            for item in update.get('updates', []):
+                attrs.add(item['attr'].lower())
+
+        dns_by_parent = {}
+        for dn in attrs_by_dn:
+            # entries with multi-valued RDN or without parent are read
+            # the usual way
+            if len(dn) > 1 and len(dn[0]) == 1:
+                dns_by_parent.setdefault(dn[1:], []).append(dn)
+
+        searches = 0
+        for parent_dn, dns in dns_by_parent.items():
+            for i in range(0, len(dns), PREFETCH_BATCH_SIZE):
+                batch = dns[i:i + PREFETCH_BATCH_SIZE]
+                attrs_list = set()
+                for dn in batch:
+                    attrs_list.update(attrs_by_dn[dn])
+                search_filter = self.conn.combine_filters(
+                    [self.conn.make_filter_from_attr(dn[0].attr, dn[0].value)
+                     for dn in batch],
+                    rules=self.conn.MATCH_ANY)
+
+                searches += 1
+                try:
+                    entries, _truncated = self.conn.find_entries(
+                        search_filter, list(attrs_list), parent_dn,
+                        scope=self.conn.SCOPE_ONELEVEL)
+                except errors.NotFound:
+                    continue
+                except errors.DatabaseError as e:
+                    self.debug("Prefetch of entries in %s failed: %s",
+                               parent_dn, e)
+                    continue
+
+                wanted = set(batch)
+                for entry in entries:
+                    if entry.dn in wanted:
+                        self.prefetched_entries[entry.dn] = entry
+
+        self.debug("Prefetched %d of %d entries with %d searches",
+                   len(self.prefetched_entries), len(attrs_by_dn), searches)
+
     def _apply_update_disposition(self, updates, entry):
         """
         updates is a list of changes to apply
@@ -748,22 +921,29 @@ class LDAPUpdate(object):
         new_entry = self._create_default_entry(update.get('dn'),
                                                update.get('default'))
 
-        try:
-            e = self._get_entry(new_entry.dn)
-            if len(e) > 1:
-                # we should only ever get back one entry
-                raise BadSyntax("More than 1 entry returned on a dn search!? %s" % new_entry.dn)
-            entry = e[0]
+        # a prefetched entry can be used only once, the next update of the
+        # same DN must see the result of this one
+        entry = self.prefetched_entries.pop(new_entry.dn, None)
+        if entry is not None:
             found = True
             self.debug("Updating existing entry: %s", entry.dn)
-        except errors.NotFound:
-            # Doesn't exist, start with the default entry
-            entry = new_entry
-            self.debug("New entry: %s", entry.dn)
-        except errors.DatabaseError:
-            # Doesn't exist, start with the default entry
-            entry = new_entry
-            self.debug("New entry, using default value: %s", entry.dn)
+        else:
+            try:
+                e = self._get_entry(new_entry.dn)
+                if len(e) > 1:
+                    # we should only ever get back one entry
+                    raise BadSyntax("More than 1 entry returned on a dn search!? %s" % new_entry.dn)
+                entry = e[0]
+                found = True
+                self.debug("Updating existing entry: %s", entry.dn)
+            except errors.NotFound:
+                # Doesn't exist, start with the default entry
+                entry = new_entry
+                self.debug("New entry: %s", entry.dn)
+            except errors.DatabaseError:
+                # Doesn't exist, start with the default entry
+                entry = new_entry
+                self.debug("New entry, using default value: %s", entry.dn)
 
         self.print_entity(entry, "Initial value")
 
@@ -790,11 +970,13 @@ class LDAPUpdate(object):
                         # this may not be an error (e.g. entries in NIS container)
                         self.error("Parent DN of %s may not exist, cannot "
                                    "create the entry", entry.dn)
+                        self.failures += 1
                         return
                 added = True
                 self.modified = True
             except Exception as e:
                 self.error("Add failure %s", e)
+                self.failures += 1
         else:
             # Update LDAP
             try:
@@ -814,9 +996,11 @@ class LDAPUpdate(object):
                 updated = False
             except errors.DatabaseError as e:
                 self.error("Update failed: %s", e)
+                self.failures += 1
                 updated = False
             except errors.ACIError as e:
                 self.error("Update failed: %s", e)
+                self.failures += 1
                 updated = False
 
             if updated:
@@ -844,6 +1028,7 @@ class LDAPUpdate(object):
             self.modified = True
         except errors.DatabaseError as e:
             self.error("Delete failed: %s", e)
+            self.failures += 1
 
     def get_all_files(self, root, recursive=False):
         """Get all update files"""
@@ -884,15 +1069,39 @@ class LDAPUpdate(object):
     def _run_updates(self, all_updates):
         for update in all_updates:
             if 'deleteentry' in update:
+                self.prefetched_entries.clear()
                 self._delete_record(update)
             elif 'plugin' in update:
+                # plugins may modify any entry
+                self.prefetched_entries.clear()
                 self._run_update_plugin(update['plugin'])
             else:
                 self._update_record(update)
 
-    def update(self, files, ordered=True):
+    def _get_update_digest(self, data):
+        """
+        Compute digest of update file content and of substitution values
+        the content is templated with
+        """
+        digest = hashlib.sha256()
+        for line in data:
+            digest.update(line.encode('utf-8') if isinstance(line, unicode)
+                          else line)
+        for key in sorted(self.sub_dict):
+            # TIME differs in every run
+            if key == 'TIME':
+                continue
+            digest.update(('\0%s=%s' % (key, self.sub_dict[key])).encode(
+                'utf-8'))
+        return digest.hexdigest()
+
+    def update(self, files, ordered=True, use_manifest=False, force=False):
         """Execute the update. files is a list of the update files to use.
         :param ordered: Update files are executed in alphabetical order
+        :param use_manifest: Record applied update files in the upgrade
+            manifest and skip files which were already applied
+        :param force: Apply all update files even if they were already
+            applied, the manifest is still recorded
 
         returns True if anything was changed, otherwise False
         """
@@ -901,11 +1110,19 @@ class LDAPUpdate(object):
         try:
             self.create_connection()
 
+            manifest = None
+            if use_manifest:
+                manifest = UpgradeManifest(self.conn)
+                manifest.load()
+
             upgrade_files = files
             if ordered:
                 upgrade_files = sorted(files)
 
+            skipped = 0
+            recorded_files = []
             for f in upgrade_files:
+                start = time.time()
                 try:
                     self.debug("Parsing update file '%s'" % f)
                     data = self.read_file(f)
@@ -914,9 +1131,45 @@ class LDAPUpdate(object):
                     raise RuntimeError(e)
 
                 self.parse_update_file(f, data, all_updates)
+
+                recordable = (manifest is not None and
+                              manifest.is_recordable(all_updates))
+                if recordable:
+                    name = os.path.basename(f)
+                    recorded_files.append(name)
+                    digest = self._get_update_digest(data)
+                    plugins = [u['plugin'] for u in all_updates
+                               if 'plugin' in u]
+                    if (not force and
+                            manifest.is_applied(name, digest, plugins)):
+                        self.debug("Update file '%s' was already applied, "
+                                   "skipping", f)
+                        skipped += 1
+                        all_updates = []
+                        continue
+
+                failures = self.failures
+                self._prefetch_entries(all_updates)
                 self._run_updates(all_updates)
+                self.prefetched_entries.clear()
+                self.debug("Update file '%s': %d updates applied in %.3f "
+                           "seconds", f, len(all_updates), time.time() - start)
                 all_updates = []
+
+                if recordable and self.failures == failures:
+                    # the file has to be applied again in the next run if
+                    # any of its updates failed
+                    manifest.set_applied(name, digest, plugins)
+                    manifest.save()
+
+            if manifest is not None:
+                if skipped:
+                    self.info("%d of %d update files were already applied "
+                              "and were skipped", skipped, len(upgrade_files))
+                manifest.prune(recorded_files)
+                manifest.save()
         finally:
+            self.prefetched_entries.clear()
             self.close_connection()
 
         return self.modified
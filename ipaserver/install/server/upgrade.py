@@ -10,6 +10,7 @@ import shutil
 import pwd
 import fileinput
 import sys
+import time
 
 import dns.exception
 
@@ -1529,6 +1530,39 @@ def add_default_caacl(ca):
     sysupgrade.set_upgrade_state('caacl', 'add_default_caacl', True)
 
 
+class UpgradeStepTimer(object):
+    """
+    Log the duration of upgrade steps executed one after another.
+
+    start() finishes the previous step, finish() the last one and logs the
+    durations of all steps.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.durations = []
+        self.step = None
+        self.step_start = None
+
+    def _finish_step(self):
+        if self.step is not None:
+            self.durations.append((self.step, time.time() - self.step_start))
+            root_logger.debug("Step %s finished in %.3f seconds",
+                              *self.durations[-1])
+            self.step = None
+
+    def start(self, name):
+        self._finish_step()
+        root_logger.debug("Step %s started", name)
+        self.step = name
+        self.step_start = time.time()
+
+    def finish(self):
+        self._finish_step()
+        root_logger.info("Steps finished in %.3f seconds: %s",
+                         time.time() - self.start_time,
+                         ', '.join('%s %.3fs' % d for d in self.durations))
+
+
 def upgrade_configuration():
     """
     Execute configuration upgrade of the IPA services
@@ -1684,6 +1718,8 @@ def upgrade_configuration():
     uninstall_selfsign(ds, http)
     uninstall_dogtag_9(ds, http)
 
+    steps = UpgradeStepTimer()
+    steps.start('local services')
     simple_service_list = (
         (memcacheinstance.MemcacheInstance(), 'MEMCACHE'),
         (otpdinstance.OtpdInstance(), 'OTPD'),
@@ -1710,11 +1746,14 @@ def upgrade_configuration():
                 ds.start()
                 dnskeysyncd.create_instance(fqdn, api.env.realm)
                 dnskeysyncd.start_dnskeysyncd()
+            else:
+                dnskeysyncd.set_token_permissions()
 
     cleanup_kdc(fstore)
     cleanup_adtrust(fstore)
     setup_firefox_extension(fstore)
 
+    steps.start('named')
     bind = bindinstance.BindInstance(fstore)
     if bind.is_configured() and not bind.is_running():
         # some upgrade steps may require bind running
@@ -1757,9 +1796,11 @@ def upgrade_configuration():
     if bind_started:
         bind.stop()
 
+    steps.start('custodia')
     custodia = custodiainstance.CustodiaInstance(api.env.host, api.env.realm)
     custodia.upgrade_instance()
 
+    steps.start('ca')
     ca_restart = any([
         ca_restart,
         ca_upgrade_schema(ca),
@@ -1793,6 +1834,7 @@ def upgrade_configuration():
         cainstance.repair_profile_caIPAserviceCert()
         ca.setup_lightweight_ca_key_retrieval()
         cainstance.ensure_ipa_authority_entry()
+    steps.finish()
 
     set_sssd_domain_option('ipa_server_mode', 'True')
 
@@ -1834,14 +1876,14 @@ def upgrade_check(options):
                          "system")
 
 
-def upgrade():
+def upgrade(force=False):
     realm = api.env.realm
     schema_files = [os.path.join(ipautil.SHARE_DIR, f) for f
                     in dsinstance.ALL_SCHEMA_FILES]
 
     schema_files.extend(dsinstance.get_all_external_schema_files(
                         paths.EXTERNAL_SCHEMA_DIR))
-    data_upgrade = IPAUpgrade(realm, schema_files=schema_files)
+    data_upgrade = IPAUpgrade(realm, schema_files=schema_files, force=force)
 
     try:
         data_upgrade.create_instance()
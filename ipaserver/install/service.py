@@ -329,8 +329,9 @@ class Service(object):
         except errors.NotFound:
             pass
         else:
-            for cert, nickname, trust_flags in ca_certs:
-                db.add_cert(cert, nickname, trust_flags)
+            with db.nssdb.batch():
+                for cert, nickname, trust_flags in ca_certs:
+                    db.add_cert(cert, nickname, trust_flags)
 
     def is_configured(self):
         return self.sstore.has_state(self.service_name)
@@ -69,10 +69,12 @@ class IPAUpgrade(service.Service):
     listeners and updating over ldapi. This way we know the server is
     quiet.
     """
-    def __init__(self, realm_name, files=[], schema_files=[]):
+    def __init__(self, realm_name, files=[], schema_files=[], force=False):
         """
         realm_name: kerberos realm name, used to determine DS instance dir
         files: list of update files to process. If none use UPDATEDIR
+        force: apply update files from UPDATEDIR even if they were already
+               applied
         """
 
         ext = ''
@@ -89,6 +91,7 @@ class IPAUpgrade(service.Service):
         self.serverid = serverid
         self.schema_files = schema_files
         self.realm = realm_name
+        self.force = force
 
     def __start(self):
         services.service(self.service_name).start(self.serverid, ldapi=True)
@@ -208,9 +211,14 @@ class IPAUpgrade(service.Service):
     def __upgrade(self):
         try:
             ld = ldapupdate.LDAPUpdate(dm_password='', ldapi=True)
-            if len(self.files) == 0:
+            # only the complete set of update files is recorded in the
+            # upgrade manifest, explicitly listed files are always applied
+            use_manifest = len(self.files) == 0
+            if use_manifest:
                 self.files = ld.get_all_files(ldapupdate.UPDATES_DIR)
-            self.modified = (ld.update(self.files) or self.modified)
+            self.modified = (ld.update(self.files,
+                                       use_manifest=use_manifest,
+                                       force=self.force) or self.modified)
         except ldapupdate.BadSyntax as e:
             root_logger.error('Bad syntax in upgrade %s', e)
             raise
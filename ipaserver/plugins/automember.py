@@ -16,6 +16,8 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import collections
+import re
 import uuid
 import time
 
@@ -136,6 +138,12 @@ EXAMPLES:
 """) + _("""
  Rebuild membership for specified hosts:
     ipa automember-rebuild --hosts=web1.example.com --hosts=web2.example.com
+""") + _("""
+ Rebuild membership for all users without a Directory Server task:
+    ipa automember-rebuild --type=group --direct
+""") + _("""
+ Show which hosts would be added to which host groups:
+    ipa automember-rebuild --type=hostgroup --dry-run
 """)
 
 register = Registry()
@@ -148,6 +156,14 @@ REBUILD_TASK_CONTAINER = DN(('cn', 'automember rebuild membership'),
                             ('cn', 'tasks'),
                             ('cn', 'config'))
 
+# Number of members added to a group in one modify operation by
+# automember-rebuild --direct
+REBUILD_CHUNK_SIZE = 1000
+# Number of entries evaluated between two progress messages
+REBUILD_PROGRESS_INTERVAL = 10000
+# Description of the error returned when a member was added meanwhile
+TYPE_OR_VALUE_EXISTS = 'Type or value exists'
+
 
 regex_attrs = (
     Str('automemberinclusiveregex*',
@@ -683,8 +699,6 @@ class automember_rebuild(Method):
     obj_name = 'automember_task'
     attr_name = 'rebuild'
 
-    # TODO: Add a --dry-run option:
-    # https://fedorahosted.org/freeipa/ticket/3936
     takes_options = (
         group_type[0].clone(
             required=False,
@@ -706,6 +720,20 @@ class automember_rebuild(Method):
             label=_('No wait'),
             doc=_("Don't wait for rebuilding membership"),
         ),
+        Flag(
+            'direct?',
+            default=False,
+            label=_('Direct'),
+            doc=_('Evaluate the rules on the IPA server and add the members '
+                  'in batches instead of starting a rebuild task'),
+        ),
+        Flag(
+            'dry_run?',
+            default=False,
+            label=_('Dry run'),
+            doc=_('Only show the members which would be added, implies '
+                  '--direct'),
+        ),
     )
     has_output = output.standard_entry
 
@@ -716,6 +744,7 @@ class automember_rebuild(Method):
         - 'users' and 'hosts' cannot be combined together
         - if 'users' and 'type' are specified, 'type' must be 'group'
         - if 'hosts' and 'type' are specified, 'type' must be 'hostgroup'
+        - 'no_wait' cannot be combined with 'direct' or 'dry_run'
         """
         super(automember_rebuild, self).validate(**kw)
         users, hosts, gtype = kw.get('users'), kw.get('hosts'), kw.get('type')
@@ -738,6 +767,11 @@ class automember_rebuild(Method):
             raise errors.MutuallyExclusiveError(
                 reason=_("users cannot be set when type is 'hostgroup'")
             )
+        if kw.get('no_wait') and (kw.get('direct') or kw.get('dry_run')):
+            raise errors.MutuallyExclusiveError(
+                reason=_("no_wait cannot be set together with direct or "
+                         "dry_run")
+            )
 
     def execute(self, *keys, **options):
         ldap = self.api.Backend.ldap2
@@ -778,6 +812,15 @@ class automember_rebuild(Method):
         else:
             search_filter = '(%s=*)' % obj.primary_key.name
 
+        if options.get('direct') or options.get('dry_run'):
+            result, summary = self._rebuild(
+                ldap, gtype, basedn, search_filter,
+                dry_run=options.get('dry_run', False))
+            return dict(
+                result=result,
+                summary=unicode(summary),
+                value=pkey_to_value(None, options))
+
         task_dn = DN(('cn', cn), REBUILD_TASK_CONTAINER)
 
         entry = ldap.make_entry(
@@ -820,3 +863,198 @@ class automember_rebuild(Method):
             result=result,
             summary=unicode(summary),
             value=pkey_to_value(None, options))
+
+    def _get_rules(self, ldap, gtype):
+        """
+        Read the automember definition of a grouping type and its rules.
+
+        Returns the definition entry and a list of (target group DN,
+        inclusive conditions, exclusive conditions) tuples, conditions are
+        lists of (attribute, compiled regex) tuples.
+        """
+        definition_dn = DN(('cn', gtype), api.env.container_automember,
+                           api.env.basedn)
+        definition = ldap.get_entry(
+            definition_dn,
+            ['automemberscope', 'automemberfilter', 'automembergroupingattr',
+             'automemberdefaultgroup'])
+
+        try:
+            entries = ldap.get_entries(
+                definition_dn, ldap.SCOPE_ONELEVEL,
+                '(objectclass=automemberregexrule)',
+                ['automembertargetgroup', INCLUDE_RE, EXCLUDE_RE])
+        except errors.NotFound:
+            entries = []
+
+        rules = []
+        for entry in entries:
+            conditions = {}
+            for attr in (INCLUDE_RE, EXCLUDE_RE):
+                conditions[attr] = []
+                for condition in entry.get(attr, []):
+                    key, _sep, regex = condition.partition('=')
+                    try:
+                        conditions[attr].append(
+                            (key.strip().lower(), re.compile(regex)))
+                    except re.error as e:
+                        self.log.warning(
+                            "Skipping invalid regular expression %r in "
+                            "automember rule %s: %s", condition, entry.dn, e)
+            for target in entry.get('automembertargetgroup', []):
+                rules.append(
+                    (target, conditions[INCLUDE_RE], conditions[EXCLUDE_RE]))
+
+        return definition, rules
+
+    @staticmethod
+    def _matches(entry, conditions):
+        for attr, regex in conditions:
+            for value in entry.raw.get(attr, []):
+                if regex.search(value.decode('utf-8')):
+                    return True
+        return False
+
+    def _rebuild(self, ldap, gtype, basedn, search_filter, dry_run=False):
+        """
+        Rebuild automember membership without a Directory Server task.
+
+        The regular expression rules are evaluated the same way the
+        Auto Membership plugin evaluates them, against entries read by a
+        paged search. Like the rebuild task, members are only added, never
+        removed. The missing members of each group are collected in memory
+        and added in chunks of REBUILD_CHUNK_SIZE members with pipelined
+        modify operations.
+
+        Progress is only reported in the server log, every
+        REBUILD_PROGRESS_INTERVAL evaluated entries and after every added
+        chunk. Members which could not be added are logged as well and
+        counted in the summary.
+
+        Returns a (result, summary) tuple, for a dry run the result maps
+        group names to the members which would be added.
+        """
+        definition, rules = self._get_rules(ldap, gtype)
+        scope = definition.single_value.get('automemberscope')
+        default_group = definition.single_value.get('automemberdefaultgroup')
+        group_attr, _sep, member_attr = definition.single_value.get(
+            'automembergroupingattr', 'member:dn').partition(':')
+
+        attrs_list = set()
+        for _target, include, exclude in rules:
+            attrs_list.update(attr for attr, _regex in include + exclude)
+        if member_attr.lower() != 'dn':
+            attrs_list.add(member_attr)
+
+        entry_filter = definition.single_value.get('automemberfilter')
+        if entry_filter:
+            if not entry_filter.startswith('('):
+                entry_filter = '(%s)' % entry_filter
+            search_filter = ldap.combine_filters(
+                [search_filter, entry_filter], rules=ldap.MATCH_ALL)
+
+        members = {}
+        missing = collections.OrderedDict()
+
+        def add_member(group_dn, values):
+            if group_dn not in members:
+                try:
+                    group = ldap.get_entry(group_dn, [group_attr])
+                except errors.NotFound:
+                    self.log.warning(
+                        "Automember target group %s not found", group_dn)
+                    members[group_dn] = None
+                else:
+                    members[group_dn] = set(group.get(group_attr, []))
+            if members[group_dn] is None:
+                return
+            for value in values:
+                if value not in members[group_dn]:
+                    members[group_dn].add(value)
+                    missing.setdefault(group_dn, []).append(value)
+
+        count = 0
+        entries = ldap.iter_entries(
+            search_filter, list(attrs_list) or ['1.1'], base_dn=basedn)
+        for entry in entries:
+            if scope and not entry.dn.endswith(DN(scope)):
+                continue
+
+            excluded = set(target for target, _include, exclude in rules
+                           if self._matches(entry, exclude))
+            targets = [target for target, include, _exclude in rules
+                       if target not in excluded and
+                       self._matches(entry, include)]
+            if not targets and default_group:
+                targets = [default_group]
+
+            if member_attr.lower() == 'dn':
+                values = [entry.dn]
+            else:
+                values = entry.get(member_attr, [])
+            for target in targets:
+                add_member(target, values)
+
+            count += 1
+            if count % REBUILD_PROGRESS_INTERVAL == 0:
+                self.log.info(
+                    "Automember rebuild: evaluated %d entries, %d members "
+                    "to add", count, sum(len(v) for v in missing.values()))
+
+        total = sum(len(v) for v in missing.values())
+        self.log.info(
+            "Automember rebuild: evaluated %d entries, %d members to add to "
+            "%d groups", count, total, len(missing))
+
+        if dry_run:
+            result = dict(
+                (unicode(group_dn[0].value),
+                 [unicode(value[0].value) if isinstance(value, DN)
+                  else unicode(value) for value in values])
+                for group_dn, values in missing.items())
+            summary = _('Automember rebuild membership would add '
+                        '%(count)d members to %(groups)d groups') % dict(
+                            count=total, groups=len(missing))
+            return result, summary
+
+        chunks = (
+            (group_dn, values[i:i + REBUILD_CHUNK_SIZE])
+            for group_dn, values in missing.items()
+            for i in range(0, len(values), REBUILD_CHUNK_SIZE))
+
+        added = 0
+        failed = []
+        for (group_dn, values), error in ldap.add_entries_to_groups(
+                chunks, group_attr):
+            if error is None:
+                added += len(values)
+                self.log.info(
+                    "Automember rebuild: added %d of %d members",
+                    added, total)
+            else:
+                # The whole chunk fails when one of its members was added
+                # meanwhile, retry the members one by one.
+                failed.extend((group_dn, [value]) for value in values)
+
+        not_added = 0
+        for (group_dn, values), error in ldap.add_entries_to_groups(
+                failed, group_attr):
+            if error is None:
+                added += len(values)
+            elif not isinstance(error, errors.DatabaseError):
+                raise error
+            elif getattr(error, 'desc', None) != TYPE_OR_VALUE_EXISTS:
+                # members added meanwhile are fine, anything else is not
+                self.log.error(
+                    "Automember rebuild: failed to add %s to %s: %s",
+                    values[0], group_dn, error)
+                not_added += 1
+
+        if not_added:
+            summary = _('Automember rebuild membership completed, '
+                        '%(count)d members added, %(failed)d members could '
+                        'not be added') % dict(count=added, failed=not_added)
+        else:
+            summary = _('Automember rebuild membership completed, '
+                        '%(count)d members added') % dict(count=added)
+        return {}, summary
@@ -573,6 +573,11 @@ class LDAPObject(Object):
     object_not_found_msg = _('%(pkey)s: %(oname)s not found')
     already_exists_msg = _('%(oname)s with name "%(pkey)s" already exists')
 
+    def _on_finalize(self):
+        super(LDAPObject, self)._on_finalize()
+        # cache of member attribute name -> list of member containers
+        self._member_containers = {}
+
     def get_dn(self, *keys, **kwargs):
         if self.parent_object:
             parent_dn = self.api.Object[self.parent_object].get_dn(*keys[:-1])
@@ -639,11 +644,53 @@ class LDAPObject(Object):
         oc = [x.lower() for x in classes]
         return objectclass.lower() in oc
 
+    def _get_member_containers(self, attr):
+        """
+        Return list of (container DN, container DN suffix, LDAP object)
+        tuples of objects which can be members in attr. The suffix is
+        a lowercase string of the container DN prefixed by comma, usable
+        for matching raw member DN strings.
+        """
+        try:
+            return self._member_containers[attr]
+        except KeyError:
+            pass
+
+        containers = []
+        for ldap_obj_name in self.attribute_members[attr]:
+            ldap_obj = self.api.Object[ldap_obj_name]
+            container_dn = DN(ldap_obj.container_dn, self.api.env.basedn)
+            containers.append(
+                (container_dn, u',%s' % unicode(container_dn).lower(),
+                 ldap_obj))
+
+        self._member_containers[attr] = containers
+        return containers
+
+    def get_primary_key_from_rdn_string(self, rdn):
+        """
+        Get primary key from a string of a single RDN of entry located
+        directly in the object container, without parsing it to DN.
+
+        :returns: primary key or None if the RDN string does not contain
+            the primary key as a plain value and it has to be parsed
+        """
+        if self.rdn_attribute or self.primary_key is None:
+            return None
+
+        attr, sep, value = rdn.partition(u'=')
+        if (not sep or attr != self.primary_key.name or not value or
+                value[0] in u' #' or value[-1] == u' ' or
+                any(c in value for c in u'\\,+"<>;')):
+            # escaped or multi-valued RDN, or entry in a sub-container
+            return None
+
+        return value
+
     def convert_attribute_members(self, entry_attrs, *keys, **options):
         if options.get('raw', False):
             return
 
-        container_dns = {}
         new_attrs = {}
 
         for attr in self.attribute_members:
@@ -653,27 +700,44 @@ class LDAPObject(Object):
                 continue
             del entry_attrs[attr]
 
+            containers = self._get_member_containers(attr)
+
             for member in value:
-                memberdn = DN(member)
-                for ldap_obj_name in self.attribute_members[attr]:
-                    ldap_obj = self.api.Object[ldap_obj_name]
-                    try:
-                        container_dn = container_dns[ldap_obj_name]
-                    except KeyError:
-                        container_dn = DN(ldap_obj.container_dn, api.env.basedn)
-                        container_dns[ldap_obj_name] = container_dn
-
-                    if memberdn.endswith(container_dn):
-                        new_value = ldap_obj.get_primary_key_from_dn(memberdn)
-                        new_attr_name = '%s_%s' % (attr, ldap_obj.name)
-                        try:
-                            new_attr = new_attrs[new_attr_name]
-                        except KeyError:
-                            new_attr = entry_attrs.setdefault(new_attr_name, [])
-                            new_attrs[new_attr_name] = new_attr
-                        new_attr.append(new_value)
+                # values may be raw bytes or DN objects
+                if isinstance(member, bytes):
+                    member_str = member.decode('utf-8')
+                else:
+                    member_str = unicode(member)
+
+                new_value = None
+
+                # fast path: match the DN string to container suffixes
+                # and take the primary key from the RDN string
+                member_lower = member_str.lower()
+                for _container_dn, suffix, ldap_obj in containers:
+                    if member_lower.endswith(suffix):
+                        new_value = ldap_obj.get_primary_key_from_rdn_string(
+                            member_str[:-len(suffix)])
                         break
 
+                if new_value is None:
+                    memberdn = DN(member)
+                    for container_dn, _suffix, ldap_obj in containers:
+                        if memberdn.endswith(container_dn):
+                            new_value = ldap_obj.get_primary_key_from_dn(
+                                memberdn)
+                            break
+                    else:
+                        continue
+
+                new_attr_name = '%s_%s' % (attr, ldap_obj.name)
+                try:
+                    new_attr = new_attrs[new_attr_name]
+                except KeyError:
+                    new_attr = entry_attrs.setdefault(new_attr_name, [])
+                    new_attrs[new_attr_name] = new_attr
+                new_attr.append(new_value)
+
     def get_indirect_members(self, entry_attrs, attrs_list):
         if 'memberindirect' in attrs_list:
             self.get_memberindirect(entry_attrs)
@@ -20,6 +20,7 @@
 
 from __future__ import absolute_import
 
+import collections
 import netaddr
 import time
 import re
@@ -30,6 +31,7 @@ import dns.name
 import dns.exception
 import dns.rdatatype
 import dns.resolver
+import dns.zone
 import six
 
 from ipalib.dns import (extra_name_format,
@@ -75,6 +77,7 @@ from ipalib.util import (normalize_zonemgr,
                          validate_bind_forwarder,
                          ipaddr_validator)
 from ipaplatform import services
+from ipapython import ipaldap
 from ipapython.dn import DN
 from ipapython.ipautil import CheckedIPAddress
 from ipapython.dnsutil import check_zone_overlap
@@ -84,6 +87,7 @@ from ipaserver.dns_data_management import (
     IPASystemRecords,
     IPADomainIsNotManagedByIPAError,
 )
+from ipaserver.dns_zone_tree import get_zone_tree, invalidate_zone_tree
 
 if six.PY3:
     unicode = str
@@ -240,6 +244,9 @@ EXAMPLES:
  Delegate zone sub.example to another nameserver:
    ipa dnsrecord-add example.com ns.sub --a-rec=203.0.113.1
    ipa dnsrecord-add example.com sub --ns-rec=ns.sub.example.com.
+""") + _("""
+ Import resource records from BIND zone file into zone example.com:
+   ipa dnszone-import example.com --file=example.com.zone
 """) + _("""
  Delete zone example.com with all resource records:
    ipa dnszone-del example.com
@@ -1745,6 +1752,11 @@ def _get_auth_zone_ldap(api, name):
     zone: authoritative zone, or None if authoritative zone is not in LDAP
     """
     assert isinstance(name, DNSName)
+
+    zone_tree = get_zone_tree(api)
+    if zone_tree is not None:
+        return zone_tree.get_auth_zone(name), False
+
     ldap = api.Backend.ldap2
 
     # Create all possible parent zone names
@@ -1809,6 +1821,10 @@ def _get_longest_match_ns_delegation_ldap(api, zone, name):
     assert isinstance(zone, DNSName)
     assert isinstance(name, DNSName)
 
+    zone_tree = get_zone_tree(api)
+    if zone_tree is not None:
+        return zone_tree.get_longest_match_ns_delegation(zone, name), False
+
     ldap = api.Backend.ldap2
 
     # get zone DN
@@ -1868,6 +1884,12 @@ def _find_subtree_forward_zones_ldap(api, name, child_zones_only=False):
     :return: (list of zonenames,  truncated), list is empty if no zone found
     """
     assert isinstance(name, DNSName)
+
+    zone_tree = get_zone_tree(api)
+    if zone_tree is not None:
+        return zone_tree.find_subtree_forward_zones(
+            name, child_zones_only=child_zones_only), False
+
     ldap = api.Backend.ldap2
 
     # prepare for filter "*.<name>."
@@ -2685,6 +2707,8 @@ class dnszone(DNSZoneBase):
         Warning if any operation with zone causes, a child forward zone is
         not effective
         """
+        # the zone tree validated before the zone was changed is outdated
+        invalidate_zone_tree()
         zone = keys[-1]
         affected_fw_zones, _truncated = _find_subtree_forward_zones_ldap(
             self.api, zone, child_zones_only=True)
@@ -2986,6 +3010,224 @@ class dnszone_remove_permission(DNSZoneBase_remove_permission):
     __doc__ = _('Remove a permission for per-zone access delegation.')
 
 
+@register()
+class dnszone_import(LDAPQuery):
+    __doc__ = _('Import resource records from a zone file into a DNS zone.')
+
+    msg_summary = _('Imported resource records into DNS zone "%(value)s"')
+
+    # number of processed entries between progress messages in the log
+    progress_interval = 1000
+
+    takes_options = LDAPQuery.takes_options + (
+        Str('file',
+            label=_('Zone file'),
+            doc=_('Zone file in master file format'),
+            cli_name='file',
+            noextrawhitespace=False,
+        ),
+        Int('window',
+            label=_('Window'),
+            doc=_('Maximal number of LDAP operations in progress'),
+            minvalue=1,
+            default=ipaldap.DEFAULT_PIPELINE_WINDOW,
+            autofill=True,
+        ),
+        Flag('force',
+             label=_('Force'),
+             doc=_('force NS record creation even if its hostname is not in '
+                   'DNS'),
+        ),
+    )
+
+    has_output = (
+        output.Output('result', dict, _('Import statistics')),
+        output.Output('failed', (list, tuple),
+                      _('Records which could not be imported')),
+        output.summary,
+        output.PrimaryKey('value'),
+    )
+
+    has_output_params = (
+        Int('records',
+            label=_('Records imported'),
+        ),
+        Int('entries',
+            label=_('Entries added'),
+        ),
+        Int('updated',
+            label=_('Entries updated'),
+        ),
+        Int('skipped',
+            label=_('Records skipped'),
+        ),
+    )
+
+    def _parse_zonefile(self, zone, zonefile):
+        try:
+            return dns.zone.from_text(
+                zonefile, origin=zone, relativize=True, check_origin=False)
+        except (dns.exception.DNSException, UnicodeError) as e:
+            raise errors.ValidationError(
+                name='file',
+                error=_('invalid zone file: %(error)s') % dict(
+                    error=unicode(e)))
+
+    def _node_to_entry_attrs(self, name, node, failed):
+        """
+        Convert a dnspython node to DNS record attributes, invalid and
+        unsupported records are appended to failed.
+        :return: (entry_attrs, records, skipped)
+        """
+        dnsrecord = self.api.Object.dnsrecord
+        entry_attrs = {}
+        ttls = []
+        records = []
+        skipped = 0
+
+        for rdataset in node:
+            rrtype = dns.rdatatype.to_text(rdataset.rdtype)
+            if rdataset.rdtype == dns.rdatatype.SOA:
+                # SOA is maintained by IPA
+                skipped += len(rdataset)
+                continue
+
+            attr = record_name_format % rrtype.lower()
+            param = dnsrecord.params.get(attr)
+            for rdata in rdataset:
+                value = unicode(rdata.to_text())
+                record = u'%s %s %s' % (name.ToASCII(), rrtype, value)
+                try:
+                    if param is None or not param.supported:
+                        raise errors.ValidationError(
+                            name=attr,
+                            error=_('DNS RR type "%s" is not supported by '
+                                    'bind-dyndb-ldap plugin') % rrtype)
+                    value = param(value)
+                    param.validate(value)
+                except errors.PublicError as e:
+                    failed.append((record, e))
+                    continue
+                entry_attrs.setdefault(attr, []).extend(value)
+                records.append(record)
+            ttls.append(rdataset.ttl)
+
+        if entry_attrs and ttls:
+            entry_attrs['dnsttl'] = [int(min(ttls))]
+
+        return entry_attrs, records, skipped
+
+    def _check_entry_attrs(self, dn, entry_attrs, old_entry, *keys,
+                           **options):
+        dnsrecord = self.api.Object.dnsrecord
+        dnsrecord.run_precallback_validators(dn, entry_attrs, *keys, **options)
+        rrattrs = dnsrecord.updated_rrattrs(old_entry, entry_attrs)
+        dnsrecord.check_record_type_dependencies(keys, rrattrs)
+        dnsrecord.check_record_type_collisions(keys, rrattrs)
+
+    def _merge_entry(self, ldap, dn, entry_attrs, *keys, **options):
+        """
+        Add records to an already existing entry, the same way as
+        dnsrecord-add does
+        """
+        old_entry = ldap.get_entry(dn, _record_attributes + ['dnsttl'])
+        for attr, values in entry_attrs.items():
+            if attr == 'dnsttl':
+                continue
+            entry_attrs[attr] = list(set(old_entry.get(attr, []) + values))
+        if old_entry.get('dnsttl'):
+            entry_attrs.pop('dnsttl', None)
+        self._check_entry_attrs(dn, entry_attrs, old_entry, *keys, **options)
+        old_entry.update(entry_attrs)
+        ldap.update_entry(old_entry)
+
+    def execute(self, *keys, **options):
+        ldap = self.obj.backend
+        dnsrecord = self.api.Object.dnsrecord
+        zone = keys[-1]
+
+        zone_dn = dnsrecord.check_zone(zone, **options)
+        zone_obj = self._parse_zonefile(zone, options['file'])
+
+        failed = []
+        stats = dict(records=0, entries=0, updated=0, skipped=0)
+        # DN -> (keys, entry_attrs, records)
+        to_merge = collections.OrderedDict()
+
+        def entries_iter():
+            for name, node in zone_obj.items():
+                name = DNSName(name)
+                entry_attrs, records, skipped = self._node_to_entry_attrs(
+                    name, node, failed)
+                stats['skipped'] += skipped
+                if not entry_attrs:
+                    continue
+
+                rkeys = (zone, name)
+                if dnsrecord.is_pkey_zone_record(*rkeys):
+                    dn = zone_dn
+                else:
+                    dn = DN(('idnsname', name.ToASCII()), zone_dn)
+
+                try:
+                    self._check_entry_attrs(dn, entry_attrs, None, *rkeys,
+                                            **options)
+                except errors.PublicError as e:
+                    failed.extend((record, e) for record in records)
+                    continue
+
+                if dn == zone_dn:
+                    # records in zone apex are stored in the zone entry
+                    to_merge[dn] = (rkeys, entry_attrs, records)
+                    continue
+
+                entry = ldap.make_entry(
+                    dn, entry_attrs,
+                    objectclass=list(dnsrecord.object_class),
+                    idnsname=[name],
+                )
+                entry_records[dn] = (rkeys, entry_attrs, records)
+                yield entry
+
+        entry_records = {}
+        for i, (entry, error) in enumerate(
+                ldap.add_entries(entries_iter(), options['window']), 1):
+            rkeys, entry_attrs, records = entry_records.pop(entry.dn)
+            if isinstance(error, errors.DuplicateEntry):
+                to_merge[entry.dn] = (rkeys, entry_attrs, records)
+            elif error is not None:
+                failed.extend((record, error) for record in records)
+            else:
+                stats['entries'] += 1
+                stats['records'] += len(records)
+
+            if i % self.progress_interval == 0:
+                self.log.info("Zone %s import: %d entries processed, "
+                              "%d records failed", zone, i, len(failed))
+
+        for dn, (rkeys, entry_attrs, records) in to_merge.items():
+            try:
+                self._merge_entry(ldap, dn, entry_attrs, *rkeys, **options)
+            except errors.EmptyModlist:
+                stats['skipped'] += len(records)
+            except errors.PublicError as e:
+                failed.extend((record, e) for record in records)
+            else:
+                stats['updated'] += 1
+                stats['records'] += len(records)
+
+        self.log.info("Zone %s import finished: %d records imported, "
+                      "%d records failed", zone, stats['records'],
+                      len(failed))
+
+        return dict(
+            result=stats,
+            failed=[u'%s: %s' % (record, unicode(error))
+                    for record, error in failed],
+            value=pkey_to_value(zone, options),
+        )
+
+
 @register()
 class dnsrecord(LDAPObject):
     """
@@ -3487,6 +3729,9 @@ class dnsrecord(LDAPObject):
         """Detect if NS record change can make forward zones ineffective due
         missing delegation. Run after parent's execute method.
         """
+        # the zone tree validated before the NS records were changed is
+        # outdated
+        invalidate_zone_tree()
         record_name_absolute = keys[-1]
         zone = keys[-2]
 
@@ -4281,6 +4526,9 @@ class dnsforwardzone(DNSZoneBase):
     # add them here, they should not be applied twice.
 
     def _warning_fw_zone_is_not_effective(self, result, *keys, **options):
+        # the zone tree validated before the forward zone was changed is
+        # outdated
+        invalidate_zone_tree()
         fwzone = keys[-1]
         _add_warning_fw_zone_is_not_effective(self.api, result, fwzone,
                                               options['version'])
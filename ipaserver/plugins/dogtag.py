@@ -242,6 +242,7 @@ digits and nothing else follows.
 import datetime
 import json
 from lxml import etree
+import threading
 import time
 
 import six
@@ -255,9 +256,11 @@ from ipapython import ipautil
 
 if api.env.in_server:
     import pki
+    import pki.account
     from pki.client import PKIConnection
     import pki.crypto as cryptoutil
     from pki.kra import KRAClient
+    import requests
 
 if six.PY3:
     unicode = str
@@ -278,6 +281,10 @@ CMS_STATUS_REJECTED     = 5
 CMS_STATUS_ERROR        = 6
 CMS_STATUS_EXCEPTION    = 7
 
+# Number of seconds an authenticated KRA client and the KRA transport
+# certificate are reused
+KRA_CLIENT_LIFETIME = 300
+
 
 def cms_request_status_to_string(request_status):
     '''
@@ -1978,6 +1985,12 @@ class kra(Backend):
 
         self.kra_port = kra_port
 
+        # authenticated KRA clients are reused by requests in each thread
+        self._local = threading.local()
+
+        # KRA transport certificate and the time it was retrieved
+        self._transport_cert = [None, 0]
+
         super(kra, self).__init__(api)
 
     @property
@@ -1987,6 +2000,9 @@ class kra(Backend):
                    as str
 
         Select our KRA host.
+
+        The host is selected again whenever a new KRA client is created, so
+        it is not pinned for longer than KRA_CLIENT_LIFETIME.
         """
         ldap2 = self.api.Backend.ldap2
         if host_has_service(api.env.ca_host, ldap2, "KRA"):
@@ -2004,9 +2020,92 @@ class kra(Backend):
         """
         Returns an authenticated KRA client to access KRA services.
 
+        The client is logged in to KRA and it is reused by subsequent calls
+        in the same thread for KRA_CLIENT_LIFETIME seconds. Use call() to
+        have the client replaced when its KRA session is no longer valid.
+
         Raises a generic exception if KRA is not enabled.
         """
+        client = getattr(self._local, 'client', None)
+        if (client is not None and
+                time.time() - self._local.created < KRA_CLIENT_LIFETIME):
+            return client
+
+        self._drop_client()
+        client = self._create_client()
+
+        kra_account = pki.account.AccountClient(client.connection)
+        kra_account.login()
+
+        self._local.client = client
+        self._local.created = time.time()
+
+        return client
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func(kra_client, *args, **kwargs) with an authenticated KRA
+        client and return its result.
+
+        If the call fails because the KRA session of the reused client is
+        no longer valid, e.g. after KRA was restarted, the client is dropped
+        and the call is retried once with a newly logged in client.
+        """
+        try:
+            return func(self.get_client(), *args, **kwargs)
+        except Exception as e:
+            if not self._is_session_error(e):
+                raise
+            self.debug('KRA session failed, logging in again: %s', e)
+            self._drop_client()
+        return func(self.get_client(), *args, **kwargs)
 
+    @staticmethod
+    def _is_session_error(e):
+        """
+        Return True if e was caused by an expired KRA session or by
+        a broken connection to KRA
+        """
+        if isinstance(e, requests.exceptions.ConnectionError):
+            return True
+        if isinstance(e, requests.exceptions.HTTPError):
+            return (e.response is not None and
+                    e.response.status_code == 401)
+        if isinstance(e, pki.PKIException):
+            return getattr(e, 'code', None) == 401
+        return False
+
+    def _drop_client(self):
+        """
+        Log out and forget the KRA client of the current thread
+        """
+        client = getattr(self._local, 'client', None)
+        self._local.client = None
+        if client is None:
+            return
+        try:
+            pki.account.AccountClient(client.connection).logout()
+        except Exception as e:
+            self.debug('Failed to log out of KRA: %s', e)
+
+    def get_transport_cert(self):
+        """
+        Returns the KRA transport certificate in DER format.
+
+        The certificate is retrieved from KRA at most once in
+        KRA_CLIENT_LIFETIME seconds.
+        """
+        transport_cert, retrieved = self._transport_cert
+        if (transport_cert is None or
+                time.time() - retrieved >= KRA_CLIENT_LIFETIME):
+            transport_cert = self.call(
+                lambda kra_client:
+                    kra_client.system_certs.get_transport_cert())
+            transport_cert = transport_cert.binary
+            self._transport_cert[:] = [transport_cert, time.time()]
+        return transport_cert
+
+    def _create_client(self):
         if not self.api.Command.kra_is_enabled()['result']:
             # TODO: replace this with a more specific exception
             raise RuntimeError('KRA service is not enabled')
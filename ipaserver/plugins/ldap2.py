@@ -35,7 +35,7 @@ import ldap as _ldap
 from ipalib import krb_utils
 from ipapython.dn import DN
 from ipapython.ipaldap import (LDAPClient, AUTOBIND_AUTO, AUTOBIND_ENABLED,
-                               AUTOBIND_DISABLED)
+                               AUTOBIND_DISABLED, DEFAULT_PIPELINE_WINDOW)
 
 
 try:
@@ -247,6 +247,30 @@ class ldap2(CrudBackend, LDAPClient):
         context.config_entry = config_entry
         return config_entry
 
+    def get_last_usn(self):
+        """
+        Return the last USN of the directory server or None if the entryUSN
+        plugin does not provide it.
+        """
+        try:
+            root_dse = self.get_entry(DN(), ['lastusn'])
+        except errors.NotFound:
+            return None
+
+        usns = {}
+        for attr, value in root_dse.raw.items():
+            if attr.lower().split(';')[0] == 'lastusn' and value:
+                try:
+                    usns[attr.lower()] = int(value[0])
+                except ValueError:
+                    continue
+        if not usns:
+            return None
+        if 'lastusn' in usns:
+            # nsslapd-entryusn-global: on
+            return usns['lastusn']
+        return min(usns.values())
+
     def has_upg(self):
         """Returns True/False whether User-Private Groups are enabled.
 
@@ -420,6 +444,31 @@ class ldap2(CrudBackend, LDAPClient):
         except errors.DatabaseError:
             raise errors.AlreadyGroupMember()
 
+    def add_entries_to_groups(self, members, member_attr='member',
+                              window=DEFAULT_PIPELINE_WINDOW):
+        """
+        Add entries to groups, pipelining the modify operations.
+
+        members is an iterable of (group_dn, dns) tuples, the entries
+        designated by dns are added to group group_dn in the member attribute
+        member_attr in a single modify operation. Unlike add_entry_to_group(),
+        the existence of the entries is not checked.
+
+        This is a generator which yields ((group_dn, dns), error) tuples in
+        the order of members, see add_entries(). The whole modify operation
+        fails with errors.DatabaseError if any of the entries is already a
+        member of the group.
+        """
+        def send(item):
+            group_dn, dns = item
+            assert isinstance(group_dn, DN)
+            modlist = [(_ldap.MOD_ADD, member_attr, list(dns))]
+            modlist = [(a, self.encode(b), self.encode(c))
+                       for a, b, c in modlist]
+            return self.conn.modify_ext(str(group_dn), modlist)
+
+        return self._pipeline(members, send, window)
+
     def remove_entry_from_group(self, dn, group_dn, member_attr='member'):
         """Remove entry from group."""
 
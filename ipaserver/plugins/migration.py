@@ -17,14 +17,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import itertools
+import json
 import re
-from ldap import MOD_ADD
+from ldap import MOD_ADD, MOD_DELETE
 from ldap import SCOPE_BASE, SCOPE_ONELEVEL, SCOPE_SUBTREE
 
 import six
 
 from ipalib import api, errors, output
-from ipalib import Command, Password, Str, Flag, StrEnum, DNParam, Bool
+from ipalib import Command, Password, Str, Flag, StrEnum, DNParam, Bool, Int
 from ipalib.cli import to_cli
 from ipalib.plugable import Registry
 from .user import NO_UPG_MAGIC
@@ -34,6 +36,7 @@ if api.env.in_server and api.env.context in ['lite', 'server']:
     except Exception as e:
         raise e
 from ipalib import _
+from ipapython import ipaldap
 from ipapython.dn import DN
 from ipapython.ipautil import write_tmp_file
 from ipapython.kerberos import Principal
@@ -120,6 +123,13 @@ EXAMPLES:
        --user-ignore-attribute=radiusgroupname \\
        ldap://ds.example.com:389
 
+ Migrate users and groups in runs of at most one hour:
+   ipa migrate-ds --time-limit=3600 ldap://ds.example.com:389
+   ipa migrate-ds --resume --time-limit=3600 ldap://ds.example.com:389
+
+ Show progress of the migration:
+   ipa migrate-ds --status ldap://ds.example.com:389
+
 LOGGING
 
 Migration will log warnings and errors to the Apache error log. This
@@ -132,8 +142,23 @@ the progress of migration.
 
 If the log level is debug, either by setting debug = True in
 /etc/ipa/default.conf or /etc/ipa/server.conf, then an entry will be printed
-for each user added plus a summary when the default user group is
-updated.
+for each batch of users added plus a summary when the default user group
+is updated.
+
+Entries are read from the remote server in pages and added to IPA in
+batches, so the migration does not need to hold the whole remote user or
+group container in memory.
+
+CHECKPOINTS
+
+The progress of migration is stored in IPA after every batch of entries.
+An interrupted migration can be continued with the "--resume" option,
+users and groups which were already migrated are skipped. The
+"--time-limit" option stops the migration after the given number of
+seconds, which allows to split a large migration into several runs. The
+"--status" option shows the stored progress and the entries which failed
+to migrate, it does not connect to the remote server and does not need the
+bind password.
 """)
 
 register = Registry()
@@ -148,6 +173,10 @@ _dn_err_msg = _('Malformed DN')
 
 _supported_schemas = (u'RFC2307bis', u'RFC2307')
 
+# maximal number of remote entries referred by DN attributes of migrated users
+# kept in memory
+_remote_entry_cache_size = 10000
+
 # search scopes for users and groups when migrating
 _supported_scopes = {u'base': SCOPE_BASE, u'onelevel': SCOPE_ONELEVEL, u'subtree': SCOPE_SUBTREE}
 _default_scope = u'onelevel'
@@ -248,6 +277,7 @@ def _pre_migrate_user(ldap, pkey, dn, entry_attrs, failed, config, ctx, **kwargs
     # Fix any attributes with DN syntax that point to entries in the old
     # tree
 
+    remote_entries = ctx.setdefault('remote_entries', {})
     for attr in entry_attrs.keys():
         if ldap.has_dn_syntax(attr):
             for ind, value in enumerate(entry_attrs[attr]):
@@ -264,9 +294,19 @@ def _pre_migrate_user(ldap, pkey, dn, entry_attrs, failed, config, ctx, **kwargs
                             'in attribute %s which could not be converted to DN: %s',
                                 pkey, value, type(value), attr, e)
                         continue
+                # the same entries (e.g. managers) are usually referred
+                # from many users, remember them
                 try:
-                    remote_entry = ds_ldap.get_entry(value, [api.Object.user.primary_key.name, api.Object.group.primary_key.name])
-                except errors.NotFound:
+                    remote_entry = remote_entries[value]
+                except KeyError:
+                    try:
+                        remote_entry = ds_ldap.get_entry(value, [api.Object.user.primary_key.name, api.Object.group.primary_key.name])
+                    except errors.NotFound:
+                        remote_entry = None
+                    if len(remote_entries) >= _remote_entry_cache_size:
+                        remote_entries.clear()
+                    remote_entries[value] = remote_entry
+                if remote_entry is None:
                     api.log.warning('%s: attribute %s refers to non-existent entry %s' % (pkey, attr, value))
                     continue
                 if value.endswith(search_bases['user']):
@@ -449,6 +489,227 @@ def _group_exc_callback(ldap, dn, entry_attrs, exc, options):
 
     raise exc
 
+# MIGRATION CHECKPOINT
+
+class MigrationCheckpoint(object):
+    """
+    Progress of migration from a single DS server, stored in LDAP after
+    every processed batch of entries so that an interrupted migration can
+    be resumed on any IPA server.
+
+    The entry cn=<LDAP URI>,cn=migration,cn=etc,$SUFFIX holds one
+    ipaConfigString value (a JSON list) for each recorded fact:
+
+        ["done", OBJ]                 all entries of OBJ were processed
+        ["last", OBJ, PKEY]           last processed primary key of OBJ
+        ["count", OBJ, N]             number of migrated entries of OBJ
+        ["pending", OBJ, [PKEY, ...]] entries of OBJ which are being added,
+                                      their post callback may not have run
+
+    Every entry which failed to migrate is stored in a child entry
+    cn=OBJ:PKEY with a single ipaConfigString value:
+
+        ["failed", OBJ, PKEY, MSG]
+
+    Only changed values and child entries are written, so the cost of
+    saving a batch does not grow with the number of recorded failures.
+    """
+
+    def __init__(self, ldap, ldapuri):
+        self.ldap = ldap
+        self.dn = DN(('cn', ldapuri.lower()), api.env.container_migration,
+                     api.env.basedn)
+        self.exists = False
+        self.done = set()
+        self.last = {}
+        self.count = {}
+        self.pending = {}
+        self.failed = {}
+        # values as stored in LDAP
+        self.stored_state = set()
+        self.stored_failed = {}
+
+    @staticmethod
+    def _encode(value):
+        return unicode(json.dumps(value, sort_keys=True))
+
+    def _failed_dn(self, ldap_obj_name, pkey):
+        return DN(('cn', u'%s:%s' % (ldap_obj_name, pkey)), self.dn)
+
+    def _get_failed_entries(self):
+        try:
+            entries, _truncated = self.ldap.find_entries(
+                filter='(objectclass=ipaconfigobject)',
+                attrs_list=['ipaconfigstring'],
+                base_dn=self.dn,
+                scope=self.ldap.SCOPE_ONELEVEL,
+                paged_search=True, time_limit=0, size_limit=0,
+            )
+        except errors.NotFound:
+            entries = []
+        return entries
+
+    def load(self):
+        """
+        Load the checkpoint from LDAP
+
+        :returns: False if there is no checkpoint stored
+        """
+        try:
+            entry = self.ldap.get_entry(self.dn, ['ipaconfigstring'])
+        except errors.NotFound:
+            return False
+
+        self.exists = True
+        for raw_value in entry.get('ipaconfigstring', []):
+            try:
+                value = json.loads(raw_value)
+                kind, ldap_obj_name = value[:2]
+                if kind == u'done':
+                    self.done.add(ldap_obj_name)
+                elif kind == u'last':
+                    self.last[ldap_obj_name] = value[2]
+                elif kind == u'count':
+                    self.count[ldap_obj_name] = int(value[2])
+                elif kind == u'pending':
+                    self.pending[ldap_obj_name] = list(value[2])
+                self.stored_state.add(raw_value)
+            except (ValueError, TypeError, IndexError):
+                api.log.warning('%s: ignoring malformed checkpoint value %s',
+                                self.dn, raw_value)
+
+        for failed_entry in self._get_failed_entries():
+            raw_value = failed_entry.single_value.get('ipaconfigstring')
+            try:
+                _kind, ldap_obj_name, pkey, msg = json.loads(raw_value)
+            except (ValueError, TypeError):
+                api.log.warning('%s: ignoring malformed checkpoint value %s',
+                                failed_entry.dn, raw_value)
+                continue
+            self.failed.setdefault(ldap_obj_name, {})[pkey] = msg
+            self.stored_failed.setdefault(ldap_obj_name, {})[pkey] = msg
+        return True
+
+    def reset(self):
+        """
+        Remove the stored checkpoint and start a new one
+        """
+        for failed_entry in self._get_failed_entries():
+            try:
+                self.ldap.delete_entry(failed_entry.dn)
+            except errors.NotFound:
+                pass
+        try:
+            self.ldap.delete_entry(self.dn)
+        except errors.NotFound:
+            pass
+        self.exists = False
+        self.done = set()
+        self.last = {}
+        self.count = {}
+        self.pending = {}
+        self.failed = {}
+        self.stored_state = set()
+        self.stored_failed = {}
+
+    def _save_failed(self, ldap_obj_name, pkeys):
+        failed = self.failed.get(ldap_obj_name, {})
+        stored = self.stored_failed.setdefault(ldap_obj_name, {})
+        for pkey in pkeys:
+            old_msg = stored.get(pkey)
+            new_msg = failed.get(pkey)
+            if old_msg == new_msg:
+                continue
+            dn = self._failed_dn(ldap_obj_name, pkey)
+            if new_msg is None:
+                try:
+                    self.ldap.delete_entry(dn)
+                except errors.NotFound:
+                    pass
+                del stored[pkey]
+                continue
+            value = self._encode([u'failed', ldap_obj_name, pkey, new_msg])
+            if old_msg is None:
+                entry = self.ldap.make_entry(
+                    dn,
+                    objectclass=['top', 'nsContainer', 'ipaConfigObject'],
+                    cn=[dn[0].value],
+                    ipaconfigstring=[value],
+                )
+                try:
+                    self.ldap.add_entry(entry)
+                except errors.DuplicateEntry:
+                    # left over by a save which was interrupted
+                    pass
+                else:
+                    stored[pkey] = new_msg
+                    continue
+            entry = self.ldap.get_entry(dn, ['ipaconfigstring'])
+            entry['ipaconfigstring'] = [value]
+            try:
+                self.ldap.update_entry(entry)
+            except errors.EmptyModlist:
+                pass
+            stored[pkey] = new_msg
+
+    def save(self, ldap_obj_name=None, pkeys=()):
+        """
+        Store the checkpoint in LDAP
+
+        Failures are updated only for the primary keys pkeys of
+        ldap_obj_name, i.e. the entries processed since the last save().
+        """
+        state = set()
+        for name in self.done:
+            state.add(self._encode([u'done', name]))
+        for name, pkey in self.last.items():
+            state.add(self._encode([u'last', name, pkey]))
+        for name, count in self.count.items():
+            state.add(self._encode([u'count', name, count]))
+        for name, pending in self.pending.items():
+            state.add(self._encode([u'pending', name, pending]))
+
+        adds = sorted(state - self.stored_state)
+        dels = sorted(self.stored_state - state)
+
+        if not self.exists:
+            entry = self.ldap.make_entry(
+                self.dn,
+                objectclass=['top', 'nsContainer', 'ipaConfigObject'],
+                cn=[self.dn[0].value],
+                ipaconfigstring=adds,
+            )
+            self.ldap.add_entry(entry)
+            self.exists = True
+        elif adds or dels:
+            modlist = []
+            if dels:
+                modlist.append(
+                    (MOD_DELETE, 'ipaconfigstring', self.ldap.encode(dels)))
+            if adds:
+                modlist.append(
+                    (MOD_ADD, 'ipaconfigstring', self.ldap.encode(adds)))
+            with self.ldap.error_handler():
+                self.ldap.conn.modify_s(str(self.dn), modlist)
+        self.stored_state = state
+
+        if ldap_obj_name is not None:
+            self._save_failed(ldap_obj_name, pkeys)
+
+    def get_status(self, migrate_order):
+        """
+        :returns: {'OBJ': {'done': bool, 'migrated': N, 'last': PKEY}, ...}
+        """
+        status = {}
+        for ldap_obj_name in migrate_order:
+            status[ldap_obj_name] = dict(
+                done=ldap_obj_name in self.done,
+                migrated=self.count.get(ldap_obj_name, 0),
+                last=self.last.get(ldap_obj_name),
+            )
+        return status
+
+
 # DS MIGRATION PLUGIN
 
 def construct_filter(template, oc_list):
@@ -508,17 +769,22 @@ class migrate_ds(Command):
     }
     migrate_order = ('user', 'group')
 
+    # number of entries read from DS and processed in one batch
+    page_size = ipaldap.DEFAULT_PAGE_SIZE
+    # maximal number of add operations waiting for a result
+    pipeline_window = ipaldap.DEFAULT_PIPELINE_WINDOW
+
     takes_args = (
         Str('ldapuri', validate_ldapuri,
             cli_name='ldap_uri',
             label=_('LDAP URI'),
             doc=_('LDAP URI of DS server to migrate from'),
         ),
-        Password('bindpw',
+        Password('bindpw?',
             cli_name='password',
             label=_('Password'),
             confirm=False,
-            doc=_('bind password'),
+            doc=_('bind password, not required with --status'),
         ),
     )
 
@@ -639,6 +905,23 @@ class migrate_ds(Command):
             default=_default_scope,
             autofill=True,
         ),
+        Flag('resume?',
+            label=_('Resume'),
+            doc=_('Resume interrupted migration from the stored checkpoint'),
+            default=False,
+        ),
+        Flag('status?',
+            label=_('Status'),
+            doc=_('Show the stored migration checkpoint without migrating'),
+            default=False,
+        ),
+        Int('timelimit?',
+            cli_name='time_limit',
+            label=_('Time limit'),
+            doc=_('Stop the migration after the given number of seconds, '
+                  'use --resume to continue'),
+            minvalue=1,
+        ),
     )
 
     has_output = (
@@ -658,6 +941,10 @@ class migrate_ds(Command):
             type=bool,
             doc=_('False if migration fails because the compatibility plug-in is enabled.'),
         ),
+        output.Output('checkpoint',
+            type=dict,
+            doc=_('State of the migration checkpoint; categorized by type.'),
+        ),
     )
 
     exclude_doc = _('%s to exclude from migration')
@@ -702,6 +989,28 @@ migration process might be incomplete\n''')
             else:
                 options[name] = tuple()
 
+    def _iter_batches(self, ldap_obj, entries):
+        """
+        Split entries from the remote server into batches of `page_size`
+        entries. Truncation of the search by the remote server is logged,
+        entries received until then are still migrated.
+        """
+        batch = []
+        try:
+            for entry in entries:
+                batch.append(entry)
+                if len(batch) >= self.page_size:
+                    yield batch
+                    batch = []
+        except errors.LimitsExceeded:
+            self.log.error(
+                '%s: %s' % (
+                    ldap_obj.name, self.truncated_err_msg
+                )
+            )
+        if batch:
+            yield batch
+
     def _get_search_bases(self, options, ds_base_dn, migrate_order):
         search_bases = dict()
         for ldap_obj_name in migrate_order:
@@ -717,21 +1026,75 @@ migration process might be incomplete\n''')
             search_bases[ldap_obj_name] = search_base
         return search_bases
 
-    def migrate(self, ldap, config, ds_ldap, ds_base_dn, options):
+    def _get_existing_pkeys(self, ldap, ldap_obj, pkeys):
+        """
+        Return the subset of primary keys of entries which already exist
+        in IPA
+        """
+        if not pkeys:
+            return set()
+
+        pkey_name = ldap_obj.primary_key.name
+        try:
+            entries, _truncated = ldap.find_entries(
+                ldap.make_filter_from_attr(pkey_name, list(pkeys)),
+                [pkey_name], DN(ldap_obj.container_dn, api.env.basedn),
+                scope=ldap.SCOPE_ONELEVEL, time_limit=-1, size_limit=-1)
+        except errors.NotFound:
+            return set()
+
+        return set(
+            e.single_value[pkey_name].lower() for e in entries
+            if e.get(pkey_name))
+
+    def migrate(self, ldap, config, ds_ldap, ds_base_dn, options,
+                checkpoint):
         """
         Migrate objects from DS to LDAP.
+
+        Progress is recorded in checkpoint after every batch of entries.
         """
         assert isinstance(ds_base_dn, DN)
         migrated = {} # {'OBJ': ['PKEY1', 'PKEY2', ...], ...}
         failed = {} # {'OBJ': {'PKEY1': 'Failed 'cos blabla', ...}, ...}
         search_bases = self._get_search_bases(options, ds_base_dn, self.migrate_order)
         migration_start = datetime.datetime.now()
+        timelimit = options.get('timelimit')
+        complete = True
+        context = {}
 
         scope = _supported_scopes[options.get('scope')]
 
         for ldap_obj_name in self.migrate_order:
             ldap_obj = self.api.Object[ldap_obj_name]
 
+            # failures recorded in previous runs are kept until the entry is
+            # migrated successfully
+            migrated[ldap_obj_name] = []
+            failed[ldap_obj_name] = checkpoint.failed.setdefault(
+                ldap_obj_name, {})
+
+            if ldap_obj_name in checkpoint.done:
+                api.log.info("%ss already migrated, skipping", ldap_obj_name)
+                continue
+
+            if not complete:
+                continue
+
+            # entries migrated before the migration was interrupted are
+            # skipped. The order of entries returned by DS is not
+            # guaranteed, so the entries which already exist are looked up
+            # in IPA, instead of skipping entries up to the last pkey.
+            # Entries added by the interrupted migration whose post callback
+            # may not have run get it run again when they are found in IPA.
+            post_pending = set(checkpoint.pending.get(ldap_obj_name, []))
+            resuming = ldap_obj_name in checkpoint.last or bool(post_pending)
+            if resuming:
+                api.log.info(
+                    "Resuming migration of %ss, %d migrated, last %s",
+                    ldap_obj_name, checkpoint.count.get(ldap_obj_name, 0),
+                    checkpoint.last.get(ldap_obj_name))
+
             template = self.migrate_objects[ldap_obj_name]['filter_template']
             oc_list = options[to_cli(self.migrate_objects[ldap_obj_name]['oc_option'])]
             search_filter = construct_filter(template, oc_list)
@@ -739,17 +1102,19 @@ migration process might be incomplete\n''')
             exclude = options['exclude_%ss' % to_cli(ldap_obj_name)]
             context = dict(ds_ldap = ds_ldap)
 
-            migrated[ldap_obj_name] = []
-            failed[ldap_obj_name] = {}
-
+            entries = ds_ldap.iter_entries(
+                search_filter, ['*'], search_bases[ldap_obj_name],
+                scope,
+                time_limit=0,
+                search_refs=True,   # migrated DS may contain search references
+                page_size=self.page_size
+            )
+            batches = self._iter_batches(ldap_obj, entries)
             try:
-                entries, truncated = ds_ldap.find_entries(
-                    search_filter, ['*'], search_bases[ldap_obj_name],
-                    scope,
-                    time_limit=0, size_limit=-1,
-                    search_refs=True    # migrated DS may contain search references
-                )
+                first_batch = next(batches, None)
             except errors.NotFound:
+                first_batch = None
+            if first_batch is None:
                 if not options.get('continue',False):
                     raise errors.NotFound(
                         reason=_('%(container)s LDAP search did not return any result '
@@ -760,14 +1125,9 @@ migration process might be incomplete\n''')
                                     'objectclass': ', '.join(oc_list)}
                     )
                 else:
-                    truncated = False
-                    entries = []
-            if truncated:
-                self.log.error(
-                    '%s: %s' % (
-                        ldap_obj.name, self.truncated_err_msg
-                    )
-                )
+                    batches = iter([])
+            else:
+                batches = itertools.chain([first_batch], batches)
 
             blacklists = {}
             for blacklist in ('oc_blacklist', 'attr_blacklist'):
@@ -793,86 +1153,161 @@ migration process might be incomplete\n''')
             invalid_gids = set()
             migrate_cnt = 0
             context['migrate_cnt'] = 0
-            for entry_attrs in entries:
-                context['migrate_cnt'] = migrate_cnt
+            for batch in batches:
                 s = datetime.datetime.now()
-
-                ava = entry_attrs.dn[0][0]
-                if ava.attr == ldap_obj.primary_key.name:
-                    # In case if pkey attribute is in the migrated object DN
-                    # and the original LDAP is multivalued, make sure that
-                    # we pick the correct value (the unique one stored in DN)
-                    pkey = ava.value.lower()
+                migrated_before = len(migrated[ldap_obj_name])
+
+                pkeys = []
+                for entry_attrs in batch:
+                    ava = entry_attrs.dn[0][0]
+                    if ava.attr == ldap_obj.primary_key.name:
+                        # In case if pkey attribute is in the migrated object DN
+                        # and the original LDAP is multivalued, make sure that
+                        # we pick the correct value (the unique one stored in DN)
+                        pkey = ava.value.lower()
+                    else:
+                        pkey = entry_attrs[ldap_obj.primary_key.name][0].lower()
+                    pkeys.append(pkey)
+
+                if resuming:
+                    existing = self._get_existing_pkeys(
+                        ldap, ldap_obj,
+                        set(p for p in pkeys
+                            if p not in failed[ldap_obj_name]))
                 else:
-                    pkey = entry_attrs[ldap_obj.primary_key.name][0].lower()
+                    existing = set()
 
-                if pkey in exclude:
-                    continue
+                post_callback = self.migrate_objects[ldap_obj_name]['post_callback']
+                for pkey in pkeys:
+                    if pkey not in existing or pkey not in post_pending:
+                        continue
+                    post_pending.discard(pkey)
+                    migrated[ldap_obj_name].append(pkey)
+                    if not callable(post_callback):
+                        continue
+                    dn = ldap_obj.get_dn(pkey)
+                    try:
+                        entry_attrs = ldap.get_entry(dn, ['*'])
+                    except errors.NotFound:
+                        continue
+                    context['migrate_cnt'] = migrate_cnt
+                    post_callback(
+                        ldap, pkey, dn, entry_attrs,
+                        failed[ldap_obj_name], config, context)
+                    migrate_cnt += 1
 
-                entry_attrs.dn = ldap_obj.get_dn(pkey)
-                entry_attrs['objectclass'] = list(
-                    set(
-                        config.get(
-                            ldap_obj.object_class_config, ldap_obj.object_class
-                        ) + [o.lower() for o in entry_attrs['objectclass']]
-                    )
-                )
-                entry_attrs[ldap_obj.primary_key.name][0] = entry_attrs[ldap_obj.primary_key.name][0].lower()
+                # transform entries of the whole batch first, so that they
+                # can be added with pipelined operations
+                prepared = []
+                for pkey, entry_attrs in zip(pkeys, batch):
+                    if pkey in exclude or pkey in existing:
+                        continue
 
-                callback = self.migrate_objects[ldap_obj_name]['pre_callback']
-                if callable(callback):
-                    try:
-                        entry_attrs.dn = callback(
-                            ldap, pkey, entry_attrs.dn, entry_attrs,
-                            failed[ldap_obj_name], config, context,
-                            schema=options['schema'],
-                            search_bases=search_bases,
-                            valid_gids=valid_gids,
-                            invalid_gids=invalid_gids,
-                            **blacklists
+                    entry_attrs.dn = ldap_obj.get_dn(pkey)
+                    entry_attrs['objectclass'] = list(
+                        set(
+                            config.get(
+                                ldap_obj.object_class_config, ldap_obj.object_class
+                            ) + [o.lower() for o in entry_attrs['objectclass']]
                         )
-                        if not entry_attrs.dn:
-                            continue
-                    except errors.NotFound as e:
-                        failed[ldap_obj_name][pkey] = unicode(e.reason)
-                        continue
+                    )
+                    entry_attrs[ldap_obj.primary_key.name][0] = entry_attrs[ldap_obj.primary_key.name][0].lower()
 
-                try:
-                    ldap.add_entry(entry_attrs)
-                except errors.ExecutionError as e:
-                    callback = self.migrate_objects[ldap_obj_name]['exc_callback']
+                    callback = self.migrate_objects[ldap_obj_name]['pre_callback']
                     if callable(callback):
                         try:
-                            callback(
-                                ldap, entry_attrs.dn, entry_attrs, e, options)
-                        except errors.ExecutionError as e:
+                            entry_attrs.dn = callback(
+                                ldap, pkey, entry_attrs.dn, entry_attrs,
+                                failed[ldap_obj_name], config, context,
+                                schema=options['schema'],
+                                search_bases=search_bases,
+                                valid_gids=valid_gids,
+                                invalid_gids=invalid_gids,
+                                **blacklists
+                            )
+                            if not entry_attrs.dn:
+                                continue
+                        except errors.NotFound as e:
+                            failed[ldap_obj_name][pkey] = unicode(e.reason)
+                            continue
+
+                    prepared.append((pkey, entry_attrs))
+
+                # the post callback of the added entries has to be run
+                # again if the migration is interrupted before the batch is
+                # saved
+                if prepared:
+                    checkpoint.pending[ldap_obj_name] = sorted(
+                        post_pending.union(pkey for pkey, _entry in prepared))
+                    checkpoint.save()
+
+                results = ldap.add_entries(
+                    (entry_attrs for _pkey, entry_attrs in prepared),
+                    window=self.pipeline_window)
+
+                for (pkey, entry_attrs), (_entry, e) in zip(prepared, results):
+                    if e is not None:
+                        if not isinstance(e, errors.ExecutionError):
+                            raise e
+                        callback = self.migrate_objects[ldap_obj_name]['exc_callback']
+                        if callable(callback):
+                            try:
+                                callback(
+                                    ldap, entry_attrs.dn, entry_attrs, e, options)
+                            except errors.ExecutionError as e:
+                                failed[ldap_obj_name][pkey] = unicode(e)
+                                continue
+                        else:
                             failed[ldap_obj_name][pkey] = unicode(e)
                             continue
-                    else:
-                        failed[ldap_obj_name][pkey] = unicode(e)
-                        continue
 
-                migrated[ldap_obj_name].append(pkey)
+                    migrated[ldap_obj_name].append(pkey)
+                    failed[ldap_obj_name].pop(pkey, None)
+
+                    context['migrate_cnt'] = migrate_cnt
+                    if callable(post_callback):
+                        post_callback(
+                            ldap, pkey, entry_attrs.dn, entry_attrs,
+                            failed[ldap_obj_name], config, context)
+                    migrate_cnt += 1
+                    if migrate_cnt > 0 and migrate_cnt % 100 == 0:
+                        api.log.info("%d %ss migrated. %s elapsed." % (migrate_cnt, ldap_obj_name, datetime.datetime.now() - migration_start))
+                if post_pending:
+                    checkpoint.pending[ldap_obj_name] = sorted(post_pending)
+                else:
+                    checkpoint.pending.pop(ldap_obj_name, None)
+                if pkeys:
+                    checkpoint.last[ldap_obj_name] = pkeys[-1]
+                checkpoint.count[ldap_obj_name] = (
+                    checkpoint.count.get(ldap_obj_name, 0) +
+                    len(migrated[ldap_obj_name]) - migrated_before)
+                checkpoint.save(ldap_obj_name, pkeys)
 
-                callback = self.migrate_objects[ldap_obj_name]['post_callback']
-                if callable(callback):
-                    callback(
-                        ldap, pkey, entry_attrs.dn, entry_attrs,
-                        failed[ldap_obj_name], config, context)
                 e = datetime.datetime.now()
                 d = e - s
                 total_dur = e - migration_start
-                migrate_cnt += 1
-                if migrate_cnt > 0 and migrate_cnt % 100 == 0:
-                    api.log.info("%d %ss migrated. %s elapsed." % (migrate_cnt, ldap_obj_name, total_dur))
-                api.log.debug("%d %ss migrated, duration: %s (total %s)" % (migrate_cnt, ldap_obj_name, d, total_dur))
+                api.log.debug("%d %ss migrated, batch of %d duration: %s (total %s)" % (migrate_cnt, ldap_obj_name, len(batch), d, total_dur))
+
+                if timelimit and total_dur.total_seconds() >= timelimit:
+                    api.log.info(
+                        "Time limit reached, %d %ss migrated. Use --resume "
+                        "to continue the migration.",
+                        migrate_cnt, ldap_obj_name)
+                    complete = False
+                    break
+            else:
+                # pending entries which were not found again are not
+                # migrated
+                checkpoint.pending.pop(ldap_obj_name, None)
+                checkpoint.done.add(ldap_obj_name)
+                checkpoint.save()
 
         if 'def_group_dn' in context:
             _update_default_group(ldap, context, True)
 
         return (migrated, failed)
 
-    def execute(self, ldapuri, bindpw, **options):
+    def execute(self, ldapuri, bindpw=None, **options):
         ldap = self.api.Backend.ldap2
         self.normalize_options(options)
         config = ldap.get_ipa_config()
@@ -883,7 +1318,25 @@ migration process might be incomplete\n''')
 
         # check if migration mode is enabled
         if config.get('ipamigrationenabled', ('FALSE', ))[0] == 'FALSE':
-            return dict(result={}, failed={}, enabled=False, compat=True)
+            return dict(result={}, failed={}, enabled=False, compat=True,
+                        checkpoint={})
+
+        checkpoint = MigrationCheckpoint(ldap, ldapuri)
+        if options.get('status'):
+            if not checkpoint.load():
+                raise errors.NotFound(
+                    reason=_('No migration checkpoint found for %(uri)s')
+                    % {'uri': ldapuri})
+            return dict(
+                result=dict((o, []) for o in self.migrate_order),
+                failed=dict(
+                    (o, checkpoint.failed.get(o, {}))
+                    for o in self.migrate_order),
+                enabled=True, compat=True,
+                checkpoint=checkpoint.get_status(self.migrate_order))
+
+        if bindpw is None:
+            raise errors.RequirementError(name='bindpw')
 
         # connect to DS
         ds_ldap = ldap2(self.api, ldap_uri=ldapuri)
@@ -906,7 +1359,8 @@ migration process might be incomplete\n''')
         if not options.get('compat'):
             try:
                 ldap.get_entry(DN(('cn', 'compat'), (api.env.basedn)))
-                return dict(result={}, failed={}, enabled=True, compat=False)
+                return dict(result={}, failed={}, enabled=True, compat=False,
+                            checkpoint={})
             except errors.NotFound:
                 pass
 
@@ -926,9 +1380,13 @@ migration process might be incomplete\n''')
                 except (IndexError, KeyError) as e:
                     raise Exception(str(e))
 
+        if not options.get('resume') or not checkpoint.load():
+            checkpoint.reset()
+
         # migrate!
         (migrated, failed) = self.migrate(
-            ldap, config, ds_ldap, ds_base_dn, options
+            ldap, config, ds_ldap, ds_base_dn, options, checkpoint
         )
 
-        return dict(result=migrated, failed=failed, enabled=True, compat=True)
+        return dict(result=migrated, failed=failed, enabled=True, compat=True,
+                    checkpoint=checkpoint.get_status(self.migrate_order))
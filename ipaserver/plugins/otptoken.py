@@ -112,6 +112,66 @@ def _check_interval(not_before, not_after):
         return not_before <= not_after
     return True
 
+def _find_current_user(api):
+    result = api.Command.user_find(whoami=True, no_members=False)['result']
+    if result:
+        return result[0]
+    return None
+
+def prepare_token_entry(api, entry_attrs, find_current_user=None,
+                        owners=None, **options):
+    """Check a new token entry and fill in its object class and defaults.
+
+    Used by otptoken-add and by ipa-otptoken-import, which creates token
+    entries without running the command.
+
+    :param find_current_user: callable returning the user_find(whoami=True)
+        result entry of the user adding the token or None, the user is
+        looked up when it is not given
+    :param owners: dict of owner DNs by owner name, if given owner DNs are
+        looked up only once
+    """
+    if not _check_interval(options.get('ipatokennotbefore', None),
+                           options.get('ipatokennotafter', None)):
+        raise ValidationError(name='not_after',
+                              error='is before the validity start')
+
+    # Set the object class and defaults for specific token types
+    token_type = options['type'].lower()
+    entry_attrs['objectclass'] = (api.Object.otptoken.object_class +
+                                  ['ipatoken' + token_type])
+    for ttype, tattrs in TOKEN_TYPES.items():
+        if ttype != token_type:
+            for tattr in tattrs:
+                if tattr in entry_attrs:
+                    del entry_attrs[tattr]
+
+    # If owner was not specified, default to the person adding this token.
+    # If managedby was not specified, attempt a sensible default.
+    if 'ipatokenowner' not in entry_attrs or 'managedby' not in entry_attrs:
+        if find_current_user is None:
+            current_user = _find_current_user(api)
+        else:
+            current_user = find_current_user()
+        if current_user:
+            cur_uid = current_user['uid'][0]
+            prev_uid = entry_attrs.setdefault('ipatokenowner', cur_uid)
+            if cur_uid == prev_uid:
+                entry_attrs.setdefault('managedby', current_user['dn'])
+
+    # Resolve the owner's dn
+    owner = entry_attrs.get('ipatokenowner', None)
+    if owners is not None and owner in owners:
+        entry_attrs['ipatokenowner'] = owners[owner]
+    else:
+        _normalize_owner(api.Object.user, entry_attrs)
+        if owners is not None and owner:
+            owners[owner] = entry_attrs['ipatokenowner']
+
+    # Check if key is not empty
+    if entry_attrs.get('ipatokenotpkey', None) is None:
+        raise ValidationError(name='key', error=_(u'cannot be empty'))
+
 def _set_token_type(entry_attrs, **options):
     klasses = [x.lower() for x in entry_attrs.get('objectclass', [])]
     for ttype in TOKEN_TYPES:
@@ -288,33 +348,8 @@ class otptoken_add(LDAPCreate):
             entry_attrs['ipatokenuniqueid'] = str(uuid.uuid4())
             dn = DN("ipatokenuniqueid=%s" % entry_attrs['ipatokenuniqueid'], dn)
 
-        if not _check_interval(options.get('ipatokennotbefore', None),
-                               options.get('ipatokennotafter', None)):
-            raise ValidationError(name='not_after',
-                                  error='is before the validity start')
-
-        # Set the object class and defaults for specific token types
         options['type'] = options['type'].lower()
-        entry_attrs['objectclass'] = otptoken.object_class + ['ipatoken' + options['type']]
-        for ttype, tattrs in TOKEN_TYPES.items():
-            if ttype != options['type']:
-                for tattr in tattrs:
-                    if tattr in entry_attrs:
-                        del entry_attrs[tattr]
-
-        # If owner was not specified, default to the person adding this token.
-        # If managedby was not specified, attempt a sensible default.
-        if 'ipatokenowner' not in entry_attrs or 'managedby' not in entry_attrs:
-            result = self.api.Command.user_find(
-                whoami=True, no_members=False)['result']
-            if result:
-                cur_uid = result[0]['uid'][0]
-                prev_uid = entry_attrs.setdefault('ipatokenowner', cur_uid)
-                if cur_uid == prev_uid:
-                    entry_attrs.setdefault('managedby', result[0]['dn'])
-
-        # Resolve the owner's dn
-        _normalize_owner(self.api.Object.user, entry_attrs)
+        prepare_token_entry(self.api, entry_attrs, **options)
 
         # Get the issuer for the URI
         owner = entry_attrs.get('ipatokenowner', None)
@@ -325,10 +360,6 @@ class otptoken_add(LDAPCreate):
             except (NotFound, IndexError):
                 pass
 
-        # Check if key is not empty
-        if entry_attrs['ipatokenotpkey'] is None:
-            raise ValidationError(name='key', error=_(u'cannot be empty'))
-
         # Build the URI parameters
         args = {}
         args['issuer'] = issuer
@@ -45,7 +45,8 @@ import six
 from ipalib import errors, _
 from ipalib.backend import Backend
 from ipalib.plugable import Registry
-from ipaserver.servroles import (attribute_instances, ENABLED, role_instances)
+from ipaserver.servroles import (attribute_instances, ENABLED, role_instances,
+                                 get_masters_snapshot)
 
 
 if six.PY3:
@@ -80,11 +81,12 @@ class serverroles(Backend):
             raise errors.NotFound(
                 reason=_("{role}: role not found".format(role=role_name)))
 
-    def _get_enabled_masters(self, role_name):
+    def _get_enabled_masters(self, role_name, snapshot=None):
         role = self._get_role(role_name)
 
         enabled_masters = [
-            r[u'server_server'] for r in role.status(self.api, server=None) if
+            r[u'server_server'] for r in role.status(
+                self.api, server=None, snapshot=snapshot) if
             r[u'status'] == ENABLED]
 
         return {role.attr_name: enabled_masters}
@@ -111,9 +113,13 @@ class serverroles(Backend):
             except errors.NotFound:
                 found_roles = []
 
+        # all roles are evaluated against a single snapshot of the masters
+        snapshot = get_masters_snapshot(self.api)
+
         result = []
         for found_role in found_roles:
-            role_status = found_role.status(self.api, server=server_server)
+            role_status = found_role.status(
+                self.api, server=server_server, snapshot=snapshot)
 
             result.extend(role_status)
 
@@ -127,7 +133,8 @@ class serverroles(Backend):
             self.api, server=server_server)
 
     def config_retrieve(self, servrole):
-        result = self._get_enabled_masters(servrole)
+        snapshot = get_masters_snapshot(self.api)
+        result = self._get_enabled_masters(servrole, snapshot=snapshot)
 
         try:
             assoc_attributes = self._get_assoc_attributes(servrole)
@@ -135,7 +142,7 @@ class serverroles(Backend):
             return result
 
         for name, attr in assoc_attributes.items():
-            attr_value = attr.get(self.api)
+            attr_value = attr.get(self.api, snapshot=snapshot)
 
             if attr_value is not None:
                 result.update({name: attr_value})
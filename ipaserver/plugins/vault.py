@@ -28,7 +28,7 @@ from ipalib.parameters import Principal
 from ipalib.plugable import Registry
 from .baseldap import LDAPObject, LDAPCreate, LDAPDelete,\
     LDAPSearch, LDAPUpdate, LDAPRetrieve, LDAPAddMember, LDAPRemoveMember,\
-    LDAPModMember, pkey_to_value
+    LDAPModMember, LDAPMultiQuery, pkey_to_value
 from ipalib.request import context
 from .service import normalize_principal, validate_realm
 from ipalib import _, ngettext
@@ -36,12 +36,14 @@ from ipapython import kerberos
 from ipapython.dn import DN
 
 if api.env.in_server:
-    import pki.account
     import pki.key
 
 if six.PY3:
     unicode = str
 
+# maximum number of KRA records of a vault listed at once
+KRA_MAX_RESULTS = 10000
+
 __doc__ = _("""
 Vaults
 """) + _("""
@@ -171,6 +173,12 @@ EXAMPLES:
    ipa vault-retrieve <name>
        [--user <user>|--service <service>|--shared]
        --out <output file> --private-key-file private.pem
+""") + _("""
+ Retrieve data from multiple vaults into a directory:
+   ipa vault-retrieve-multiple <name> <name>...
+       [--user <user>|--service <service>|--shared]
+       --out-dir <output directory>
+       [--password-file password.txt] [--private-key-file private.pem]
 """) + _("""
  Add vault owners:
    ipa vault-add-owner <name>
@@ -744,6 +752,56 @@ class vault(LDAPObject):
 
         return 'ipa:' + id
 
+    def get_chunk_key_id(self, client_key_id):
+        """
+        Generates a client key ID to archive/retrieve data chunks in KRA.
+
+        Large data is archived as multiple chunks which are KRA records of
+        their own. The vault record contains the list of the chunks.
+        """
+        return client_key_id + u'#chunk'
+
+    def deactivate_key_records(self, kra_client, client_key_id, keep=()):
+        """
+        Deactivates active KRA records with the client key ID, except
+        records whose KRA key IDs are listed in keep.
+        """
+        response = kra_client.keys.list_keys(
+            client_key_id,
+            pki.key.KeyClient.KEY_STATUS_ACTIVE,
+            max_results=KRA_MAX_RESULTS)
+
+        for key_info in response.key_infos:
+            if key_info.get_key_id() in keep:
+                continue
+            kra_client.keys.modify_key_status(
+                key_info.get_key_id(),
+                pki.key.KeyClient.KEY_STATUS_INACTIVE)
+
+    def retrieve_data(self, kra_client, dn, wrapped_session_key):
+        """
+        Retrieves vault data from KRA.
+
+        :returns: tuple (vault data encrypted with session key, nonce)
+        """
+        client_key_id = self.get_key_id(dn)
+
+        # find vault record in KRA
+        response = kra_client.keys.list_keys(
+            client_key_id,
+            pki.key.KeyClient.KEY_STATUS_ACTIVE)
+
+        if not len(response.key_infos):
+            raise errors.NotFound(reason=_('No archived data.'))
+
+        key_info = response.key_infos[0]
+
+        key = kra_client.keys.retrieve_key(
+            key_info.get_key_id(),
+            wrapped_session_key)
+
+        return key.encrypted_data, key.nonce_data
+
     def get_container_attribute(self, entry, options):
         if options.get('raw', False):
             return
@@ -816,23 +874,15 @@ class vault_del(LDAPDelete):
     def post_callback(self, ldap, dn, *args, **options):
         assert isinstance(dn, DN)
 
-        kra_client = self.api.Backend.kra.get_client()
-
-        kra_account = pki.account.AccountClient(kra_client.connection)
-        kra_account.login()
-
         client_key_id = self.obj.get_key_id(dn)
 
-        # deactivate vault record in KRA
-        response = kra_client.keys.list_keys(
-            client_key_id, pki.key.KeyClient.KEY_STATUS_ACTIVE)
+        def deactivate(kra_client):
+            # deactivate vault record and data chunks in KRA
+            self.obj.deactivate_key_records(kra_client, client_key_id)
+            self.obj.deactivate_key_records(
+                kra_client, self.obj.get_chunk_key_id(client_key_id))
 
-        for key_info in response.key_infos:
-            kra_client.keys.modify_key_status(
-                key_info.get_key_id(),
-                pki.key.KeyClient.KEY_STATUS_INACTIVE)
-
-        kra_account.logout()
+        self.api.Backend.kra.call(deactivate)
 
         return True
 
@@ -987,9 +1037,8 @@ class vaultconfig_show(Retrieve):
             raise errors.InvocationError(
                 format=_('KRA service is not enabled'))
 
-        kra_client = self.api.Backend.kra.get_client()
-        transport_cert = kra_client.system_certs.get_transport_cert()
-        config = {'transport_cert': transport_cert.binary}
+        transport_cert = self.api.Backend.kra.get_transport_cert()
+        config = {'transport_cert': transport_cert}
         config.update(
             self.api.Backend.serverroles.config_retrieve("KRA server")
         )
@@ -1018,6 +1067,10 @@ class vault_archive_internal(PKQuery):
             'nonce',
             doc=_('Nonce'),
         ),
+        Str(
+            'chunks*',
+            doc=_('KRA key IDs of data chunks referenced by vault data'),
+        ),
     )
 
     has_output = output.standard_entry
@@ -1033,43 +1086,108 @@ class vault_archive_internal(PKQuery):
         wrapped_vault_data = options.pop('vault_data')
         nonce = options.pop('nonce')
         wrapped_session_key = options.pop('session_key')
+        chunks = options.pop('chunks', None) or ()
 
         # retrieve vault info
         vault = self.api.Command.vault_show(*args, **options)['result']
 
+        client_key_id = self.obj.get_key_id(vault['dn'])
+        chunk_key_id = self.obj.get_chunk_key_id(client_key_id)
+
+        def archive(kra_client):
+            # make sure all data chunks were archived into this vault
+            for chunk_id in chunks:
+                key_info = kra_client.keys.get_key_info(chunk_id)
+                if (key_info.client_key_id != chunk_key_id or
+                        key_info.status !=
+                        pki.key.KeyClient.KEY_STATUS_ACTIVE):
+                    raise errors.NotFound(
+                        reason=_('Data chunk %(chunk)s not found') %
+                        dict(chunk=chunk_id))
+
+            # deactivate existing vault record and unused data chunks in KRA
+            self.obj.deactivate_key_records(kra_client, client_key_id)
+            self.obj.deactivate_key_records(kra_client, chunk_key_id, chunks)
+
+            # forward wrapped data to KRA
+            kra_client.keys.archive_encrypted_data(
+                client_key_id,
+                pki.key.KeyClient.PASS_PHRASE_TYPE,
+                wrapped_vault_data,
+                wrapped_session_key,
+                None,
+                nonce,
+            )
+
         # connect to KRA
-        kra_client = self.api.Backend.kra.get_client()
+        self.api.Backend.kra.call(archive)
 
-        kra_account = pki.account.AccountClient(kra_client.connection)
-        kra_account.login()
+        response = {
+            'value': args[-1],
+            'result': {},
+        }
 
-        client_key_id = self.obj.get_key_id(vault['dn'])
+        response['summary'] = self.msg_summary % response
 
-        # deactivate existing vault record in KRA
-        response = kra_client.keys.list_keys(
-            client_key_id,
-            pki.key.KeyClient.KEY_STATUS_ACTIVE)
+        return response
 
-        for key_info in response.key_infos:
-            kra_client.keys.modify_key_status(
-                key_info.get_key_id(),
-                pki.key.KeyClient.KEY_STATUS_INACTIVE)
 
-        # forward wrapped data to KRA
-        kra_client.keys.archive_encrypted_data(
-            client_key_id,
-            pki.key.KeyClient.PASS_PHRASE_TYPE,
-            wrapped_vault_data,
-            wrapped_session_key,
-            None,
-            nonce,
-        )
+@register()
+class vault_archive_chunk_internal(PKQuery):
+
+    NO_CLI = True
+
+    takes_options = vault_options + (
+        Bytes(
+            'session_key',
+            doc=_('Session key wrapped with transport certificate'),
+        ),
+        Bytes(
+            'vault_data',
+            doc=_('Vault data chunk encrypted with session key'),
+        ),
+        Bytes(
+            'nonce',
+            doc=_('Nonce'),
+        ),
+    )
 
-        kra_account.logout()
+    has_output = output.standard_entry
+
+    msg_summary = _('Archived data chunk into vault "%(value)s"')
+
+    def execute(self, *args, **options):
+
+        if not self.api.Command.kra_is_enabled()['result']:
+            raise errors.InvocationError(
+                format=_('KRA service is not enabled'))
+
+        wrapped_vault_data = options.pop('vault_data')
+        nonce = options.pop('nonce')
+        wrapped_session_key = options.pop('session_key')
+
+        # retrieve vault info
+        vault = self.api.Command.vault_show(*args, **options)['result']
+
+        client_key_id = self.obj.get_key_id(vault['dn'])
+
+        # forward wrapped data chunk to KRA, the chunk becomes part of the
+        # vault data once vault_archive_internal references it
+        key = self.api.Backend.kra.call(
+            lambda kra_client: kra_client.keys.archive_encrypted_data(
+                self.obj.get_chunk_key_id(client_key_id),
+                pki.key.KeyClient.PASS_PHRASE_TYPE,
+                wrapped_vault_data,
+                wrapped_session_key,
+                None,
+                nonce,
+            ))
 
         response = {
             'value': args[-1],
-            'result': {},
+            'result': {
+                'chunk_id': unicode(key.get_key_id()),
+            },
         }
 
         response['summary'] = self.msg_summary % response
@@ -1104,30 +1222,141 @@ class vault_retrieve_internal(PKQuery):
         # retrieve vault info
         vault = self.api.Command.vault_show(*args, **options)['result']
 
-        # connect to KRA
-        kra_client = self.api.Backend.kra.get_client()
+        # retrieve encrypted data from KRA
+        vault_data, nonce = self.api.Backend.kra.call(
+            self.obj.retrieve_data, vault['dn'], wrapped_session_key)
 
-        kra_account = pki.account.AccountClient(kra_client.connection)
-        kra_account.login()
+        response = {
+            'value': args[-1],
+            'result': {
+                'vault_data': vault_data,
+                'nonce': nonce,
+            },
+        }
 
-        client_key_id = self.obj.get_key_id(vault['dn'])
+        response['summary'] = self.msg_summary % response
 
-        # find vault record in KRA
-        response = kra_client.keys.list_keys(
-            client_key_id,
-            pki.key.KeyClient.KEY_STATUS_ACTIVE)
+        return response
 
-        if not len(response.key_infos):
-            raise errors.NotFound(reason=_('No archived data.'))
 
-        key_info = response.key_infos[0]
+@register()
+class vault_retrieve_multiple_internal(LDAPMultiQuery):
 
-        # retrieve encrypted data from KRA
-        key = kra_client.keys.retrieve_key(
-            key_info.get_key_id(),
-            wrapped_session_key)
+    NO_CLI = True
+
+    takes_options = LDAPMultiQuery.takes_options + vault_options + (
+        Bytes(
+            'session_key',
+            doc=_('Session key wrapped with transport certificate'),
+        ),
+    )
+
+    has_output = (
+        output.summary,
+        output.ListOfEntries('result'),
+        output.ListOfPrimaryKeys('value', flags=['no_display']),
+    )
+
+    msg_summary = _('Retrieved data from vaults "%(value)s"')
+
+    def execute(self, *keys, **options):
+
+        if not self.api.Command.kra_is_enabled()['result']:
+            raise errors.InvocationError(
+                format=_('KRA service is not enabled'))
+
+        wrapped_session_key = options.pop('session_key')
+        continue_ = options.pop('continue', False)
+
+        result = []
+        retrieved = []
+
+        for pkey in keys[-1]:
+            try:
+                # retrieve vault info
+                vault = self.api.Command.vault_show(
+                    *(keys[:-1] + (pkey,)), **options)['result']
+
+                # retrieve encrypted data from KRA
+                vault_data, nonce = self.api.Backend.kra.call(
+                    self.obj.retrieve_data, vault['dn'], wrapped_session_key)
+            except errors.ExecutionError:
+                if not continue_:
+                    raise
+                continue
+
+            entry = {
+                'cn': vault['cn'],
+                'ipavaulttype': vault['ipavaulttype'],
+                'vault_data': vault_data,
+                'nonce': nonce,
+            }
+            if 'ipavaultsalt' in vault:
+                entry['ipavaultsalt'] = vault['ipavaultsalt']
+
+            result.append(entry)
+            retrieved.append(pkey)
+
+        response = {
+            'value': pkey_to_value(retrieved, options),
+            'result': result,
+        }
+
+        response['summary'] = self.msg_summary % {
+            'value': u', '.join(retrieved)}
+
+        return response
+
+
+@register()
+class vault_retrieve_chunk_internal(PKQuery):
+
+    NO_CLI = True
+
+    takes_options = vault_options + (
+        Bytes(
+            'session_key',
+            doc=_('Session key wrapped with transport certificate'),
+        ),
+        Str(
+            'chunk_id',
+            doc=_('KRA key ID of the data chunk'),
+        ),
+    )
+
+    has_output = output.standard_entry
 
-        kra_account.logout()
+    msg_summary = _('Retrieved data chunk from vault "%(value)s"')
+
+    def execute(self, *args, **options):
+
+        if not self.api.Command.kra_is_enabled()['result']:
+            raise errors.InvocationError(
+                format=_('KRA service is not enabled'))
+
+        wrapped_session_key = options.pop('session_key')
+        chunk_id = options.pop('chunk_id')
+
+        # retrieve vault info
+        vault = self.api.Command.vault_show(*args, **options)['result']
+
+        client_key_id = self.obj.get_key_id(vault['dn'])
+
+        def retrieve_chunk(kra_client):
+            # make sure the data chunk belongs to this vault
+            key_info = kra_client.keys.get_key_info(chunk_id)
+            if (key_info.client_key_id != self.obj.get_chunk_key_id(
+                    client_key_id) or
+                    key_info.status != pki.key.KeyClient.KEY_STATUS_ACTIVE):
+                raise errors.NotFound(
+                    reason=_('Data chunk %(chunk)s not found') %
+                    dict(chunk=chunk_id))
+
+            # retrieve encrypted data chunk from KRA
+            return kra_client.keys.retrieve_key(chunk_id, wrapped_session_key)
+
+        # connect to KRA
+        key = self.api.Backend.kra.call(retrieve_chunk)
 
         response = {
             'value': args[-1],
@@ -69,15 +69,21 @@ which accepts FQDN of a new master hosting the attribute.
 
 The available role/attribute instances are stored in
 `role_instances`/`attribute_instances` tuples.
+
+The status of all roles and attributes is computed from a single
+`MastersSnapshot` of the masters subtree returned by `get_masters_snapshot()`.
+The snapshot is cached and reused until the entryUSN check detects
+a modification of master or service entries.
 """
 
 import abc
-from collections import namedtuple, defaultdict
+from collections import namedtuple, defaultdict, OrderedDict
+import threading
 
-from ldap import SCOPE_ONELEVEL
 import six
 
 from ipalib import _, errors
+from ipalib.request import context
 from ipapython.dn import DN
 
 
@@ -130,58 +136,36 @@ class BaseServerRole(LDAPBasedProperty):
             u'status': status}
 
     @abc.abstractmethod
-    def create_search_params(self, ldap, api_instance, server=None):
-        """
-        create search base and filter
-        :param ldap: ldap connection
-        :param api_instance: API instance
-        :param server: server FQDN. if given, the method should generate
-        filter and search base matching only the status on this server
-        :returns: tuple of search base (a DN) and search filter
+    def get_result_from_snapshot(self, snapshot, server=None):
         """
-        pass
+        Get role status from the snapshot of masters
 
-    @abc.abstractmethod
-    def get_result_from_entries(self, entries):
-        """
-        Get role status from returned LDAP entries
-
-        :param entries: LDAPEntry objects returned by `search()`
+        :param snapshot: `MastersSnapshot` instance
+        :param server: server FQDN. if given, the method should return only
+            the status on this server
         :returns: list of dicts generated by `create_role_status_dict()`
-                  method
+                  method for masters on which the role is not absent
         """
         pass
 
-    def _fill_in_absent_masters(self, ldap2, api_instance, result):
+    def _fill_in_absent_masters(self, snapshot, result):
         """
         get all masters on which the role is absent
 
-        :param ldap2: LDAP connection
-        :param api_instance: API instance
-        :param result: output of `get_result_from_entries` method
+        :param snapshot: `MastersSnapshot` instance
+        :param result: output of `get_result_from_snapshot` method
 
         :returns: list of masters on which the role is absent
         """
-        search_base = DN(api_instance.env.container_masters,
-                         api_instance.env.basedn)
-        search_filter = '(objectclass=ipaConfigObject)'
-        attrs_list = ['cn']
-
-        all_masters = ldap2.get_entries(
-            search_base,
-            filter=search_filter,
-            scope=SCOPE_ONELEVEL,
-            attrs_list=attrs_list)
-
-        all_master_cns = set(m['cn'][0] for m in all_masters)
         enabled_configured_masters = set(r[u'server_server'] for r in result)
 
-        absent_masters = all_master_cns.difference(enabled_configured_masters)
+        absent_masters = snapshot.masters.difference(
+            enabled_configured_masters)
 
         return [self.create_role_status_dict(m, ABSENT) for m in
                 absent_masters]
 
-    def status(self, api_instance, server=None, attrs_list=("*",)):
+    def status(self, api_instance, server=None, snapshot=None):
         """
         probe and return status of the role either on single server or on the
         whole topology
@@ -189,31 +173,23 @@ class BaseServerRole(LDAPBasedProperty):
         :param api_instance: API instance
         :param server: server FQDN. If given, only the status of the role on
                        this master will be returned
+        :param snapshot: `MastersSnapshot` to use, if not given an up-to-date
+                         snapshot is retrieved
         :returns: * 'enabled' if the role is enabled on the master
                   * 'configured' if it is not enabled but has
                     been configured by installer
                   * 'absent' otherwise
         """
-        ldap2 = api_instance.Backend.ldap2
-        search_base, search_filter = self.create_search_params(
-            ldap2, api_instance, server=server)
-
-        try:
-            entries = ldap2.get_entries(
-                search_base,
-                filter=search_filter,
-                attrs_list=attrs_list)
-        except errors.EmptyResult:
-            entries = []
-
-        if not entries and server is not None:
-            return [self.create_role_status_dict(server, ABSENT)]
+        if snapshot is None:
+            snapshot = get_masters_snapshot(api_instance)
 
-        result = self.get_result_from_entries(entries)
+        result = self.get_result_from_snapshot(snapshot, server=server)
+
+        if not result and server is not None:
+            return [self.create_role_status_dict(server, ABSENT)]
 
         if server is None:
-            result.extend(
-                self._fill_in_absent_masters(ldap2, api_instance, result))
+            result.extend(self._fill_in_absent_masters(snapshot, result))
 
         return sorted(result, key=lambda x: x[u'server_server'])
 
@@ -249,40 +225,47 @@ class ServerAttribute(LDAPBasedProperty):
         raise NotImplementedError(
             "{}: no valid associated role found".format(self.attr_name))
 
-    def create_search_filter(self, ldap):
+    def get_from_snapshot(self, snapshot):
         """
-        Create search filter which matches LDAP data corresponding to the
-        attribute
+        get the master which has the attribute set from the snapshot of
+        masters
+
+        :param snapshot: `MastersSnapshot` instance
+        :returns: master FQDN or None
         """
-        svc_filter = ldap.make_filter_from_attr(
-            'cn', self.associated_service_name)
+        service_name = self.associated_service_name.lower()
+        config_value = self.ipa_config_string_value.lower()
 
-        configstring_filter = ldap.make_filter_from_attr(
-            'ipaConfigString', self.ipa_config_string_value)
-        return ldap.combine_filters(
-            [svc_filter, configstring_filter], rules=ldap.MATCH_ALL)
+        for master_cn in sorted(snapshot.services):
+            entry = snapshot.services[master_cn].get(service_name)
+            if entry is None:
+                continue
+            ipaconfigstring_values = set(
+                v.lower() for v in entry.get('ipaConfigString', []))
+            if config_value in ipaconfigstring_values:
+                return master_cn
 
-    def get(self, api_instance):
+        return None
+
+    def get(self, api_instance, snapshot=None):
         """
         get the master which has the attribute set
         :param api_instance: API instance
+        :param snapshot: `MastersSnapshot` to use, if not given an up-to-date
+                         snapshot is retrieved
         :returns: master FQDN
         """
-        ldap2 = api_instance.Backend.ldap2
-        search_base = DN(api_instance.env.container_masters,
-                         api_instance.env.basedn)
-
-        search_filter = self.create_search_filter(ldap2)
+        if snapshot is None:
+            snapshot = get_masters_snapshot(api_instance)
 
-        try:
-            entries = ldap2.get_entries(search_base, filter=search_filter)
-        except errors.EmptyResult:
+        master_cn = self.get_from_snapshot(snapshot)
+        if master_cn is None:
             return
 
-        master_cn = entries[0].dn[1]['cn']
-
         associated_role_providers = set(
-            self._get_assoc_role_providers(api_instance))
+            r[u'server_server'] for r in
+            self.associated_role.get_result_from_snapshot(snapshot)
+            if r[u'status'] == ENABLED)
 
         if master_cn not in associated_role_providers:
             raise errors.ValidationError(
@@ -480,25 +463,21 @@ class ServiceBasedRole(BaseServerRole):
 
         return result
 
-    def create_search_params(self, ldap, api_instance, server=None):
-        search_base = DN(api_instance.env.container_masters,
-                         api_instance.env.basedn)
+    def get_result_from_snapshot(self, snapshot, server=None):
+        component_services = set(s.lower() for s in self.component_services)
 
-        search_filter = ldap.make_filter_from_attr(
-            'cn',
-            self.component_services,
-            rules=ldap.MATCH_ANY,
-            exact=True
-        )
-
-        if server is not None:
-            search_base = DN(('cn', server), search_base)
+        if server is None:
+            masters = snapshot.services.keys()
+        else:
+            masters = [server]
 
-        return search_base, search_filter
+        entries = []
+        for master in masters:
+            for name, entry in snapshot.services.get(master, {}).items():
+                if name in component_services:
+                    entries.append(entry)
 
-    def status(self, api_instance, server=None):
-        return super(ServiceBasedRole, self).status(
-            api_instance, server=server, attrs_list=('ipaConfigString', 'cn'))
+        return self.get_result_from_entries(entries)
 
 
 class ADtrustBasedRole(BaseServerRole):
@@ -507,36 +486,158 @@ class ADtrustBasedRole(BaseServerRole):
     sysaccount group.
     """
 
-    def get_result_from_entries(self, entries):
+    def get_result_from_snapshot(self, snapshot, server=None):
         result = []
 
-        for e in entries:
-            result.append(
-                self.create_role_status_dict(e['fqdn'][0], ENABLED)
-            )
+        for fqdn in snapshot.adtrust_agents:
+            if server is not None and fqdn != server:
+                continue
+            result.append(self.create_role_status_dict(fqdn, ENABLED))
+
         return result
 
-    def create_search_params(self, ldap, api_instance, server=None):
-        search_base = DN(
-            api_instance.env.container_host, api_instance.env.basedn)
 
-        search_filter = ldap.make_filter_from_attr(
-            "memberof",
-            DN(('cn', 'adtrust agents'), ('cn', 'sysaccounts'),
-               ('cn', 'etc'), api_instance.env.basedn)
+class MastersSnapshot(object):
+    """
+    Snapshot of the LDAP content which is needed to compute status of all
+    server roles and attributes: master entries, their service entries and
+    members of the 'adtrust agents' sysaccount group.
+
+    :param usn: last USN of the directory at the time the snapshot was taken
+    :param masters: set of master FQDNs
+    :param services: dict keyed by master FQDN containing dicts of service
+        entries keyed by lowercased service name
+    :param adtrust_agents: set of FQDNs of hosts in 'adtrust agents' group
+    """
+
+    def __init__(self, usn, masters, services, adtrust_agents):
+        self.usn = usn
+        self.masters = masters
+        self.services = services
+        self.adtrust_agents = adtrust_agents
+
+
+# maximal number of bind principals with a cached snapshot
+MASTERS_SNAPSHOT_CACHE_SIZE = 16
+
+_masters_snapshot_cache = OrderedDict()
+_masters_snapshot_cache_lock = threading.Lock()
+
+
+def _get_adtrust_agents_dn(api_instance):
+    return DN(('cn', 'adtrust agents'), ('cn', 'sysaccounts'),
+              ('cn', 'etc'), api_instance.env.basedn)
+
+
+def _find_all_entries(ldap2, base_dn, search_filter, attrs_list):
+    try:
+        entries, truncated = ldap2.find_entries(
+            filter=search_filter,
+            attrs_list=attrs_list,
+            base_dn=base_dn,
+            scope=ldap2.SCOPE_SUBTREE,
+            time_limit=0,
+            size_limit=0,
+            paged_search=True)
+    except errors.NotFound:
+        return []
+
+    ldap2.handle_truncated_result(truncated)
+    return entries
+
+
+def _load_masters_snapshot(api_instance):
+    ldap2 = api_instance.Backend.ldap2
+    masters_dn = DN(api_instance.env.container_masters,
+                    api_instance.env.basedn)
+
+    usn = ldap2.get_last_usn()
+
+    masters = set()
+    services = defaultdict(dict)
+    for entry in _find_all_entries(
+            ldap2, masters_dn, '(objectclass=*)',
+            ['cn', 'objectclass', 'ipaConfigString']):
+        # level of the entry below the masters container
+        depth = len(entry.dn) - len(masters_dn)
+
+        if depth == 1:
+            objectclasses = set(
+                oc.lower() for oc in entry.get('objectclass', []))
+            if 'ipaconfigobject' in objectclasses and entry.get('cn'):
+                masters.add(entry['cn'][0])
+        elif depth == 2 and entry.get('cn'):
+            services[entry.dn[1]['cn']][entry['cn'][0].lower()] = entry
+
+    adtrust_agents = set()
+    for entry in _find_all_entries(
+            ldap2,
+            DN(api_instance.env.container_host, api_instance.env.basedn),
+            ldap2.make_filter_from_attr(
+                'memberof', _get_adtrust_agents_dn(api_instance)),
+            ['fqdn']):
+        adtrust_agents.add(entry['fqdn'][0])
+
+    return MastersSnapshot(usn, masters, dict(services), adtrust_agents)
+
+
+def _is_masters_snapshot_valid(api_instance, snapshot):
+    """
+    Check with one search that no master, service entry or the
+    'adtrust agents' group has been added, modified or deleted since the
+    snapshot was taken
+    """
+    ldap2 = api_instance.Backend.ldap2
+
+    usn_filter = '(entryusn>=%d)' % (snapshot.usn + 1)
+    relevant_filter = ldap2.combine_filters([
+        ldap2.make_filter_from_attr(
+            'objectclass', ['ipaconfigobject', 'nstombstone']),
+        ldap2.make_filter_from_attr('cn', 'adtrust agents'),
+    ], rules=ldap2.MATCH_ANY)
+
+    try:
+        ldap2.find_entries(
+            filter=ldap2.combine_filters([usn_filter, relevant_filter],
+                                         rules=ldap2.MATCH_ALL),
+            attrs_list=['1.1'],
+            base_dn=DN(('cn', 'etc'), api_instance.env.basedn),
+            size_limit=1,
         )
-        if server is not None:
-            server_filter = ldap.make_filter_from_attr(
-                'fqdn',
-                server,
-                exact=True
-            )
-            search_filter = ldap.combine_filters(
-                [search_filter, server_filter],
-                rules=ldap.MATCH_ALL
-            )
+    except errors.NotFound:
+        return True
+    return False
+
+
+def get_masters_snapshot(api_instance):
+    """
+    Return up-to-date `MastersSnapshot`.
+
+    The snapshot is taken with two searches and shared by all role and
+    attribute instances. It is cached per bind principal, since the visible
+    content depends on access rights of the bound user, and reused as long
+    as the entryUSN check does not find any relevant modification.
+    """
+    ldap2 = api_instance.Backend.ldap2
+    key = (ldap2.ldap_uri, getattr(context, 'principal', None))
+
+    with _masters_snapshot_cache_lock:
+        snapshot = _masters_snapshot_cache.get(key)
+
+    if snapshot is not None and _is_masters_snapshot_valid(
+            api_instance, snapshot):
+        return snapshot
+
+    snapshot = _load_masters_snapshot(api_instance)
+
+    with _masters_snapshot_cache_lock:
+        _masters_snapshot_cache.pop(key, None)
+        if snapshot.usn is not None:
+            _masters_snapshot_cache[key] = snapshot
+            while len(_masters_snapshot_cache) > MASTERS_SNAPSHOT_CACHE_SIZE:
+                _masters_snapshot_cache.popitem(last=False)
 
-        return search_base, search_filter
+    return snapshot
 
 
 role_instances = (
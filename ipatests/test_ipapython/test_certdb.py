@@ -0,0 +1,174 @@
+#
+# Copyright (C) 2016  FreeIPA Contributors see COPYING for license
+#
+"""
+Test the `ipapython/certdb.py` module.
+"""
+
+import base64
+import os
+
+import pytest
+
+from ipalib import x509
+from ipaplatform.paths import paths
+from ipapython import certdb, ipautil
+
+pytestmark = pytest.mark.tier0
+
+# nicknames with spaces must be quoted in certutil batch files
+CA_NICKNAME = u'Test CA'
+OTHER_NICKNAME = u'Other test CA'
+
+
+def create_db(db, nickname=None, subject=None):
+    pwfile = os.path.join(db.secdir, 'pwfile')
+    with open(pwfile, 'w') as f:
+        f.write('testpw')
+    db.create_db(pwfile)
+    if nickname is not None:
+        noisefile = os.path.join(db.secdir, 'noise')
+        with open(noisefile, 'wb') as f:
+            f.write(os.urandom(1024))
+        db.run_certutil(['-S', '-f', pwfile, '-z', noisefile, '-x',
+                         '-s', subject, '-n', nickname, '-t', 'CT,C,C',
+                         '-m', '1'])
+
+
+def to_der(pem):
+    cert, _start = certdb.find_cert_from_txt(pem)
+    return base64.b64decode(x509.strip_header(cert))
+
+
+@pytest.fixture
+def nssdb(request):
+    db = certdb.NSSDatabase()
+    request.addfinalizer(db.close)
+    create_db(db, CA_NICKNAME, 'CN=Test CA')
+    return db
+
+
+@pytest.fixture
+def other_ca_pem():
+    with certdb.NSSDatabase() as db:
+        create_db(db, OTHER_NICKNAME, 'CN=Other test CA')
+        return db.get_cert(OTHER_NICKNAME, pem=True)
+
+
+@pytest.fixture
+def certutil_calls(nssdb, monkeypatch):
+    calls = []
+    run_certutil = nssdb.run_certutil
+
+    def counting_run_certutil(args, stdin=None, **kwargs):
+        calls.append(args)
+        return run_certutil(args, stdin, **kwargs)
+
+    monkeypatch.setattr(nssdb, 'run_certutil', counting_run_certutil)
+    return calls
+
+
+def names(certlist):
+    return sorted(name for name, _flags in certlist)
+
+
+class TestNSSDatabaseCache(object):
+    def test_list_certs(self, nssdb, certutil_calls):
+        certlist = nssdb.list_certs()
+        assert names(certlist) == [CA_NICKNAME]
+        assert nssdb.list_certs() == certlist
+        assert nssdb.has_nickname(CA_NICKNAME)
+        assert certutil_calls == [['-L']]
+
+    def test_get_cert(self, nssdb, certutil_calls):
+        pem = nssdb.get_cert(CA_NICKNAME, pem=True)
+        der = nssdb.get_cert(CA_NICKNAME)
+        assert der == to_der(pem)
+        assert nssdb.get_cert(CA_NICKNAME) == der
+        assert nssdb.get_cert(CA_NICKNAME, pem=True) == pem
+        assert certutil_calls == [['-L'], ['-L', '-n', CA_NICKNAME, '-a']]
+
+    def test_unknown_nickname(self, nssdb):
+        assert not nssdb.has_nickname(u'Unknown')
+        with pytest.raises(RuntimeError):
+            nssdb.get_cert(u'Unknown')
+
+    def test_external_change(self, nssdb, certutil_calls):
+        nssdb.get_cert(CA_NICKNAME)
+        ipautil.run([paths.CERTUTIL, '-d', nssdb.secdir, '-D',
+                     '-n', CA_NICKNAME])
+
+        assert nssdb.list_certs() == ()
+        assert not nssdb.has_nickname(CA_NICKNAME)
+        assert certutil_calls.count(['-L']) == 2
+
+    def test_trust_root_cert(self, nssdb, certutil_calls):
+        nssdb.list_certs()
+        nssdb.trust_root_cert(CA_NICKNAME, 'C,,')
+        certlist = nssdb.list_certs()
+        assert certutil_calls.count(['-L']) == 1
+
+        # the updated snapshot matches the database
+        nssdb.invalidate_cache()
+        assert nssdb.list_certs() == certlist
+        assert certlist[0][1].split(',')[0] == 'Cu'
+
+    def test_delete_cert(self, nssdb, certutil_calls):
+        nssdb.get_cert(CA_NICKNAME)
+        nssdb.delete_cert(CA_NICKNAME)
+        assert nssdb.list_certs() == ()
+        assert certutil_calls.count(['-L']) == 1
+        with pytest.raises(RuntimeError):
+            nssdb.get_cert(CA_NICKNAME)
+
+    def test_add_cert(self, nssdb, other_ca_pem, certutil_calls):
+        nssdb.list_certs()
+        nssdb.add_cert(other_ca_pem, OTHER_NICKNAME, 'C,,', pem=True)
+        assert names(nssdb.list_certs()) == [OTHER_NICKNAME, CA_NICKNAME]
+        assert nssdb.get_cert(OTHER_NICKNAME) == to_der(other_ca_pem)
+
+    def test_update_snapshot_stale_stamp(self, nssdb):
+        nssdb.list_certs()
+        stamp = nssdb._get_db_stamp()
+        nssdb._update_snapshot(
+            stamp + (('cert9.db', 0, 0, 0),),
+            [(['-D', '-n', CA_NICKNAME], None)])
+        assert nssdb._snapshot is None
+
+
+class TestNSSDatabaseBatch(object):
+    def test_batch(self, nssdb, other_ca_pem, certutil_calls):
+        nssdb.list_certs()
+        with nssdb.batch():
+            nssdb.add_cert(other_ca_pem, OTHER_NICKNAME, 'C,,', pem=True)
+            nssdb.trust_root_cert(OTHER_NICKNAME, 'CT,C,C')
+            nssdb.delete_cert(CA_NICKNAME)
+            # changes are applied when the context exits
+            assert names(nssdb.list_certs()) == [CA_NICKNAME]
+
+        # the added cert is listed again, everything else is one batch run
+        assert [args[0] for args in certutil_calls
+                if args != ['-L']] == ['-B']
+        certlist = nssdb.list_certs()
+        assert certlist == ((OTHER_NICKNAME, 'CT,C,C'),)
+
+        nssdb.invalidate_cache()
+        assert nssdb.list_certs() == certlist
+
+    def test_batch_failure(self, nssdb):
+        with pytest.raises(ipautil.CalledProcessError):
+            with nssdb.batch():
+                nssdb.trust_root_cert(CA_NICKNAME, 'C,,')
+                nssdb.delete_cert(u'Unknown')
+
+        # the change preceding the failing one is applied
+        certlist = nssdb.list_certs()
+        assert certlist[0][1].split(',')[0] == 'Cu'
+
+    def test_batch_exception(self, nssdb):
+        with pytest.raises(ValueError):
+            with nssdb.batch():
+                nssdb.delete_cert(CA_NICKNAME)
+                raise ValueError()
+
+        assert names(nssdb.list_certs()) == [CA_NICKNAME]
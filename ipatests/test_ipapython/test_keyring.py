@@ -20,6 +20,8 @@
 Test the `kernel_keyring.py` module.
 """
 
+import time
+
 from nose.tools import raises  # pylint: disable=E0611
 from ipapython import kernel_keyring
 
@@ -165,3 +167,28 @@ class test_keyring(object):
         assert(result == TEST_VALUE)
 
         kernel_keyring.del_key(TEST_UNICODEKEY)
+
+    def test_11(self):
+        """
+        Set key expiration
+        """
+        kernel_keyring.add_key(TEST_KEY, TEST_VALUE)
+        kernel_keyring.set_key_timeout(TEST_KEY, 1)
+        assert kernel_keyring.read_key(TEST_KEY) == TEST_VALUE
+
+        time.sleep(1.5)
+        assert not kernel_keyring.has_key(TEST_KEY)
+
+
+class test_keyring_keyctl(test_keyring):
+    """
+    Test the kernel keyring interface using the keyctl utility
+    """
+
+    def setup(self):
+        self.backend = kernel_keyring._backend
+        kernel_keyring._backend = kernel_keyring._KeyctlBackend()
+        super(test_keyring_keyctl, self).setup()
+
+    def teardown(self):
+        kernel_keyring._backend = self.backend
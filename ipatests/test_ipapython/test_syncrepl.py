@@ -0,0 +1,137 @@
+#
+# Copyright (C) 2016  FreeIPA Contributors see COPYING for license
+#
+"""
+Test the `ipapython/dnssec/syncrepl.py` module.
+"""
+
+import ldap
+import pytest
+
+from ipapython.dnssec.syncrepl import (
+    SyncReplConsumer, SyncReplStateStore, SYNC_REFRESH_REQUIRED)
+
+pytestmark = pytest.mark.tier0
+
+ENTRY_UUID = '8f3b5b82-e0b111e5-a9d8c7d9-73a8d2a4'
+ENTRY = {
+    'dn': 'idnsname=example.com.,cn=dns,dc=example,dc=com',
+    'objectClass': [b'top', b'idnsZone'],
+    'idnsName': [b'example.com.'],
+    'binaryValue': [b'\x00\xff\x80binary'],
+}
+
+
+@pytest.fixture
+def filename(tmpdir):
+    return str(tmpdir.join('state.db'))
+
+
+@pytest.fixture
+def store(request, filename):
+    store = SyncReplStateStore(filename)
+    request.addfinalizer(store.close)
+    return store
+
+
+def test_encode_decode():
+    data = SyncReplStateStore._encode(ENTRY)
+    assert SyncReplStateStore._decode(data) == ENTRY
+
+
+def test_empty(store):
+    assert store.get_cookie() is None
+    assert list(store.get_entries()) == []
+
+
+def test_commit(store, filename):
+    store.set_cookie('cookie1')
+    store.put_entry(ENTRY_UUID, ENTRY)
+    store.commit()
+    store.close()
+
+    store = SyncReplStateStore(filename)
+    try:
+        assert store.get_cookie() == 'cookie1'
+        assert list(store.get_entries()) == [(ENTRY_UUID, ENTRY)]
+    finally:
+        store.close()
+
+
+def test_rollback(store, filename):
+    store.set_cookie('cookie1')
+    store.put_entry(ENTRY_UUID, ENTRY)
+    store.commit()
+
+    # changes which are not committed are lost
+    store.set_cookie('cookie2')
+    store.delete_entry(ENTRY_UUID)
+    store.close()
+
+    store = SyncReplStateStore(filename)
+    try:
+        assert store.get_cookie() == 'cookie1'
+        assert list(store.get_entries()) == [(ENTRY_UUID, ENTRY)]
+    finally:
+        store.close()
+
+
+def test_clear_entries(store):
+    store.put_entry(ENTRY_UUID, ENTRY)
+    store.put_entry('other', {'dn': 'cn=other', 'cn': [b'other']})
+    store.clear_entries()
+    assert list(store.get_entries()) == []
+
+
+def test_clear(store):
+    store.set_cookie('cookie1')
+    store.put_entry(ENTRY_UUID, ENTRY)
+    store.clear()
+    assert store.get_cookie() is None
+    assert list(store.get_entries()) == []
+
+
+class TestRefreshRequired(object):
+    @pytest.fixture
+    def consumer(self, request, filename):
+        store = SyncReplStateStore(filename)
+        store.set_cookie('cookie1')
+        store.put_entry(ENTRY_UUID, ENTRY)
+        store.commit()
+        store.close()
+
+        consumer = SyncReplConsumer('ldap://localhost', state_file=filename)
+        request.addfinalizer(consumer.close_db)
+        return consumer
+
+    @pytest.mark.parametrize('error', [
+        ldap.LDAPError({'result': SYNC_REFRESH_REQUIRED,
+                        'desc': 'e-syncRefreshRequired'}),
+        ldap.PROTOCOL_ERROR({'desc': 'Protocol error'}),
+        ldap.UNWILLING_TO_PERFORM({'desc': 'Server is unwilling to perform'}),
+    ])
+    def test_cookie_refused(self, consumer, error):
+        assert consumer.syncrepl_get_cookie() == 'cookie1'
+        assert consumer.is_cookie_refused(error)
+
+    def test_other_error(self, consumer):
+        assert not consumer.is_cookie_refused(
+            ldap.NO_SUCH_OBJECT({'desc': 'No such object'}))
+
+    def test_no_cookie(self, consumer):
+        consumer.reset_state()
+        assert not consumer.is_cookie_refused(
+            ldap.LDAPError({'result': SYNC_REFRESH_REQUIRED}))
+
+    def test_reset_state(self, consumer, filename):
+        consumer.reset_state()
+        assert consumer.syncrepl_get_cookie() is None
+        consumer.close_db()
+
+        # the next consumer starts with a full refresh
+        store = SyncReplStateStore(filename)
+        try:
+            assert store.get_cookie() is None
+            assert list(store.get_entries()) == []
+        finally:
+            store.close()
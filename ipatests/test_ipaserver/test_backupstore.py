@@ -0,0 +1,101 @@
+#
+# Copyright (C) 2016  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Tests for the incremental backup storage
+"""
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from ipaserver.install import backupstore
+
+pytestmark = pytest.mark.tier0
+
+
+def make_ldif(count, skip=()):
+    return b''.join(
+        b'dn: uid=user%d,cn=users,cn=accounts,dc=example,dc=com\n'
+        b'objectClass: top\n'
+        b'uid: user%d\n'
+        b'\n' % (i, i)
+        for i in range(count) if i not in skip)
+
+
+def write_file(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fd:
+        fd.write(data)
+
+
+def read_tree(top):
+    result = {}
+    for root, dirs, files in os.walk(top):
+        for name in dirs:
+            result[os.path.relpath(os.path.join(root, name), top)] = None
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as fd:
+                result[os.path.relpath(path, top)] = fd.read()
+    return result
+
+
+@pytest.fixture
+def tmpdir_path(request):
+    path = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(path))
+    return path
+
+
+class TestBackupStore(object):
+    def test_ldif_chunks(self):
+        ldif = make_ldif(1000)
+        chunks = list(backupstore.iter_ldif_chunks(
+            ldif.splitlines(True)))
+        assert b''.join(chunks) == ldif
+        assert len(chunks) > 1
+        for chunk in chunks:
+            assert chunk.startswith(b'dn: ')
+            assert chunk.endswith(b'\n\n')
+
+    def test_incremental_backup(self, tmpdir_path):
+        source = os.path.join(tmpdir_path, 'source')
+        full = os.path.join(tmpdir_path, 'ipa-full-1')
+        incremental = os.path.join(tmpdir_path, 'ipa-full-2')
+        restored = os.path.join(tmpdir_path, 'restored')
+        for path in (full, incremental, restored):
+            os.mkdir(path)
+
+        write_file(os.path.join(source, 'ipa-userRoot.ldif'),
+                   make_ldif(2000))
+        write_file(os.path.join(source, 'ipa', 'db', 'id2entry.db'),
+                   os.urandom(backupstore.BLOCK_SIZE + 10))
+        os.makedirs(os.path.join(source, 'ipa', 'empty'))
+
+        total, stored = backupstore.write_backup(source, full)
+        assert total == stored
+
+        # remove a single entry
+        write_file(os.path.join(source, 'ipa-userRoot.ldif'),
+                   make_ldif(2000, skip=(1000,)))
+        total, stored = backupstore.write_backup(source, incremental, full)
+        assert 0 < stored < backupstore.BLOCK_SIZE
+
+        assert backupstore.get_backup_chain(incremental) == [
+            incremental, full]
+
+        backupstore.restore_backup(incremental, restored)
+        assert read_tree(restored) == read_tree(source)
+
+    def test_missing_base(self, tmpdir_path):
+        backup = os.path.join(tmpdir_path, 'ipa-full-1')
+        os.mkdir(backup)
+        with pytest.raises(backupstore.admintool.ScriptError):
+            backupstore.write_backup(
+                tmpdir_path, backup,
+                os.path.join(tmpdir_path, 'nonexistent'))
@@ -0,0 +1,270 @@
+#
+# Copyright (C) 2016  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Tests for the cached DNS zone tree
+"""
+
+import pytest
+
+from ipalib import errors
+from ipalib.request import context, context_frame
+from ipapython import ipaldap
+from ipapython.dn import DN
+from ipapython.dnsutil import DNSName
+from ipaserver import dns_zone_tree
+from ipaserver.dns_zone_tree import DNSZoneTree, get_zone_tree
+
+pytestmark = pytest.mark.tier0
+
+
+@pytest.fixture
+def zone_tree():
+    tree = DNSZoneTree()
+    tree.add_zone(DNSName(u'example.com.'))
+    tree.add_zone(DNSName(u'sub.example.com.'))
+    tree.add_zone(DNSName(u'fw.example.com.'), forward=True)
+    tree.add_zone(DNSName(u'a.fw.example.com.'), forward=True)
+    tree.add_zone(DNSName(u'other.test.'), forward=True)
+    tree.add_delegation(DNSName(u'example.com.'), DNSName(u'fw'))
+    tree.add_delegation(DNSName(u'example.com.'), DNSName(u'b.deep'))
+    tree.add_delegation(DNSName(u'example.com.'), DNSName(u'@'))
+    return tree
+
+
+class TestDNSZoneTree(object):
+    @pytest.mark.parametrize('name,expected', [
+        (u'host.example.com.', u'example.com.'),
+        (u'EXAMPLE.com.', u'example.com.'),
+        (u'host.sub.example.com.', u'sub.example.com.'),
+        (u'host.fw.example.com.', u'example.com.'),
+        (u'host.other.test.', None),
+        (u'com.', None),
+    ])
+    def test_get_auth_zone(self, zone_tree, name, expected):
+        result = zone_tree.get_auth_zone(DNSName(name))
+        if expected is None:
+            assert result is None
+        else:
+            assert result == DNSName(expected)
+
+    @pytest.mark.parametrize('name,expected', [
+        (u'x.a.fw.example.com.', u'fw'),
+        (u'fw.example.com.', u'fw'),
+        (u'x.b.deep.example.com.', u'b.deep'),
+        (u'deep.example.com.', None),
+        (u'example.com.', None),
+        (u'host.example.com.', None),
+        (u'host.other.test.', None),
+        (u'a.fw', u'fw'),
+    ])
+    def test_get_longest_match_ns_delegation(self, zone_tree, name,
+                                             expected):
+        result = zone_tree.get_longest_match_ns_delegation(
+            DNSName(u'example.com.'), DNSName(name))
+        if expected is None:
+            assert result is None
+        else:
+            assert result == DNSName(expected)
+            assert not result.is_absolute()
+
+    def test_find_subtree_forward_zones(self, zone_tree):
+        result = zone_tree.find_subtree_forward_zones(
+            DNSName(u'fw.example.com.'))
+        assert sorted(result) == sorted([DNSName(u'fw.example.com.'),
+                                         DNSName(u'a.fw.example.com.')])
+
+        result = zone_tree.find_subtree_forward_zones(
+            DNSName(u'fw.example.com.'), child_zones_only=True)
+        assert result == [DNSName(u'a.fw.example.com.')]
+
+        result = zone_tree.find_subtree_forward_zones(DNSName(u'com.'))
+        assert sorted(result) == sorted([DNSName(u'fw.example.com.'),
+                                         DNSName(u'a.fw.example.com.')])
+
+        assert zone_tree.find_subtree_forward_zones(
+            DNSName(u'nonexistent.')) == []
+
+    def test_delegations(self, zone_tree):
+        example = DNSName(u'example.com.')
+        assert zone_tree.delegations == {
+            (example, DNSName(u'fw')),
+            (example, DNSName(u'b.deep')),
+            (example, DNSName(u'@')),
+        }
+        assert zone_tree.has_delegation(example, DNSName(u'FW'))
+        assert zone_tree.has_delegation(
+            example, DNSName(u'b.deep.example.com.'))
+        assert not zone_tree.has_delegation(example, DNSName(u'deep'))
+
+    def test_zones(self, zone_tree):
+        assert zone_tree.zones == {
+            (DNSName(u'example.com.'), False),
+            (DNSName(u'sub.example.com.'), False),
+            (DNSName(u'fw.example.com.'), True),
+            (DNSName(u'a.fw.example.com.'), True),
+            (DNSName(u'other.test.'), True),
+        }
+
+    def test_stored_case(self):
+        tree = DNSZoneTree()
+        tree.add_zone(DNSName(u'Example.COM.'))
+        tree.add_zone(DNSName(u'FW.Example.COM.'), forward=True)
+        tree.add_delegation(DNSName(u'example.com.'), DNSName(u'Sub'))
+
+        assert str(tree.get_auth_zone(
+            DNSName(u'host.example.com.'))) == 'Example.COM.'
+        assert str(tree.get_longest_match_ns_delegation(
+            DNSName(u'example.com.'), DNSName(u'host.sub'))) == 'Sub'
+        assert [str(zone) for zone in tree.find_subtree_forward_zones(
+            DNSName(u'example.com.'))] == ['FW.Example.COM.']
+
+
+BASE_DN = DN(('dc', 'example'), ('dc', 'com'))
+CONTAINER_DNS = DN(('cn', 'dns'))
+ZONE_DN = DN(('idnsname', 'example.com.'), CONTAINER_DNS, BASE_DN)
+
+
+class FakeEntry(dict):
+    def __init__(self, dn, **attrs):
+        super(FakeEntry, self).__init__(attrs)
+        self.dn = dn
+
+    @property
+    def single_value(self):
+        return dict((name, values[0]) for name, values in self.items())
+
+
+def zone_entry(usn=1):
+    return FakeEntry(
+        ZONE_DN,
+        objectclass=['top', 'idnsrecord', 'idnszone'],
+        idnsname=[DNSName(u'example.com.')],
+        idnszoneactive=[True],
+        nsrecord=[u'ns.example.com.'],
+        entryusn=[usn])
+
+
+def record_entry(name, usn=1, nsrecord=()):
+    return FakeEntry(
+        DN(('idnsname', name), ZONE_DN),
+        objectclass=['top', 'idnsrecord'],
+        idnsname=[DNSName(name)],
+        nsrecord=list(nsrecord),
+        entryusn=[usn])
+
+
+class FakeLDAP(ipaldap.LDAPClient):
+    """LDAP client which answers searches of the zone tree and counts them"""
+    def __init__(self):
+        # pylint: disable=super-init-not-called
+        self.calls = 0
+        self.last_usn = 10
+        self.changes = []
+
+    def get_last_usn(self):
+        self.calls += 1
+        return self.last_usn
+
+    def find_entries(self, filter=None, **kwargs):
+        # pylint: disable=redefined-builtin
+        self.calls += 1
+        if 'entryusn' in filter:
+            entries = self.changes
+        elif 'idnsZoneActive' in filter:
+            entries = [zone_entry()]
+        else:
+            entries = [record_entry(u'sub', nsrecord=[u'ns.sub.example.com.'])]
+        if not entries:
+            raise errors.NotFound(reason=u'no entries')
+        return entries, False
+
+
+class FakeAPI(object):
+    class Backend(object):
+        pass
+
+    class env(object):
+        container_dns = CONTAINER_DNS
+        basedn = BASE_DN
+
+
+@pytest.fixture
+def fake_api(request):
+    api = FakeAPI()
+    api.Backend.ldap2 = FakeLDAP()
+
+    def fin():
+        dns_zone_tree._zone_tree_cache.clear()
+        context.__dict__.pop('dns_zone_tree', None)
+    fin()
+    request.addfinalizer(fin)
+    return api
+
+
+class TestGetZoneTree(object):
+    def lookup(self, api):
+        tree = get_zone_tree(api)
+        assert tree is not None
+        assert tree.get_auth_zone(
+            DNSName(u'host.example.com.')) == DNSName(u'example.com.')
+        assert tree.get_longest_match_ns_delegation(
+            DNSName(u'example.com.'),
+            DNSName(u'host.sub.example.com.')) == DNSName(u'sub')
+        return tree
+
+    def test_ldap_calls_per_command(self, fake_api):
+        ldap = fake_api.Backend.ldap2
+
+        with context_frame():
+            # last USN, zones and delegations are read once
+            self.lookup(fake_api)
+            assert ldap.calls == 3
+            self.lookup(fake_api)
+            assert ldap.calls == 3
+
+        with context_frame():
+            # single entryUSN search in every following command
+            self.lookup(fake_api)
+            assert ldap.calls == 4
+            self.lookup(fake_api)
+            assert ldap.calls == 4
+
+    def test_soa_serial_update(self, fake_api):
+        ldap = fake_api.Backend.ldap2
+
+        with context_frame():
+            tree = self.lookup(fake_api)
+
+        ldap.changes = [zone_entry(usn=12), record_entry(u'www', usn=11)]
+        with context_frame():
+            assert self.lookup(fake_api) is tree
+            assert ldap.calls == 4
+        assert tree.usn == 12
+
+    @pytest.mark.parametrize('change', [
+        record_entry(u'other', usn=11, nsrecord=[u'ns.other.test.']),
+        # NS records of a known delegation were removed
+        record_entry(u'sub', usn=11),
+    ])
+    def test_ns_record_change(self, fake_api, change):
+        ldap = fake_api.Backend.ldap2
+
+        with context_frame():
+            tree = self.lookup(fake_api)
+
+        ldap.changes = [change]
+        with context_frame():
+            assert self.lookup(fake_api) is not tree
+            # entryUSN search followed by reload of the tree
+            assert ldap.calls == 7
+
+    def test_invalidate(self, fake_api):
+        ldap = fake_api.Backend.ldap2
+
+        with context_frame():
+            self.lookup(fake_api)
+            dns_zone_tree.invalidate_zone_tree()
+            self.lookup(fake_api)
+            assert ldap.calls == 4
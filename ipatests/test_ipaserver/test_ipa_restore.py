@@ -0,0 +1,142 @@
+#
+# Copyright (C) 2016  FreeIPA Contributors see COPYING for license
+#
+
+"""
+Tests for removal of RUV entries from LDIF files by ipa-restore
+"""
+
+import io
+import logging
+
+import pytest
+
+from ipaserver.install import ipa_restore
+
+pytestmark = pytest.mark.tier0
+
+USER_ENTRY = b"""dn: uid=admin,cn=users,cn=accounts,dc=example,dc=com
+objectClass: top
+objectClass: person
+uid: admin
+nsUniqueId: 8f3b5b82-e0b111e5-a9d8c7d9-73a8d2a4
+description: a long description which is folded onto a continuation line
+  by the LDIF writer
+"""
+
+GROUP_ENTRY = b"""dn: cn=admins,cn=groups,cn=accounts,dc=example,dc=com
+objectClass: top
+objectClass: groupOfNames
+cn: admins
+member: uid=admin,cn=users,cn=accounts,dc=example,dc=com
+"""
+
+RUV_DN = 'nsuniqueid=ffffffff-ffffffff-ffffffff-ffffffff,dc=example,dc=com'
+
+RUV_ENTRY = b"""dn: nsuniqueid=ffffffff-ffffffff-ffffffff-ffffffff,dc=example,dc=com
+objectClass: top
+objectClass: nsTombstone
+objectClass: extensibleobject
+nsUniqueId: ffffffff-ffffffff-ffffffff-ffffffff
+nsds50ruv: {replicageneration} 5720b9a3000000040000
+"""
+
+# the unique ID is folded, the DN doesn't contain it
+FOLDED_RUV_ENTRY = b"""dn: cn=replica,dc=example,dc=com
+objectClass: top
+objectClass: nsTombstone
+nsUniqueId: ffffffff-ffffffff-ff
+ ffffff-ffffffff
+nsds50ruv: {replicageneration} 5720b9a3000000040000
+"""
+
+# mentions the RUV unique ID but is not a RUV entry
+NOT_RUV_ENTRY = b"""dn: cn=not a ruv,dc=example,dc=com
+objectClass: top
+description: ffffffff-ffffffff-ffffffff-ffffffff
+"""
+
+
+def ldif(*entries):
+    return b'\n'.join(entries)
+
+
+def remove_ruv_entries(data, processes=1):
+    out_file = io.BytesIO()
+    ipa_restore.remove_ruv_entries(
+        io.BytesIO(data), out_file, logging.getLogger(__name__), processes)
+    return out_file.getvalue()
+
+
+class TestIterLDIFChunks(object):
+    @pytest.mark.parametrize('chunk_size', [1, 7, 64, 1024])
+    def test_chunks(self, chunk_size):
+        data = ldif(USER_ENTRY, GROUP_ENTRY, RUV_ENTRY, USER_ENTRY)
+        chunks = list(ipa_restore._iter_ldif_chunks(io.BytesIO(data),
+                                                    chunk_size))
+
+        assert b''.join(chunks) == data
+        # entries are never split
+        for chunk in chunks[:-1]:
+            assert chunk.endswith(b'\n\n')
+
+    def test_empty(self):
+        assert list(ipa_restore._iter_ldif_chunks(io.BytesIO(b''), 64)) == []
+
+
+class TestRemoveRUVEntriesFromChunk(object):
+    def test_no_ruv(self):
+        data = ldif(USER_ENTRY, GROUP_ENTRY)
+        assert ipa_restore._remove_ruv_entries_from_chunk(data) == (data, [])
+
+    def test_ruv(self):
+        data = ldif(USER_ENTRY, RUV_ENTRY, GROUP_ENTRY)
+        assert ipa_restore._remove_ruv_entries_from_chunk(data) == (
+            ldif(USER_ENTRY, GROUP_ENTRY), [RUV_DN])
+
+    def test_folded_uniqueid(self):
+        data = ldif(USER_ENTRY, FOLDED_RUV_ENTRY, GROUP_ENTRY)
+        assert ipa_restore._remove_ruv_entries_from_chunk(data) == (
+            ldif(USER_ENTRY, GROUP_ENTRY), ['cn=replica,dc=example,dc=com'])
+
+    def test_not_ruv(self):
+        data = ldif(USER_ENTRY, NOT_RUV_ENTRY)
+        assert ipa_restore._remove_ruv_entries_from_chunk(data) == (data, [])
+
+    def test_ruv_last(self):
+        data = ldif(USER_ENTRY, GROUP_ENTRY, RUV_ENTRY)
+        assert ipa_restore._remove_ruv_entries_from_chunk(data) == (
+            ldif(USER_ENTRY, GROUP_ENTRY), [RUV_DN])
+
+    def test_ruv_only(self):
+        assert ipa_restore._remove_ruv_entries_from_chunk(RUV_ENTRY) == (
+            b'', [RUV_DN])
+
+
+class TestRemoveRUVEntries(object):
+    @pytest.fixture(params=[1, 2], ids=['serial', 'parallel'])
+    def processes(self, request, monkeypatch):
+        # make chunk boundaries fall inside of entries
+        monkeypatch.setattr(ipa_restore, 'LDIF_CHUNK_SIZE', 100)
+        return request.param
+
+    def test_ruv_across_chunks(self, processes):
+        data = ldif(USER_ENTRY, RUV_ENTRY, GROUP_ENTRY)
+        assert len(RUV_ENTRY) > 2 * ipa_restore.LDIF_CHUNK_SIZE
+
+        assert remove_ruv_entries(data, processes) == ldif(USER_ENTRY,
+                                                           GROUP_ENTRY)
+
+    def test_folded_uniqueid(self, processes):
+        data = ldif(USER_ENTRY, FOLDED_RUV_ENTRY, NOT_RUV_ENTRY)
+        assert remove_ruv_entries(data, processes) == ldif(USER_ENTRY,
+                                                           NOT_RUV_ENTRY)
+
+    def test_ruv_last(self, processes):
+        data = ldif(USER_ENTRY, GROUP_ENTRY, RUV_ENTRY)
+        assert remove_ruv_entries(data, processes) == ldif(USER_ENTRY,
+                                                           GROUP_ENTRY)
+
+    def test_no_ruv(self, processes):
+        data = ldif(USER_ENTRY, GROUP_ENTRY, NOT_RUV_ENTRY)
+        assert remove_ruv_entries(data, processes) == data
@@ -18,11 +18,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import shutil
+import tempfile
+
 import pytest
 from nss import nss
 from ipalib.x509 import initialize_nss_database
 
-from ipaserver.install.ipa_otptoken_import import PSKCDocument, ValidationError
+from ipaserver.install.ipa_otptoken_import import (
+    PSKCDocument, PSKCStream, ValidationError)
 
 basename = os.path.join(os.path.dirname(__file__), "data")
 
@@ -156,3 +160,38 @@ class test_otptoken_import(object):
                 })]
         finally:
             nss.nss_shutdown()
+
+    def test_stream(self):
+        nss.nss_init_nodb()
+        try:
+            doc = PSKCStream(os.path.join(basename, "pskc-figure7.xml"))
+            assert doc.keyname == 'My Password 1'
+            doc.setKey('qwerty')
+            assert [(t.id, t.options) for t in doc.getKeyPackages()] == \
+                [(u'123456', {
+                    'ipatokenotpkey': u'GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ',
+                    'ipatokenvendor': u'TokenVendorAcme',
+                    'ipatokenserial': u'987654321',
+                    'ipatokenotpdigits': 8,
+                    'type': u'hotp'})]
+        finally:
+            nss.nss_shutdown()
+
+    def test_stream_invalid(self):
+        with pytest.raises(ValueError):
+            PSKCStream(os.path.join(basename, "pskc-invalid.xml"))
+
+    def test_stream_writer(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(tmpdir, "failed.xml")
+            doc = PSKCStream(os.path.join(basename, "full.xml"))
+            with doc.writer(output) as save:
+                for t in doc.getKeyPackages():
+                    save(t)
+                    t.remove()
+
+            doc = PSKCDocument(output)
+            assert [t.id for t in doc.getKeyPackages()] == [u'KID1']
+        finally:
+            shutil.rmtree(tmpdir)
@@ -13,6 +13,7 @@ import pytest
 
 from ipalib import api, create_api, errors
 from ipapython.dn import DN
+from ipaserver.servroles import get_masters_snapshot
 from ipatests.util import MockLDAP
 
 
@@ -748,3 +749,31 @@ class TestServerAttributes(object):
 
             assert (
                 self.config_retrieve(role_name, mock_api)[attr_name] == host)
+
+
+class TestMastersSnapshot(object):
+    def test_snapshot_is_reused_until_modification(self, mock_api,
+                                                   mock_masters):
+        attr_name = "ca_renewal_master_server"
+        role_name = "CA server"
+
+        snapshot = get_masters_snapshot(mock_api)
+        if snapshot.usn is None:
+            pytest.skip("entryUSN is not available")
+
+        assert get_masters_snapshot(mock_api) is snapshot
+
+        original_renewal_master = mock_api.Backend.serverroles.config_retrieve(
+            role_name)[attr_name]
+        other_ca_server = mock_masters.get_fqdn('trust-controller-ca')
+
+        try:
+            mock_api.Backend.serverroles.config_update(
+                **{attr_name: other_ca_server})
+
+            new_snapshot = get_masters_snapshot(mock_api)
+            assert new_snapshot is not snapshot
+            assert new_snapshot.usn > snapshot.usn
+        finally:
+            mock_api.Backend.serverroles.config_update(
+                **{attr_name: original_renewal_master})
@@ -268,6 +268,26 @@ class TestAutomemberRebuildHostMembership(XMLRPC_test):
         hostgroup1.remove_member(dict(host=host1.fqdn))
         hostgroup1.retrieve()
 
+    def test_rebuild_membership_hostgroups_direct(self, automember_hostgroup,
+                                                  hostgroup1, host1):
+        """ Rebuild automember membership for hosts without a task, first as
+        a dry run. Check the host has been added to the hostgroup only by
+        the real run. """
+        command = automember_hostgroup.make_rebuild_command(
+            type=u'hostgroup', dry_run=True)
+        result = command()
+        assert result['result'][hostgroup1.cn] == [host1.fqdn]
+        hostgroup1.retrieve()
+
+        command = automember_hostgroup.make_rebuild_command(
+            type=u'hostgroup', direct=True)
+        result = command()
+        assert result['result'] == {}
+        hostgroup1.attrs.update(member_host=[host1.fqdn])
+        hostgroup1.retrieve()
+        hostgroup1.remove_member(dict(host=host1.fqdn))
+        hostgroup1.retrieve()
+
     def test_rebuild_membership_for_host(self, host1, automember_hostgroup,
                                          hostgroup1):
         """ Rebuild automember membership for one host, both synchronously and
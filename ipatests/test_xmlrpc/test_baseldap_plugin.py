@@ -26,9 +26,10 @@ import ldap
 from ipapython.dn import DN
 from ipapython import ipaldap
 from ipalib import errors
+from ipalib import Str
 from ipalib.frontend import Command
 from ipaserver.plugins import baseldap
-from ipatests.util import assert_deepequal
+from ipatests.util import assert_deepequal, create_test_api
 import pytest
 
 
@@ -221,3 +222,49 @@ def test_entry_to_dict():
     assert_deepequal(
         baseldap.entry_to_dict(entry, all=True, raw=True),
         the_dict)
+
+
+@pytest.mark.tier0
+def test_convert_attribute_members():
+    """Test the LDAPObject.convert_attribute_members method"""
+    basedn = DN(('dc', 'example'), ('dc', 'com'))
+
+    class testuser(baseldap.LDAPObject):
+        container_dn = DN(('cn', 'users'), ('cn', 'accounts'))
+        takes_params = (Str('uid', primary_key=True),)
+
+    class testgroup(baseldap.LDAPObject):
+        container_dn = DN(('cn', 'groups'), ('cn', 'accounts'))
+        takes_params = (Str('cn', primary_key=True),)
+        attribute_members = {'member': ['testuser', 'testgroup']}
+
+    class FakeEntry(dict):
+        @property
+        def raw(self):
+            return self
+
+    api, _home = create_test_api(basedn=basedn)
+    api.add_plugin(testuser)
+    api.add_plugin(testgroup)
+    api.finalize()
+
+    users_dn = DN(testuser.container_dn, basedn)
+    groups_dn = DN(testgroup.container_dn, basedn)
+    entry = FakeEntry(member=[
+        DN(('uid', 'admin'), users_dn),
+        DN(('cn', 'admins'), groups_dn),
+        # escaped RDN value, converted by parsing the DN
+        DN(('uid', 'a,b'), users_dn),
+        # entry outside of the member containers is ignored
+        DN(('cn', 'other'), ('cn', 'etc'), basedn),
+        # raw value
+        str(DN(('uid', 'tuser'), users_dn)).encode('utf-8'),
+    ])
+    api.Object.testgroup.convert_attribute_members(entry)
+
+    assert_deepequal(
+        dict(entry),
+        dict(
+            member_testuser=[u'admin', u'a,b', u'tuser'],
+            member_testgroup=[u'admins'],
+        ))
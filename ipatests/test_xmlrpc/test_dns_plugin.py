@@ -27,6 +27,7 @@ from ipapython.dnsutil import DNSName
 from ipapython.dn import DN
 from ipatests.test_xmlrpc import objectclasses
 from ipatests.test_xmlrpc.xmlrpc_test import Declarative, fuzzy_digits
+from ipatests.util import Fuzzy
 import pytest
 
 try:
@@ -6174,3 +6175,87 @@ class test_dns_type_uri(test_dns):
             },
         ),
     ]
+
+
+@pytest.mark.tier1
+class test_dns_zone_import(test_dns):
+    """Test import of records from a zone file."""
+
+    @classmethod
+    def setup_class(cls):
+        super(test_dns_zone_import, cls).setup_class()
+        try:
+            api.Command['dnszone_add'](zone1, idnssoarname=zone1_rname)
+        except errors.DuplicateEntry:
+            pass
+
+    cleanup_commands = [
+        ('dnszone_del', [zone1], {'continue': True}),
+    ]
+
+    zonefile = (
+        u'$TTL 3600\n'
+        u'{name} IN A 192.0.2.1\n'
+        u'{name} IN TXT "text data"\n'
+        u'alias IN CNAME {name}\n'
+        u'hinfo IN HINFO "PC" "Linux"\n'
+    ).format(name=name1)
+
+    tests = [
+        dict(
+            desc='Import zone file into zone %r' % zone1,
+            command=('dnszone_import', [zone1], {'file': zonefile}),
+            expected={
+                'value': zone1_absolute_dnsname,
+                'summary': u'Imported resource records into DNS zone '
+                           u'"%s"' % zone1_absolute,
+                'result': {
+                    'records': 3,
+                    'entries': 2,
+                    'updated': 0,
+                    'skipped': 0,
+                },
+                'failed': [Fuzzy(u'^hinfo HINFO "PC" "Linux": .*')],
+            },
+        ),
+        dict(
+            desc='Show imported record %r in zone %r' % (name1, zone1),
+            command=('dnsrecord_show', [zone1, name1_dnsname], {}),
+            expected={
+                'value': name1_dnsname,
+                'summary': None,
+                'result': {
+                    'dn': name1_dn,
+                    'idnsname': [name1_dnsname],
+                    'dnsttl': [u'3600'],
+                    'arecord': [u'192.0.2.1'],
+                    'txtrecord': [u'"text data"'],
+                },
+            },
+        ),
+        dict(
+            desc='Import the same zone file into zone %r again' % zone1,
+            command=('dnszone_import', [zone1], {'file': zonefile}),
+            expected={
+                'value': zone1_absolute_dnsname,
+                'summary': u'Imported resource records into DNS zone '
+                           u'"%s"' % zone1_absolute,
+                'result': {
+                    'records': 0,
+                    'entries': 0,
+                    'updated': 0,
+                    'skipped': 3,
+                },
+                'failed': [Fuzzy(u'^hinfo HINFO "PC" "Linux": .*')],
+            },
+        ),
+        dict(
+            desc='Try to import invalid zone file into zone %r' % zone1,
+            command=('dnszone_import', [zone1],
+                     {'file': u'{name} IN A\n'.format(name=name1)}),
+            expected=lambda x, output: (
+                type(x) == errors.ValidationError and
+                Fuzzy(u"^invalid 'file': invalid zone file: ") == x.message
+            ),
+        ),
+    ]
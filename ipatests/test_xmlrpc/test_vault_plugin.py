@@ -21,8 +21,12 @@
 Test the `ipaserver/plugins/vault.py` module.
 """
 
+import os
+import tempfile
+
 import nose
 from ipalib import api
+from ipaclient.plugins.vault import MAX_VAULT_DATA_SIZE
 from ipatests.test_xmlrpc.xmlrpc_test import Declarative, fuzzy_string
 import pytest
 
@@ -33,10 +37,18 @@ user_name = u'testuser'
 standard_vault_name = u'standard_test_vault'
 symmetric_vault_name = u'symmetric_test_vault'
 asymmetric_vault_name = u'asymmetric_test_vault'
+large_standard_vault_name = u'large_standard_test_vault'
+large_symmetric_vault_name = u'large_symmetric_test_vault'
+large_asymmetric_vault_name = u'large_asymmetric_test_vault'
 
 # binary data from \x00 to \xff
 secret = ''.join(chr(c) for c in range(0, 256))
 
+# data larger than a single vault archive request, archived in chunks
+large_secret = secret * (MAX_VAULT_DATA_SIZE // len(secret) * 3 // 2)
+large_secret_file = os.path.join(
+    tempfile.gettempdir(), 'ipa-test-vault-secret-%d' % os.getpid())
+
 password = u'password'
 other_password = u'other_password'
 
@@ -138,6 +150,18 @@ class test_vault_plugin(Declarative):
 
         super(test_vault_plugin, cls).setup_class()
 
+        with open(large_secret_file, 'wb') as f:
+            f.write(large_secret)
+
+    @classmethod
+    def teardown_class(cls):
+        try:
+            os.remove(large_secret_file)
+        except OSError:
+            pass
+
+        super(test_vault_plugin, cls).teardown_class()
+
     cleanup_commands = [
         ('vault_del', [vault_name], {'continue': True}),
         ('vault_del', [vault_name], {
@@ -149,6 +173,9 @@ class test_vault_plugin(Declarative):
         ('vault_del', [standard_vault_name], {'continue': True}),
         ('vault_del', [symmetric_vault_name], {'continue': True}),
         ('vault_del', [asymmetric_vault_name], {'continue': True}),
+        ('vault_del', [large_standard_vault_name], {'continue': True}),
+        ('vault_del', [large_symmetric_vault_name], {'continue': True}),
+        ('vault_del', [large_asymmetric_vault_name], {'continue': True}),
     ]
 
     tests = [
@@ -662,6 +689,27 @@ class test_vault_plugin(Declarative):
             },
         },
 
+        {
+            'desc': 'Retrieve secret from standard vault with '
+                    'vault_retrieve_multiple',
+            'command': (
+                'vault_retrieve_multiple',
+                [[standard_vault_name]],
+                {},
+            ),
+            'expected': {
+                'value': [standard_vault_name],
+                'summary': 'Retrieved data from vaults "%s"'
+                           % standard_vault_name,
+                'result': [
+                    {
+                        'cn': [standard_vault_name],
+                        'data': secret,
+                    },
+                ],
+            },
+        },
+
         {
             'desc': 'Change standard vault to symmetric vault',
             'command': (
@@ -998,4 +1046,187 @@ class test_vault_plugin(Declarative):
             },
         },
 
+        {
+            'desc': 'Create standard vault for large data',
+            'command': (
+                'vault_add',
+                [large_standard_vault_name],
+                {
+                    'ipavaulttype': u'standard',
+                },
+            ),
+            'expected': {
+                'value': large_standard_vault_name,
+                'summary': 'Added vault "%s"' % large_standard_vault_name,
+                'result': {
+                    'dn': u'cn=%s,cn=admin,cn=users,cn=vaults,cn=kra,%s'
+                          % (large_standard_vault_name, api.env.basedn),
+                    'objectclass': [u'top', u'ipaVault'],
+                    'cn': [large_standard_vault_name],
+                    'ipavaulttype': [u'standard'],
+                    'owner_user': [u'admin'],
+                    'username': u'admin',
+                },
+            },
+        },
+
+        {
+            'desc': 'Archive large file into standard vault',
+            'command': (
+                'vault_archive',
+                [large_standard_vault_name],
+                {
+                    'in': large_secret_file,
+                },
+            ),
+            'expected': {
+                'value': large_standard_vault_name,
+                'summary': 'Archived data into vault "%s"'
+                           % large_standard_vault_name,
+                'result': {},
+            },
+        },
+
+        {
+            'desc': 'Retrieve large data from standard vault',
+            'command': (
+                'vault_retrieve',
+                [large_standard_vault_name],
+                {},
+            ),
+            'expected': {
+                'value': large_standard_vault_name,
+                'summary': 'Retrieved data from vault "%s"'
+                           % large_standard_vault_name,
+                'result': {
+                    'data': large_secret,
+                },
+            },
+        },
+
+        {
+            'desc': 'Create symmetric vault for large data',
+            'command': (
+                'vault_add',
+                [large_symmetric_vault_name],
+                {
+                    'ipavaulttype': u'symmetric',
+                    'password': password,
+                },
+            ),
+            'expected': {
+                'value': large_symmetric_vault_name,
+                'summary': 'Added vault "%s"' % large_symmetric_vault_name,
+                'result': {
+                    'dn': u'cn=%s,cn=admin,cn=users,cn=vaults,cn=kra,%s'
+                          % (large_symmetric_vault_name, api.env.basedn),
+                    'objectclass': [u'top', u'ipaVault'],
+                    'cn': [large_symmetric_vault_name],
+                    'ipavaulttype': [u'symmetric'],
+                    'ipavaultsalt': [fuzzy_string],
+                    'owner_user': [u'admin'],
+                    'username': u'admin',
+                },
+            },
+        },
+
+        {
+            'desc': 'Archive large file into symmetric vault',
+            'command': (
+                'vault_archive',
+                [large_symmetric_vault_name],
+                {
+                    'password': password,
+                    'in': large_secret_file,
+                },
+            ),
+            'expected': {
+                'value': large_symmetric_vault_name,
+                'summary': 'Archived data into vault "%s"'
+                           % large_symmetric_vault_name,
+                'result': {},
+            },
+        },
+
+        {
+            'desc': 'Retrieve large data from symmetric vault',
+            'command': (
+                'vault_retrieve',
+                [large_symmetric_vault_name],
+                {
+                    'password': password,
+                },
+            ),
+            'expected': {
+                'value': large_symmetric_vault_name,
+                'summary': 'Retrieved data from vault "%s"'
+                           % large_symmetric_vault_name,
+                'result': {
+                    'data': large_secret,
+                },
+            },
+        },
+
+        {
+            'desc': 'Create asymmetric vault for large data',
+            'command': (
+                'vault_add',
+                [large_asymmetric_vault_name],
+                {
+                    'ipavaulttype': u'asymmetric',
+                    'ipavaultpublickey': public_key,
+                },
+            ),
+            'expected': {
+                'value': large_asymmetric_vault_name,
+                'summary': 'Added vault "%s"' % large_asymmetric_vault_name,
+                'result': {
+                    'dn': u'cn=%s,cn=admin,cn=users,cn=vaults,cn=kra,%s'
+                          % (large_asymmetric_vault_name, api.env.basedn),
+                    'objectclass': [u'top', u'ipaVault'],
+                    'cn': [large_asymmetric_vault_name],
+                    'ipavaulttype': [u'asymmetric'],
+                    'ipavaultpublickey': [public_key],
+                    'owner_user': [u'admin'],
+                    'username': u'admin',
+                },
+            },
+        },
+
+        {
+            'desc': 'Archive large file into asymmetric vault',
+            'command': (
+                'vault_archive',
+                [large_asymmetric_vault_name],
+                {
+                    'in': large_secret_file,
+                },
+            ),
+            'expected': {
+                'value': large_asymmetric_vault_name,
+                'summary': 'Archived data into vault "%s"'
+                           % large_asymmetric_vault_name,
+                'result': {},
+            },
+        },
+
+        {
+            'desc': 'Retrieve large data from asymmetric vault',
+            'command': (
+                'vault_retrieve',
+                [large_asymmetric_vault_name],
+                {
+                    'private_key': private_key,
+                },
+            ),
+            'expected': {
+                'value': large_asymmetric_vault_name,
+                'summary': 'Retrieved data from vault "%s"'
+                           % large_asymmetric_vault_name,
+                'result': {
+                    'data': large_secret,
+                },
+            },
+        },
+
     ]